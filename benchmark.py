@@ -0,0 +1,491 @@
+#!/home/pi/.Envs/garage/bin/python
+# -*- coding: utf-8 -*-
+"""
+Mesures de performance de bout en bout, sans capteur ni réseau : lecture du
+capteur émulé (voir emulation.py), boucle de surveillance complète avec
+stockage des mesures, envoi des notifications vers des serveurs SMTP et
+HTTP locaux, débit et latence du serveur web sous charge, durée d'import de
+garage.py et serveur.py.
+
+Les résultats sont enregistrés en JSON ; --compare signale les mesures qui
+se sont dégradées par rapport à un enregistrement précédent, par exemple
+celui du commit précédent. La mesure du démarrage échoue aussi si les
+imports dépassent leur budget ou si un module qui ne doit être chargé qu'à
+sa première utilisation l'est dès le démarrage.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import configparser
+import functools
+import http.server
+import json
+import logging
+import os
+import platform
+import queue
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import emulation
+import tsl2561
+
+# configuration des mesures, indépendante de /etc/garage.conf pour que les
+# résultats soient comparables d'une machine à l'autre
+CONFIG = """
+[Etats]
+ferme = 0.0
+ouvert = 0.52
+lumiere = 0.57
+
+[Temps]
+delay = 20
+compteur = 3
+
+[Capteur]
+integration = 402
+gain = 16
+
+[Mail]
+destinataires = garage@localhost
+expediteur = garage@localhost
+"""
+MESURES = ("lecture", "surveillance", "notification", "serveur", "demarrage")
+# budget de la durée d'import (ms, mesurée par python -X importtime), à
+# ajuster avec --budget selon la machine
+BUDGET = {"garage": 150, "serveur": 150}
+# modules chargés seulement s'ils sont configurés, à leur première
+# utilisation
+DIFFERES = ("numpy", "requests", "rrdtool", "smtplib", "email.mime.text")
+# nombre de lancements de l'interpréteur par module mesuré
+ESSAIS_IMPORT = 5
+# le graphique du jour est demandé avec l'extension de son format
+CHEMINS = ("/", "/api/current", "/api/history?start=end-1d", "/garage_jour")
+
+
+class Args:
+    pass
+
+
+class ServeurSMTP(socketserver.ThreadingTCPServer):
+    """ serveur SMTP local qui accepte tous les messages et note leur date
+    de réception
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), GestionnaireSMTP)
+        self.recus = queue.Queue()
+
+
+class GestionnaireSMTP(socketserver.StreamRequestHandler):
+    def reponse(self, texte):
+        self.wfile.write(texte.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reponse("220 localhost")
+        for ligne in self.rfile:
+            commande = ligne[:4].upper()
+            if commande == b"DATA":
+                self.reponse("354 fin par <CRLF>.<CRLF>")
+                lignes = []
+                for ligne_ in self.rfile:
+                    if ligne_ == b".\r\n":
+                        break
+                    lignes.append(ligne_)
+                self.server.recus.put((time.perf_counter(), b"".join(lignes)))
+                self.reponse("250 OK")
+            elif commande == b"QUIT":
+                self.reponse("221 au revoir")
+                return
+            else:
+                self.reponse("250 localhost")
+
+
+class GestionnaireSMS(http.server.BaseHTTPRequestHandler):
+    """ API SMS locale : accepte tous les messages et note leur date de
+    réception
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.recus.put((time.perf_counter(), self.path))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def demarre(serveur):
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    return serveur
+
+
+def moyenne_us(fonction, repetitions):
+    """ durée moyenne d'un appel de fonction en microsecondes """
+    debut = time.perf_counter()
+    for _ in range(repetitions):
+        fonction()
+    return (time.perf_counter() - debut) * 1e6 / repetitions
+
+
+def mesure_lecture(repetitions):
+    """ coût par mesure de TSL2561.read sur le bus émulé (sans les attentes
+    de fin de conversion), du calcul de la luminosité seul et du calcul
+    groupé de lux_array
+    """
+    horloge = emulation.Horloge()
+    resultats = {}
+    tsl2561.time = horloge
+    try:
+        for bloc in (False, True):
+            capteur = emulation.TSL2561Emule(lambda date: 50.0, horloge)
+            tsl = tsl2561.TSL2561(emulation.BusEmule({0x39: capteur},
+                                                     horloge=horloge),
+                                  block=bloc)
+            tsl.gain(16)
+            tsl.integration_time(13)
+            cle = "read_bloc_us" if bloc else "read_us"
+            resultats[cle] = moyenne_us(tsl.read, repetitions)
+        tsl.continuous(True)
+        resultats["read_continu_us"] = moyenne_us(
+            lambda: (horloge.sleep(0.02), tsl.read()), repetitions)
+        tsl.continuous(False)
+        resultats["read_autorange_us"] = moyenne_us(
+            functools.partial(tsl.read, autorange=True), repetitions)
+        canaux = tsl.last_channels
+        resultats["lux_us"] = moyenne_us(functools.partial(tsl._lux, canaux),
+                                         repetitions)
+    finally:
+        tsl2561.time = time
+    broadband, ir = [canaux[0]] * repetitions, [canaux[1]] * repetitions
+    # numpy est importé au premier appel
+    tsl2561.TSL2561.lux_array(broadband[:1], ir[:1], 16, 13)
+    debut = time.perf_counter()
+    tsl2561.TSL2561.lux_array(broadband, ir, 16, 13)
+    resultats["lux_array_us"] = (time.perf_counter() - debut) * 1e6 / \
+        repetitions
+    resultats["numpy"] = tsl2561.numpy is not None
+    return resultats
+
+
+def mesure_surveillance(config, repertoire):
+    """ journée synthétique rejouée par Surveille avec publication des
+    mesures et écriture de chacune dans la base (rrdtool.update ou base en
+    pur Python)
+    """
+    import partage
+    from graphes import rrdtool
+    debut = int(time.time()) // emulation.JOUR * emulation.JOUR - \
+        emulation.JOUR
+    points = emulation.journee_synthetique(config["Etats"], debut, graine=1)
+    base = os.path.join(repertoire, "garage.rrd")
+    tampon = None
+    if rrdtool is not None:
+        from rrd_manage import cree_rrd_database
+        from stockage import TamponRRD
+        cree_rrd_database(base, config.getint("Temps", "delay"), debut - 60)
+        tampon = TamponRRD(1)
+    publication = partage.Publication(os.path.join(repertoire, "mesures"))
+    bilan = emulation.rejoue(config, points, graine=1, base=base,
+                             tampon=tampon, publication=publication)
+    lectures = len(bilan["lectures"])
+    return {"lectures": lectures,
+            "iteration_us": bilan["duree"] * 1e6 / max(1, lectures),
+            "acceleration": bilan["duree_virtuelle"] / bilan["duree"],
+            "stockage": "rrdtool" if rrdtool is not None else "serie",
+            "base": base,
+            "partage": os.path.join(repertoire, "mesures")}
+
+
+def mesure_notification(config, repertoire, messages):
+    """ coût de previens et délai jusqu'à la réception de chaque message
+    par les serveurs SMTP et SMS locaux
+    """
+    import garage
+    from notification import Distributeur, TransportSMS, TransportSMTP
+    smtp = demarre(ServeurSMTP())
+    sms = http.server.ThreadingHTTPServer(("127.0.0.1", 0), GestionnaireSMS)
+    sms.daemon_threads = True
+    sms.recus = queue.Queue()
+    demarre(sms)
+    garage.config = config
+    garage.logger = logging.getLogger('Garage')
+    garage.transport_mail = TransportSMTP(*smtp.server_address)
+    client = TransportSMS("utilisateur", "secret", "http://{}:{}/sendmsg"
+                          .format(*sms.server_address))
+    garage.distributeur = Distributeur(
+        {"sms": functools.partial(garage.envoi_sms, client),
+         "mail": garage.envoi_mail},
+        os.path.join(repertoire, "spool"))
+    appels, delais = [], {"mail": [], "sms": []}
+    try:
+        for numero in range(messages):
+            debut = time.perf_counter()
+            garage.previens("message {}".format(numero))
+            appels.append(time.perf_counter() - debut)
+            for nom, serveur in (("mail", smtp), ("sms", sms)):
+                recu, _ = serveur.recus.get(timeout=10)
+                delais[nom].append(recu - debut)
+    finally:
+        garage.distributeur.arrete(5)
+        garage.transport_mail.close()
+        client.close()
+        smtp.shutdown()
+        sms.shutdown()
+    resultats = {"previens_us": sum(appels) * 1e6 / len(appels)}
+    for nom, valeurs in delais.items():
+        valeurs.sort()
+        resultats["{}_p50_ms".format(nom)] = valeurs[len(valeurs) // 2] * 1000
+        resultats["{}_max_ms".format(nom)] = valeurs[-1] * 1000
+    return resultats
+
+
+def mesure_serveur(base, partage, clients, duree):
+    """ débit et latence de serveur.py, lancé dans ce processus sur les
+    mesures et la base produites par mesure_surveillance
+    """
+    import charge
+    import serveur
+    from graphes import rrdtool
+    from serie import fichier_serie
+    serveur.fichier_partage = partage
+    serveur.bases["garage"] = base
+    if rrdtool is not None:
+        serveur.graphes = serveur.Graphes(base, 32)
+    else:
+        serveur.graphes = serveur.GraphesSerie(fichier_serie(base), 32)
+    httpd = demarre(serveur.ServeurConcurrent(("127.0.0.1", 0),
+                                              serveur.mon_serveur,
+                                              journal=False))
+    resultats = {}
+    try:
+        for chemin in CHEMINS:
+            if chemin in serveur.GRAPHES:
+                chemin += "." + serveur.graphes.extension
+            resultat = charge.charge(*httpd.server_address, chemin, clients,
+                                     duree)
+            resultats[chemin] = {cle: resultat[cle] for cle in
+                                 ("requetes_par_seconde", "latence_p50_ms",
+                                  "latence_p99_ms", "erreurs")}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return resultats
+
+
+def temps_import(module, essais=ESSAIS_IMPORT):
+    """ durée d'import de module (ms, médiane de essais lancements de
+    python -X importtime) et modules qu'il importe
+    """
+    durees = []
+    for _ in range(essais):
+        sortie = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import " + module],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            check=True).stderr.decode()
+        importes = set()
+        for ligne in sortie.splitlines():
+            # import time: propre | cumulé | nom indenté selon la profondeur
+            champs = ligne.split("|")
+            if len(champs) != 3 or not champs[1].strip().isdigit():
+                continue
+            nom = champs[2].rstrip()
+            if nom == " site":
+                # les modules importés par site ne comptent pas
+                importes = set()
+            elif nom == " " + module:
+                durees.append(int(champs[1]) / 1000)
+            else:
+                importes.add(nom.strip())
+    return statistics.median(durees), importes
+
+
+def mesure_demarrage():
+    """ durée d'import de garage.py et serveur.py, et modules différés
+    importés malgré tout
+    """
+    resultats = {}
+    for module in BUDGET:
+        try:
+            duree, importes = temps_import(module)
+        except subprocess.CalledProcessError as e:
+            print("Import de {} impossible : {}".format(
+                module, e.stderr.decode().strip().splitlines()[-1]),
+                file=sys.stderr)
+            continue
+        resultats[module + "_ms"] = duree
+        resultats[module + "_differes"] = sorted(
+            set(DIFFERES) & importes)
+    return resultats
+
+
+def depassements(resultats, budget=BUDGET):
+    """ messages des dépassements du budget de démarrage """
+    messages = []
+    for module, limite in budget.items():
+        duree = resultats.get(module + "_ms")
+        if duree is not None and duree > limite:
+            messages.append("Import de {} en {:.1f} ms, budget {} ms".format(
+                module, duree, limite))
+        for differe in resultats.get(module + "_differes", []):
+            messages.append("{} importé au démarrage de {}".format(differe,
+                                                                 module))
+    return messages
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def mesure(mesures, repetitions=10000, messages=20, clients=10, duree=2):
+    """ lance les mesures demandées et renvoie les résultats """
+    config = configparser.ConfigParser()
+    config.read_string(CONFIG)
+    resultats = {}
+    with tempfile.TemporaryDirectory() as repertoire:
+        if "lecture" in mesures:
+            resultats["lecture"] = mesure_lecture(repetitions)
+        if "surveillance" in mesures or "serveur" in mesures:
+            # le serveur lit les mesures produites par la surveillance
+            surveillance = mesure_surveillance(config, repertoire)
+            if "surveillance" in mesures:
+                resultats["surveillance"] = {
+                    cle: valeur for cle, valeur in surveillance.items()
+                    if cle not in ("base", "partage")}
+        if "notification" in mesures:
+            resultats["notification"] = mesure_notification(
+                config, repertoire, messages)
+        if "serveur" in mesures:
+            resultats["serveur"] = mesure_serveur(
+                surveillance["base"], surveillance["partage"], clients,
+                duree)
+        if "demarrage" in mesures:
+            resultats["demarrage"] = mesure_demarrage()
+    return {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "parametres": {"repetitions": repetitions, "messages": messages,
+                           "clients": clients, "duree": duree},
+            "resultats": resultats}
+
+
+def aplatit(resultats, prefixe=""):
+    """ valeurs numériques des résultats, par chemin "mesure.clé" """
+    valeurs = {}
+    for cle, valeur in resultats.items():
+        if isinstance(valeur, dict):
+            valeurs.update(aplatit(valeur, prefixe + cle + "."))
+        elif isinstance(valeur, (int, float)) and \
+                not isinstance(valeur, bool):
+            valeurs[prefixe + cle] = valeur
+    return valeurs
+
+
+def compare(ancien, nouveau, tolerance=0.2):
+    """ liste des (clé, ancienne valeur, nouvelle valeur) dégradées de plus
+    de tolerance ; les débits doivent augmenter, les durées diminuer
+    """
+    anciennes = aplatit(ancien["resultats"])
+    degradees = []
+    for cle, valeur in aplatit(nouveau["resultats"]).items():
+        reference = anciennes.get(cle)
+        if not reference or cle.endswith(("lectures", "erreurs")):
+            continue
+        if cle.endswith(("par_seconde", "acceleration")):
+            degradee = valeur < reference * (1 - tolerance)
+        else:
+            degradee = valeur > reference * (1 + tolerance)
+        if degradee:
+            degradees.append((cle, reference, valeur))
+    return degradees
+
+
+def affiche(resultats, prefixe=""):
+    for cle, valeur in aplatit(resultats).items():
+        print("{:50} {:12.2f}".format(prefixe + cle, valeur))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mesurer les performances "
+                                                 "sans capteur ni réseau.")
+    parser.add_argument("mesures", nargs="*",
+                        help="mesures à lancer parmi {} (toutes par "
+                             "défaut)".format(", ".join(MESURES)))
+    parser.add_argument("-o", "--sortie",
+                        help="fichier JSON où enregistrer les résultats")
+    parser.add_argument("-c", "--compare", type=argparse.FileType('r'),
+                        help="résultats JSON précédents : code de retour 1 "
+                             "si une mesure s'est dégradée")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2,
+                        help="dégradation relative tolérée (0.2 par défaut)")
+    parser.add_argument("-n", "--repetitions", type=int, default=10000,
+                        help="nombre de lectures du capteur émulé")
+    parser.add_argument("-m", "--messages", type=int, default=20,
+                        help="nombre de notifications envoyées")
+    parser.add_argument("--clients", type=int, default=10,
+                        help="nombre de clients simultanés du serveur web")
+    parser.add_argument("-d", "--duree", type=float, default=2,
+                        help="durée de la charge pour chaque adresse (s)")
+    parser.add_argument("-b", "--budget", type=float,
+                        help="durée d'import maximale de garage.py et "
+                             "serveur.py (ms, {} par défaut)".format(
+                                 ", ".join("{} pour {}".format(limite, module)
+                                           for module, limite
+                                           in BUDGET.items())))
+    args = Args()
+    parser.parse_args(namespace=args)
+    inconnues = set(args.mesures) - set(MESURES)
+    if inconnues:
+        parser.error("mesures inconnues : {}".format(", ".join(inconnues)))
+    logging.basicConfig(level=logging.ERROR)
+    resultats = mesure(args.mesures or MESURES, args.repetitions,
+                       args.messages, args.clients, args.duree)
+    affiche(resultats["resultats"])
+    if args.sortie:
+        with open(args.sortie, "w", encoding="utf-8") as f:
+            json.dump(resultats, f, indent=2, ensure_ascii=False)
+    echec = False
+    if "demarrage" in resultats["resultats"]:
+        budget = BUDGET if args.budget is None \
+            else dict.fromkeys(BUDGET, args.budget)
+        for message in depassements(resultats["resultats"]["demarrage"],
+                                    budget):
+            print(message)
+            echec = True
+    if args.compare:
+        degradees = compare(json.load(args.compare), resultats,
+                            args.tolerance)
+        for cle, ancienne, nouvelle in degradees:
+            print("Dégradation de {} : {:.2f} -> {:.2f}".format(
+                cle, ancienne, nouvelle))
+        echec = echec or bool(degradees)
+    sys.exit(1 if echec else 0)
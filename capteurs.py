@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+"""
+Surveillance de plusieurs capteurs de luminosité par un seul processus.
+Chaque capteur est lu à sa propre période par une tâche asyncio. Les accès
+à un même bus I2C sont sérialisés par un verrou et exécutés dans un
+thread par bus, pour ne pas bloquer la boucle d'événements.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import logging
+import math
+import time
+import metriques
+from filtres import Decision
+
+FMT_DATE = "%H:%M:%S"
+# intervalle entre deux bilans de ponctualité des lectures (s)
+RAPPORT = 3600
+
+logger = logging.getLogger('Garage')
+
+
+class Porte:
+    """ machine à états d'une porte : prévient à chaque changement d'état
+    et lors de la perte ou du retour du capteur
+    """
+
+    def __init__(self, nom, etats, previens, decision=None):
+        """
+        param: nom: nom de la porte, repris dans les messages
+        param: etats: section de configuration état -> seuil de luminosité
+        param: previens: fonction d'envoi d'un message
+        param: decision: filtrage des mesures (voir filtres.py), ou None
+            pour retenir l'état de chaque mesure
+        """
+        self.nom = nom
+        self.etats = etats
+        self.previens = previens
+        self.decision = decision if decision is not None \
+            else Decision(etats)
+        self.etat = 'fermé'
+        self.malade = False
+
+    def mesure(self, lux):
+        """ prend en compte une valeur lue et renvoie l'état correspondant """
+        if self.malade:
+            self.malade = False
+            msg = "Capteur {nom} ok.".format(nom=self.nom)
+            logger.info(msg)
+            self.previens(msg)
+        etat = self.decision.mesure(lux)
+        if etat != self.etat:
+            gdh = datetime.datetime.now()
+            msg = "{nom} : etat {statut}" \
+                  " a {gdh}".format(nom=self.nom, statut=etat,
+                                    gdh=gdh.strftime(FMT_DATE))
+            self.previens(msg)
+        self.etat = etat
+        return etat
+
+    def bornes(self, lux):
+        """ renvoie les luminosités qui encadrent l'état confirmé : une
+        mesure sous la première ou au-dessus de la seconde propose un
+        changement d'état (None s'il n'y en a pas). Avant la première
+        décision, les seuils qui encadrent lux.
+        """
+        if self.decision.etat is None:
+            return self.decision.classifieur.bornes(lux)
+        return self.decision.bornes()
+
+    def reconfigure(self, etats, decision):
+        """ nouveaux seuils ou nouveau filtrage, en gardant l'état courant """
+        decision.force(self.etat)
+        self.etats = etats
+        self.decision = decision
+
+    def erreur(self, e):
+        """ prend en compte une erreur de lecture du capteur """
+        if not self.malade:
+            msg = "Erreur dans la lecture du capteur {nom} : " \
+                  "{e}".format(nom=self.nom, e=e)
+            logger.fatal(msg)
+            self.previens(msg)
+        self.malade = True
+
+
+class Cadence:
+    """ échéances des lectures d'un capteur, sur l'horloge monotone : la
+    durée des lectures ne décale pas les suivantes. En régime établi, les
+    lectures tombent sur les multiples de la période (en heure système),
+    comme les pas de la base rrd. En mode adaptatif, l'intervalle descend à
+    rapide quand la luminosité varie ou approche d'un seuil, puis double à
+    chaque lecture stable jusqu'à revenir à la période.
+    """
+
+    def __init__(self, periode, rapide=0, variation=0.1, proximite=0.1):
+        """
+        param: periode: intervalle normal entre deux lectures (s)
+        param: rapide: intervalle minimal en mode adaptatif (s), 0 pour
+            des lectures à période fixe
+        param: variation: variation relative de la luminosité entre deux
+            lectures qui déclenche les lectures rapides
+        param: proximite: distance relative à un seuil en deçà de laquelle
+            les lectures sont rapides
+        """
+        self.periode = periode
+        self.rapide = rapide
+        self.variation = variation
+        self.proximite = proximite
+        self.intervalle = periode
+        self.precedente = None
+        # ponctualité : lectures à l'heure, échéances manquées, écarts (s)
+        self.lectures = 0
+        self.manquees = 0
+        self.gigue_totale = 0.0
+        self.gigue_max = 0.0
+
+    def alignee(self, apres):
+        """ première échéance alignée sur la période après la date monotone
+        apres
+        """
+        decalage = time.time() - time.monotonic()
+        return (math.floor((apres + decalage) / self.periode) + 1) * \
+            self.periode - decalage
+
+    def adapte(self, lux, seuils):
+        """ choisit l'intervalle jusqu'à la prochaine lecture d'après la
+        luminosité lue et les seuils des états de la porte
+        """
+        if not self.rapide:
+            self.intervalle = self.periode
+            return
+        agitee = self.precedente is not None and \
+            abs(lux - self.precedente) > self.variation * abs(self.precedente)
+        proche = any(seuil and abs(lux - seuil) <= self.proximite * seuil
+                     for seuil in seuils)
+        self.precedente = lux
+        if agitee or proche:
+            self.intervalle = self.rapide
+        else:
+            self.intervalle = min(self.periode, self.intervalle * 2)
+
+    def suivante(self, echeance, maintenant):
+        """ échéance qui suit echeance ; les échéances déjà passées à la
+        date maintenant sont comptées comme manquées et sautées
+        """
+        if self.intervalle >= self.periode:
+            # un demi-pas évite de retomber sur echeance par arrondi
+            suivante = self.alignee(echeance + self.periode / 2)
+        else:
+            suivante = echeance + self.intervalle
+        if suivante <= maintenant:
+            pas = min(self.intervalle, self.periode)
+            self.manquees += math.ceil((maintenant - suivante) / pas) or 1
+            suivante = self.alignee(maintenant) \
+                if self.intervalle >= self.periode else maintenant + pas
+        return suivante
+
+    def mesure(self, ecart):
+        """ prend en compte le retard d'une lecture sur son échéance (s) """
+        self.lectures += 1
+        self.gigue_totale += abs(ecart)
+        self.gigue_max = max(self.gigue_max, abs(ecart))
+
+    def bilan(self):
+        return "{} lectures, gigue moyenne {:.1f} ms, maximale {:.1f} ms, " \
+               "{} échéances manquées".format(
+                   self.lectures,
+                   self.gigue_totale * 1000 / max(1, self.lectures),
+                   self.gigue_max * 1000, self.manquees)
+
+
+class Capteur:
+    """ capteur de luminosité associé à une porte """
+
+    def __init__(self, nom, tsl, porte, bus=1, delai=30, cycle=1.0,
+                 rrd=None, interruption=None, persistance=1, cadence=None,
+                 automatique=False):
+        """
+        param: automatique: gain et temps d'intégration choisis à chaque
+            lecture d'après la luminosité (voir TSL2561.read)
+        param: cadence: échéances des lectures (Cadence), à période delai
+            fixe par défaut
+        param: interruption: source d'interruption (voir interruptions.py)
+            reliée à la ligne INT du capteur, ou None pour une lecture
+            périodique
+        param: persistance: nombre de cycles d'intégration hors seuils
+            avant que le capteur ne déclenche l'interruption
+        """
+        self.nom = nom
+        self.tsl = tsl
+        self.porte = porte
+        self.bus = bus
+        self.delai = delai
+        self.cycle = cycle
+        self.rrd = rrd
+        self.interruption = interruption
+        self.persistance = persistance
+        # seuils d'interruption programmés dans le capteur
+        self.arme = False
+        # date et valeur de la dernière lecture
+        self.horodatage = None
+        self.lux = None
+        # date monotone de la dernière tentative de lecture
+        self.activite = time.monotonic()
+        self.cadence = cadence if cadence is not None else Cadence(delai)
+        self.automatique = automatique
+
+
+class Ordonnanceur:
+    """ lit tous les capteurs en parallèle, chacun à sa période """
+
+    def __init__(self, capteurs, enregistre=None, signaux=None,
+                 veilleur=None):
+        """
+        param: capteurs: liste des capteurs à surveiller
+        param: enregistre: fonction appelée avec (capteur, lux) après
+            chaque lecture réussie
+        param: signaux: signal -> fonction appelée dans la boucle
+            d'événements à la réception du signal
+        param: veilleur: (période, fonction) : fonction appelée dans la
+            boucle d'événements toutes les période secondes, par exemple
+            pour le chien de garde de systemd
+        """
+        self.capteurs = capteurs
+        self.enregistre = enregistre
+        self.signaux = signaux or {}
+        self.veilleur = veilleur
+        self._taches = None
+        self._reglages = set()
+        bus = {capteur.bus for capteur in capteurs}
+        self.verrous = {}
+        self.executeur = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(bus)), thread_name_prefix="i2c")
+
+    async def _i2c(self, capteur, fonction, *args):
+        """ exécute une fonction du capteur en ayant le bus pour soi """
+        async with self.verrous[capteur.bus]:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executeur, functools.partial(fonction, *args))
+
+    async def attend(self, capteur, pause):
+        """ attend pause secondes avant la prochaine lecture. En mode continu
+        avec un rapport cyclique inférieur à 1, le capteur est éteint pendant
+        l'attente puis rallumé juste assez tôt pour qu'une conversion soit
+        terminée au moment de la lecture. Renvoie True si l'attente a été
+        interrompue par le capteur.
+        """
+        tsl = capteur.tsl
+        if capteur.interruption is not None and capteur.arme:
+            return await self.attend_interruption(capteur, pause)
+        if not tsl.continuous() or capteur.cycle >= 1:
+            await asyncio.sleep(pause)
+            return False
+        allume = min(pause, max(pause * capteur.cycle,
+                                tsl.conversion_time()))
+        await self._i2c(capteur, tsl.active, False)
+        await asyncio.sleep(pause - allume)
+        await self._i2c(capteur, tsl.active, True)
+        await asyncio.sleep(allume)
+        return False
+
+    async def attend_interruption(self, capteur, delai):
+        """ attend que le capteur signale un changement d'état, au plus
+        delai secondes pour continuer à enregistrer des mesures
+        """
+        loop = asyncio.get_running_loop()
+        source = capteur.interruption
+        evenement = asyncio.Event()
+        loop.add_reader(source.fileno(), evenement.set)
+        try:
+            await asyncio.wait_for(evenement.wait(), delai)
+            source.acquitte()
+            logger.debug("%s : interruption", capteur.nom)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(source.fileno())
+
+    async def arme(self, capteur, lux):
+        """ programme dans le capteur les seuils de l'état confirmé : tant
+        que la décision n'a pas changé, chaque intégration hors de ces
+        seuils réveille une lecture
+        """
+        tsl = capteur.tsl
+        bas, haut = capteur.porte.bornes(lux)
+        mini = 0 if bas is None else tsl.broadband_threshold(bas)
+        maxi = 0xffff if haut is None else tsl.broadband_threshold(haut)
+        capteur.arme = False
+        await self._i2c(capteur, tsl.threshold, capteur.persistance,
+                        mini, maxi)
+        await self._i2c(capteur, tsl.interrupt, False)
+        capteur.arme = True
+        logger.debug("%s : seuils d'interruption %s - %s", capteur.nom,
+                     mini, maxi)
+
+    async def lit(self, capteur):
+        """ lit le capteur sans garder le bus pendant l'intégration """
+        tsl = capteur.tsl
+        await self._i2c(capteur, tsl.active, True)
+        await asyncio.sleep(tsl.remaining())
+        reglage = tsl.gain(), tsl.integration_time()
+        lux = await self._i2c(capteur, functools.partial(
+            tsl.read, autorange=capteur.automatique))
+        capteur.horodatage = time.time()
+        if reglage != (tsl.gain(), tsl.integration_time()):
+            logger.debug("%s : gain %s, temps d'intégration %s ms",
+                         capteur.nom, tsl.gain(), tsl.integration_time())
+        if not tsl.continuous():
+            await self._i2c(capteur, tsl.active, False)
+        return lux
+
+    async def surveille(self, capteur):
+        """ boucle de lecture d'un capteur, à chaque échéance de sa cadence
+        ou lorsqu'il signale un changement d'état
+        """
+        cadence = capteur.cadence
+        echeance = time.monotonic()
+        rapport = echeance + RAPPORT
+        while True:
+            tsl = capteur.tsl
+            # hors mode continu, la conversion commence à l'allumage
+            avance = 0 if tsl.continuous() else tsl.conversion_time()
+            interrompue = await self.attend(
+                capteur, max(0, echeance - avance - time.monotonic()))
+            try:
+                lux = await self.lit(capteur)
+                etat = capteur.porte.mesure(lux)
+                if capteur.interruption is not None:
+                    await self.arme(capteur, lux)
+            except (IOError, ValueError) as e:
+                capteur.activite = time.monotonic()
+                capteur.arme = False
+                metriques.LECTURE_ERREURS.ajoute(capteur.nom)
+                capteur.porte.erreur(e)
+                cadence.periode = capteur.delai
+                echeance = cadence.suivante(echeance, time.monotonic())
+                continue
+            capteur.lux = lux
+            maintenant = capteur.activite = time.monotonic()
+            if not interrompue:
+                cadence.mesure(maintenant - echeance)
+                metriques.GIGUE.observe(abs(maintenant - echeance),
+                                        capteur.nom)
+            logger.debug("%s : valeur lue : %s - état : %s "
+                         "(%s transactions I2C)", capteur.nom, lux, etat,
+                         capteur.tsl.last_transactions)
+            if self.enregistre is not None:
+                self.enregistre(capteur, lux)
+            cadence.periode = capteur.delai
+            cadence.adapte(lux, capteur.porte.decision.classifieur.seuils)
+            if interrompue and echeance > maintenant:
+                # après une interruption, l'échéance prévue est gardée
+                echeance = min(echeance, maintenant + cadence.intervalle)
+            else:
+                echeance = cadence.suivante(echeance, maintenant)
+            if maintenant >= rapport:
+                logger.info("%s : %s", capteur.nom, cadence.bilan())
+                rapport = maintenant + RAPPORT
+
+    def regle(self, capteur, gain, integration):
+        """ change le gain et le temps d'intégration d'un capteur entre deux
+        lectures ; appelé depuis la boucle d'événements
+        """
+        tache = asyncio.get_running_loop().create_task(
+            self._regle(capteur, gain, integration))
+        self._reglages.add(tache)
+        tache.add_done_callback(self._reglages.discard)
+
+    async def _regle(self, capteur, gain, integration):
+        tsl = capteur.tsl
+        try:
+            if gain is not None and gain != tsl.gain():
+                await self._i2c(capteur, tsl.gain, gain)
+            if integration is not None and \
+                    integration != tsl.integration_time():
+                await self._i2c(capteur, tsl.integration_time, integration)
+        except (IOError, ValueError) as e:
+            logger.error("%s : erreur lors du réglage du capteur : %s",
+                         capteur.nom, e)
+            return
+        # les seuils d'interruption dépendent du gain et de l'intégration
+        capteur.arme = False
+        logger.info("%s : gain %s, temps d'intégration %s ms", capteur.nom,
+                    tsl.gain(), tsl.integration_time())
+
+    async def _veille(self, periode, fonction):
+        while True:
+            fonction()
+            await asyncio.sleep(periode)
+
+    def arrete(self):
+        """ termine la surveillance : run rend la main sans attendre la
+        fin des lectures en cours, qui ne sont pas enregistrées
+        """
+        if self._taches is not None:
+            self._taches.cancel()
+
+    async def _main(self, duree=None):
+        loop = asyncio.get_running_loop()
+        for signum, fonction in self.signaux.items():
+            loop.add_signal_handler(signum, fonction)
+        self.verrous = {capteur.bus: asyncio.Lock()
+                        for capteur in self.capteurs}
+        taches = [self.surveille(capteur) for capteur in self.capteurs]
+        if self.veilleur is not None:
+            taches.append(self._veille(*self.veilleur))
+        self._taches = asyncio.gather(*taches)
+        try:
+            if duree is None:
+                await self._taches
+            else:
+                await asyncio.wait_for(self._taches, duree)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            pass
+        finally:
+            self._taches = None
+            for signum in self.signaux:
+                loop.remove_signal_handler(signum)
+
+    def run(self, duree=None, boucle=None):
+        """ lit les capteurs, sans fin ou pendant duree secondes
+        param: boucle: boucle d'événements à utiliser (par exemple à
+            horloge virtuelle, voir emulation.py), une nouvelle par défaut
+        """
+        try:
+            if boucle is None:
+                asyncio.run(self._main(duree))
+            else:
+                boucle.run_until_complete(self._main(duree))
+        finally:
+            self.executeur.shutdown(wait=False)
@@ -0,0 +1,118 @@
+#!/home/pi/.Envs/garage/bin/python
+# -*- coding: utf-8 -*-
+"""
+Test de charge du serveur web : plusieurs clients envoient des requêtes
+en parallèle sur des connexions persistantes, puis le programme affiche
+le débit et les latences (médiane et 99e centile) pour chaque adresse.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import http.client
+import threading
+import time
+
+CHEMINS = ['/', '/garage_jour.png', '/garage_mois.png', '/garage_annee.png']
+
+
+class Args:
+    pass
+
+
+def centile(valeurs, p):
+    """ centile p (entre 0 et 100) d'une liste triée """
+    if not valeurs:
+        return float("nan")
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p / 100))]
+
+
+def client(hote, port, chemin, fin, latences, erreurs, persistant):
+    connexion = None
+    while time.monotonic() < fin:
+        if connexion is None:
+            connexion = http.client.HTTPConnection(hote, port, timeout=10)
+        debut = time.perf_counter()
+        try:
+            connexion.request("GET", chemin,
+                              headers={} if persistant
+                              else {"Connection": "close"})
+            reponse = connexion.getresponse()
+            reponse.read()
+        except (OSError, http.client.HTTPException):
+            erreurs.append(chemin)
+            connexion.close()
+            connexion = None
+            continue
+        latences.append(time.perf_counter() - debut)
+        if not persistant or reponse.will_close:
+            connexion.close()
+            connexion = None
+    if connexion is not None:
+        connexion.close()
+
+
+def charge(hote, port, chemin, clients=10, duree=5, persistant=True):
+    """ envoie des requêtes sur chemin pendant duree secondes et renvoie
+    les statistiques sous forme de dictionnaire
+    """
+    latences, erreurs = [], []
+    fin = time.monotonic() + duree
+    threads = [threading.Thread(target=client,
+                                args=(hote, port, chemin, fin, latences,
+                                      erreurs, persistant))
+               for _ in range(clients)]
+    debut = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ecoule = time.monotonic() - debut
+    latences.sort()
+    return {"chemin": chemin,
+            "clients": clients,
+            "requetes": len(latences),
+            "erreurs": len(erreurs),
+            "requetes_par_seconde": len(latences) / ecoule,
+            "latence_p50_ms": centile(latences, 50) * 1000,
+            "latence_p99_ms": centile(latences, 99) * 1000}
+
+
+def affiche(resultat):
+    print("{chemin:20} {requetes_par_seconde:8.1f} req/s  "
+          "p50 {latence_p50_ms:7.2f} ms  p99 {latence_p99_ms:7.2f} ms  "
+          "({requetes} requêtes, {erreurs} erreurs)".format(**resultat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mesurer le débit et la "
+                                                 "latence du serveur web.")
+    parser.add_argument("-H", "--hote", default="localhost",
+                        help="adresse du serveur")
+    parser.add_argument("-p", "--port", type=int, default=8080,
+                        help="port du serveur")
+    parser.add_argument("-n", "--clients", type=int, default=10,
+                        help="nombre de clients simultanés")
+    parser.add_argument("-d", "--duree", type=float, default=5,
+                        help="durée du test pour chaque adresse (s)")
+    parser.add_argument("--sans-keep-alive", action="store_true",
+                        help="une connexion par requête")
+    parser.add_argument("chemins", nargs="*", default=CHEMINS,
+                        help="adresses à tester")
+    args = Args()
+    parser.parse_args(namespace=args)
+    for chemin in args.chemins:
+        affiche(charge(args.hote, args.port, chemin, args.clients,
+                       args.duree, not args.sans_keep_alive))
@@ -5,6 +5,78 @@ import os
 import time
 import atexit
 import signal
+import socket
+
+# first file descriptor passed by systemd socket activation
+LISTEN_FDS_START = 3
+
+
+def sd_notify(*states):
+    """Send states (e.g. "READY=1", "WATCHDOG=1") to the service manager.
+
+    Return False when not started by systemd with a notify socket."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # abstract namespace
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall("\n".join(states).encode("utf-8"))
+    except OSError:
+        return False
+    return True
+
+
+def watchdog_interval():
+    """Seconds between two "WATCHDOG=1" pings: half of the WatchdogSec of
+    the service, or None when the watchdog is not enabled for this process."""
+    try:
+        usec = int(os.environ["WATCHDOG_USEC"])
+    except (KeyError, ValueError):
+        return None
+    pid = os.environ.get("WATCHDOG_PID")
+    if pid and pid != str(os.getpid()):
+        return None
+    return usec / 2e6
+
+
+def listen_fds():
+    """File descriptors passed by systemd socket activation or by reexec(),
+    in order. The environment variables are cleared so that children do not
+    inherit them."""
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return []
+    try:
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+    except ValueError:
+        count = 0
+    for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(name, None)
+    return list(range(LISTEN_FDS_START, LISTEN_FDS_START + count))
+
+
+def reexec(fds=()):
+    """Replace the process by a new instance of the same program, with the
+    same pid, passing fds the way systemd socket activation does (see
+    listen_fds). Does not return."""
+    import fcntl
+    sys.stdout.flush()
+    sys.stderr.flush()
+    # copies above the target range, so that no target overwrites a source
+    copies = [fcntl.fcntl(fd, fcntl.F_DUPFD, LISTEN_FDS_START + len(fds))
+              for fd in fds]
+    for index, copy in enumerate(copies):
+        os.dup2(copy, LISTEN_FDS_START + index)
+        os.close(copy)
+    os.environ["LISTEN_PID"] = str(os.getpid())
+    os.environ["LISTEN_FDS"] = str(len(fds))
+    argv = getattr(sys, "orig_argv", None)
+    # keep the interpreter options (-X, -O...) when known
+    argv = argv[1:] if argv else sys.argv
+    os.execv(sys.executable, [sys.executable] + list(argv))
 
 
 class daemon:
@@ -67,8 +139,9 @@ class daemon:
         self.daemonize()
         self.run()
 
-    def stop(self):
-        """Stop the daemon."""
+    def stop(self, timeout=30):
+        """Stop the daemon: send SIGTERM once, leave it timeout seconds to
+        finish its work, then kill it."""
         # Get the pid from the pidfile
         try:
             with open(self.pidfile, 'r') as pf:
@@ -81,11 +154,19 @@ class daemon:
                              "Daemon not running?\n".format(self.pidfile))
             return  # not an error in a restart
 
-        # Try killing the daemon process
+        # Ask the daemon to stop, only once: a second SIGTERM would
+        # interrupt its cleanup
         try:
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + timeout
             while 1:
-                os.kill(pid, signal.SIGTERM)
                 time.sleep(0.1)
+                if time.monotonic() > deadline:
+                    sys.stderr.write("Daemon still running after {0} s, "
+                                     "killed\n".format(timeout))
+                    os.kill(pid, signal.SIGKILL)
+                    deadline = float("inf")
+                os.kill(pid, 0)
         except OSError as err:
             e = str(err.args)
             if e.find("No such process") > 0:
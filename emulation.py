@@ -0,0 +1,804 @@
+#!/home/pi/.Envs/garage/bin/python
+# -*- coding: utf-8 -*-
+"""
+Émulation d'un capteur TSL2561 sur un bus SMBus, pour faire tourner le
+programme sans Raspberry Pi : le bus émulé répond aux registres utilisés par
+tsl2561.TSL2561 (identifiant, contrôle, temps d'intégration, canaux, seuils
+et interruption) avec une latence et un taux d'erreurs I2C réglables.
+
+Lancé seul, le programme rejoue une trace de luminosité (fichier de mesures,
+historique de la base rrd ou journée synthétique) à travers Surveille avec
+une horloge virtuelle : une journée de lectures est rejouée en quelques
+secondes, sans stockage ni envoi des notifications. La sortie INT des
+capteurs déclarant une ligne gpio est émulée par un tube (SourceTube).
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import configparser
+import errno
+import logging
+import math
+import os
+import random
+import selectors
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import tsl2561
+from interruptions import SourceTube
+
+FICH_CONFIG = '/etc/garage.conf'
+JOUR = 86400
+# identifiants des boîtiers (registre ID : numéro de pièce, révision)
+IDENTIFIANTS = {"T": 0x50, "FN": 0x50, "CL": 0x50, "CS": 0x10}
+# durée d'une intégration (s) et valeur maximale des canaux, par valeur du
+# champ INTEG du registre TIMING
+INTEGRATIONS = {0x00: (0.0137, 5047), 0x01: (0.101, 37177),
+                0x02: (0.402, 65535)}
+# événements de la journée synthétique : (heure, durée en s, indice de l'état
+# de la porte dans l'ordre des seuils, -1 pour le plus lumineux)
+EVENEMENTS = ((7.5, 600, 1), (7.6, 240, -1), (12.25, 1800, 1),
+              (18.0, 900, 1), (18.1, 1200, -1), (22.5, 300, -1))
+
+
+class Args:
+    pass
+
+
+class Horloge:
+    """ horloge virtuelle : sleep avance l'heure au lieu d'attendre. Elle
+    remplace le module time dans capteurs et tsl2561 pendant un rejeu.
+    """
+
+    def __init__(self, debut=None):
+        self.origine = time.time() if debut is None else debut
+        self.instant = 0.0
+
+    def monotonic(self):
+        return self.instant
+
+    def time(self):
+        return self.origine + self.instant
+
+    perf_counter = monotonic
+
+    def sleep(self, duree):
+        if duree > 0:
+            self.instant += duree
+
+
+class TSL2561Emule:
+    """ registres d'un TSL2561 éclairé par lumiere(date). Les canaux donnent
+    le résultat de la dernière intégration terminée, calculé pour que
+    TSL2561.read rende la luminosité de la trace.
+    """
+
+    def __init__(self, lumiere, horloge=time, boitier="T", rapport_ir=0.3):
+        """
+        param: lumiere: fonction date (heure système) -> luminosité
+        param: horloge: module time ou Horloge
+        param: boitier: T, FN, CL ou CS
+        param: rapport_ir: rapport entre les canaux infrarouge et large bande
+        """
+        self.lumiere = lumiere
+        self.horloge = horloge
+        self.classe = tsl2561.TSL2561CS if boitier == "CS" \
+            else tsl2561.TSL2561
+        self.rapport_ir = rapport_ir
+        self.registres = bytearray(16)
+        self.registres[tsl2561._REGISTER_TIMING] = 0x02
+        self.registres[tsl2561._REGISTER_ID] = IDENTIFIANTS[boitier]
+        # date monotone du début de la première intégration
+        self.depart = None
+        # source d'interruption reliée à la sortie INT, sortie INT active,
+        # dernière intégration comparée aux seuils et nombre d'intégrations
+        # consécutives hors seuils
+        self.source = None
+        self.signale = False
+        self.examine = 0
+        self.hors = 0
+
+    def allume(self):
+        return self.registres[tsl2561._REGISTER_CONTROL] & 0x03 == 0x03
+
+    def ecrit(self, registre, valeur):
+        if registre in (tsl2561._REGISTER_CONTROL, tsl2561._REGISTER_TIMING):
+            # les intégrations repartent de zéro
+            self.registres[registre] = valeur
+            self.depart = self.horloge.monotonic() if self.allume() else None
+            self.examine = self.hors = 0
+        elif registre not in (tsl2561._REGISTER_ID,
+                              tsl2561._REGISTER_CHANNEL0,
+                              tsl2561._REGISTER_CHANNEL0 + 1,
+                              tsl2561._REGISTER_CHANNEL1,
+                              tsl2561._REGISTER_CHANNEL1 + 1):
+            self.registres[registre] = valeur & 0xff
+            if tsl2561._REGISTER_THRESHHOLD_MIN <= registre <= \
+                    tsl2561._REGISTER_INTERRUPT:
+                # nouveaux seuils : seules les intégrations suivantes comptent
+                self.examine = self._cycle()
+                self.hors = 0
+
+    def lit(self, registre):
+        if registre in (tsl2561._REGISTER_CHANNEL0,
+                        tsl2561._REGISTER_CHANNEL0 + 1,
+                        tsl2561._REGISTER_CHANNEL1,
+                        tsl2561._REGISTER_CHANNEL1 + 1):
+            self.convertit()
+        return self.registres[registre]
+
+    def _mot(self, registre):
+        return self.registres[registre] | self.registres[registre + 1] << 8
+
+    def convertit(self):
+        """ met dans les registres des canaux le résultat de la dernière
+        intégration terminée
+        """
+        duree = self._duree()
+        cycles = self._cycle()
+        if cycles < 1:
+            return
+        fin = self.horloge.time() - (self.horloge.monotonic() - self.depart -
+                                     cycles * duree)
+        large, infrarouge = self.canaux(self.lumiere(fin))
+        for registre, valeur in ((tsl2561._REGISTER_CHANNEL0, large),
+                                 (tsl2561._REGISTER_CHANNEL1, infrarouge)):
+            self.registres[registre] = valeur & 0xff
+            self.registres[registre + 1] = valeur >> 8
+
+    def canaux(self, lux):
+        """ valeurs brutes des deux canaux pour une luminosité lux, avec le
+        gain et le temps d'intégration courants
+        """
+        timing = self.registres[tsl2561._REGISTER_TIMING]
+        gain = 16 if timing & 0x10 else 1
+        temps = {0x00: 13, 0x01: 101, 0x02: 402}[timing & 0x03]
+        _, maximum = INTEGRATIONS[timing & 0x03]
+        ratio = (self.rapport_ir * 1024 + 1) / 2
+        k, b, m = self.classe._lux_table()
+        indice = bisect.bisect_left(k, ratio)
+        coefficient = b[indice] - self.rapport_ir * m[indice]
+        if coefficient <= 0 or lux <= 0.5:
+            return 0, 0
+        large = round((lux * 16384 - 8192) * 1024 /
+                      (tsl2561._scale(temps, gain) * coefficient))
+        return (min(maximum, large),
+                min(maximum, round(large * self.rapport_ir)))
+
+    def _duree(self):
+        """ durée d'une intégration, None si le capteur n'intègre pas """
+        timing = self.registres[tsl2561._REGISTER_TIMING]
+        if self.depart is None or timing & 0x03 not in INTEGRATIONS:
+            return None
+        return INTEGRATIONS[timing & 0x03][0]
+
+    def _cycle(self):
+        """ nombre d'intégrations terminées depuis l'allumage ; une
+        intégration qui se termine maintenant est comptée
+        """
+        duree = self._duree()
+        if duree is None:
+            return 0
+        return math.floor((self.horloge.monotonic() - self.depart) / duree
+                          + 1e-9)
+
+    def _cycles(self, fin):
+        """ (indice, date monotone de fin, hors seuils) des intégrations pas
+        encore comparées aux seuils et terminées au plus tard à fin
+        """
+        interruption = self.registres[tsl2561._REGISTER_INTERRUPT]
+        duree = self._duree()
+        if self.source is None or self.signale or duree is None or \
+                not interruption & 0x30:
+            return
+        maintenant = self.horloge.monotonic()
+        indice = self.examine + 1
+        while self.depart + indice * duree <= fin:
+            date = self.depart + indice * duree
+            large, _ = self.canaux(self.lumiere(
+                self.horloge.time() + date - maintenant))
+            # persistance nulle : interruption à chaque intégration
+            hors = not interruption & 0x0f or not (
+                self._mot(tsl2561._REGISTER_THRESHHOLD_MIN) <= large <=
+                self._mot(tsl2561._REGISTER_THRESHHOLD_MAX))
+            yield indice, date, hors
+            indice += 1
+
+    def prochaine_interruption(self, fin):
+        """ date monotone à laquelle la sortie INT s'activera, si c'est au
+        plus tard à fin, sinon None
+        """
+        persistance = max(1, self.registres[tsl2561._REGISTER_INTERRUPT]
+                          & 0x0f)
+        hors = self.hors
+        for _, date, dehors in self._cycles(fin):
+            hors = hors + 1 if dehors else 0
+            if hors >= persistance:
+                return date
+        return None
+
+    def avance(self, date):
+        """ compare aux seuils les intégrations terminées jusqu'à date et
+        active la sortie INT (déclenche la source) si la persistance est
+        atteinte ; elle reste active jusqu'à son effacement
+        """
+        persistance = max(1, self.registres[tsl2561._REGISTER_INTERRUPT]
+                          & 0x0f)
+        for indice, _, dehors in self._cycles(date):
+            self.examine = indice
+            self.hors = self.hors + 1 if dehors else 0
+            if self.hors >= persistance:
+                self.signale = True
+                self.source.declenche()
+                return
+
+    def efface(self):
+        """ commande d'effacement de l'interruption """
+        self.signale = False
+        self.hors = 0
+
+
+class BusEmule:
+    """ bus SMBus (interface de smbus2.SMBus) relié à des TSL2561Emule """
+
+    def __init__(self, capteurs=None, latence=0.0, erreurs=0.0, graine=None,
+                 horloge=time):
+        """
+        param: capteurs: adresse -> TSL2561Emule
+        param: latence: durée de chaque transaction (s)
+        param: erreurs: probabilité qu'une transaction échoue
+        param: graine: graine du tirage des erreurs
+        """
+        self.capteurs = capteurs or {}
+        self.latence = latence
+        self.erreurs = erreurs
+        self.horloge = horloge
+        self.aleatoire = random.Random(graine)
+        self.transactions = 0
+        self.echecs = 0
+
+    def _capteur(self, adresse):
+        self.transactions += 1
+        self.horloge.sleep(self.latence)
+        if adresse not in self.capteurs or \
+                self.aleatoire.random() < self.erreurs:
+            self.echecs += 1
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        return self.capteurs[adresse]
+
+    def read_byte_data(self, adresse, commande):
+        return self._capteur(adresse).lit(commande & 0x0f)
+
+    def write_byte_data(self, adresse, commande, valeur):
+        self._capteur(adresse).ecrit(commande & 0x0f, valeur)
+
+    def read_word_data(self, adresse, commande):
+        capteur = self._capteur(adresse)
+        registre = commande & 0x0f
+        return capteur.lit(registre) | capteur.lit(registre + 1) << 8
+
+    def write_word_data(self, adresse, commande, valeur):
+        capteur = self._capteur(adresse)
+        capteur.ecrit(commande & 0x0f, valeur & 0xff)
+        capteur.ecrit((commande & 0x0f) + 1, valeur >> 8)
+
+    def read_i2c_block_data(self, adresse, commande, longueur):
+        capteur = self._capteur(adresse)
+        return [capteur.lit((commande & 0x0f) + i) for i in range(longueur)]
+
+    def write_byte(self, adresse, valeur):
+        # commande seule : effacement de l'interruption
+        capteur = self._capteur(adresse)
+        if valeur & tsl2561._CLEAR_BIT:
+            capteur.efface()
+
+    def close(self):
+        pass
+
+
+class SelecteurVirtuel(selectors.DefaultSelector):
+    """ sélecteur qui, faute d'événement prêt, avance l'horloge virtuelle
+    jusqu'à la prochaine échéance de la boucle, ou jusqu'à l'interruption
+    d'un capteur émulé si elle arrive avant, au lieu d'attendre
+    """
+
+    def __init__(self, horloge, capteurs=()):
+        """
+        param: capteurs: TSL2561Emule dont la sortie INT est émulée
+        """
+        super().__init__()
+        self.horloge = horloge
+        self.capteurs = capteurs
+
+    def select(self, timeout=None):
+        if timeout is None:
+            return super().select(timeout)
+        evenements = super().select(0)
+        if evenements:
+            return evenements
+        maintenant = self.horloge.monotonic()
+        date = maintenant + timeout
+        for capteur in self.capteurs:
+            interruption = capteur.prochaine_interruption(date)
+            if interruption is not None:
+                date = max(maintenant, interruption)
+        self.horloge.sleep(date - maintenant)
+        for capteur in self.capteurs:
+            capteur.avance(date)
+        # les tubes des interruptions déclenchées sont lisibles
+        return super().select(0)
+
+
+class ExecuteurImmediat(concurrent.futures.Executor):
+    """ exécute les accès I2C dans la boucle d'événements : sans thread, le
+    temps virtuel n'avance pas pendant un accès au bus
+    """
+
+    def submit(self, fonction, *args, **kwargs):
+        futur = concurrent.futures.Future()
+        try:
+            futur.set_result(fonction(*args, **kwargs))
+        except Exception as e:
+            futur.set_exception(e)
+        return futur
+
+
+def boucle_virtuelle(horloge, capteurs=()):
+    boucle = asyncio.SelectorEventLoop(SelecteurVirtuel(horloge, capteurs))
+    boucle.time = horloge.monotonic
+    return boucle
+
+
+class NotificationSystemd:
+    """ socket de notification de systemd émulée : reçoit les messages de
+    daemon3x.sd_notify (READY=1, WATCHDOG=1, STATUS=...) du processus
+    courant ou d'un processus lancé avec environnement() :
+
+      with NotificationSystemd(chien_de_garde=2) as systemd:
+          subprocess.Popen([...], env=dict(os.environ,
+                                           **systemd.environnement()))
+          systemd.attend("READY")
+    """
+
+    def __init__(self, chien_de_garde=None):
+        """
+        param: chien_de_garde: WatchdogSec du service émulé (s), None pour
+            désactiver le chien de garde
+        """
+        self.chien_de_garde = chien_de_garde
+        self.repertoire = tempfile.mkdtemp(prefix="garage-systemd-")
+        self.adresse = os.path.join(self.repertoire, "notify")
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.adresse)
+        # (date monotone, message clé -> valeur) reçus
+        self.messages = []
+
+    def environnement(self):
+        """ variables d'environnement d'un service lancé par systemd """
+        variables = {"NOTIFY_SOCKET": self.adresse}
+        if self.chien_de_garde:
+            variables["WATCHDOG_USEC"] = str(int(self.chien_de_garde * 1e6))
+        return variables
+
+    def recoit(self, delai=0.0):
+        """ messages reçus pendant au plus delai secondes, sans attendre
+        s'il y en a déjà
+        """
+        recus = []
+        self.socket.settimeout(max(0.0, delai))
+        while True:
+            try:
+                donnees = self.socket.recv(4096)
+            except (socket.timeout, BlockingIOError):
+                return recus
+            message = dict(ligne.split("=", 1) for ligne
+                           in donnees.decode("utf-8").splitlines()
+                           if "=" in ligne)
+            self.messages.append((time.monotonic(), message))
+            recus.append(message)
+            # puis les messages déjà arrivés
+            self.socket.setblocking(False)
+
+    def attend(self, cle, valeur="1", delai=10.0):
+        """ attend au plus delai secondes un message cle=valeur ; renvoie
+        True s'il est arrivé
+        """
+        fin = time.monotonic() + delai
+        while time.monotonic() < fin:
+            for message in self.recoit(fin - time.monotonic()):
+                if message.get(cle) == valeur:
+                    return True
+        return False
+
+    def close(self):
+        self.socket.close()
+        shutil.rmtree(self.repertoire, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def interpole(points):
+    """ fonction date -> luminosité, interpolée entre les (date, lux) de
+    points (triés par date, sans valeur manquante)
+    """
+    dates = [date for date, _ in points]
+    valeurs = [valeur for _, valeur in points]
+
+    def lumiere(date):
+        i = bisect.bisect_right(dates, date)
+        if i == 0:
+            return valeurs[0]
+        if i == len(dates):
+            return valeurs[-1]
+        part = (date - dates[i - 1]) / (dates[i] - dates[i - 1])
+        return valeurs[i - 1] + part * (valeurs[i] - valeurs[i - 1])
+    return lumiere
+
+
+def niveaux(etats):
+    """ luminosité typique de chaque état, du plus sombre au plus clair :
+    milieu de l'intervalle entre deux seuils
+    """
+    from filtres import Classifieur
+    seuils = Classifieur(etats).seuils
+    return [(bas + haut) / 2 for bas, haut in zip(seuils, seuils[1:])] + \
+        [max(1.0, 2 * seuils[-1])]
+
+
+def journee_synthetique(etats, debut, pas=60, bruit=0.02, graine=None):
+    """ trace d'une journée : porte fermée, ouverte ou éclairée selon
+    EVENEMENTS, avec un bruit relatif gaussien
+    """
+    aleatoire = random.Random(graine)
+    lux = niveaux(etats)
+    points = []
+    for date in range(int(debut), int(debut) + JOUR + pas, pas):
+        heure = (date - debut) / 3600
+        etat = 0
+        for depart, duree, indice in EVENEMENTS:
+            if depart <= heure < depart + duree / 3600:
+                # l'état le plus lumineux l'emporte
+                etat = max(etat, indice % len(lux))
+        points.append((date, lux[etat] * (1 + aleatoire.gauss(0, bruit))))
+    return points
+
+
+def lit_fichier(fichier, debut, pas=60):
+    """ trace d'un fichier de mesures : « date luminosité » par ligne, ou
+    une luminosité par ligne espacée de pas secondes
+    """
+    points = []
+    for ligne in fichier:
+        champs = ligne.replace(",", " ").replace(";", " ").split()
+        if not champs or champs[0].startswith("#"):
+            continue
+        try:
+            valeurs = [float(champ) for champ in champs[-2:]]
+        except ValueError:
+            # ligne d'entête
+            continue
+        if len(valeurs) == 2:
+            points.append((valeurs[0], valeurs[1]))
+        else:
+            points.append((debut + len(points) * pas, valeurs[0]))
+    return [(date, lux) for date, lux in points if not math.isnan(lux)]
+
+
+def adresses(config):
+    """ (bus, adresse, boîtier, ligne) des capteurs déclarés dans la
+    configuration, comme garage.lit_capteurs ; ligne est (puce, numéro) de
+    la ligne gpio reliée à la sortie INT, ou None
+    """
+    sections = [section for section in config.sections()
+                if section.startswith("Capteur:")] or ["Capteur"]
+    return [(config.getint(section, "bus", fallback=1),
+             int(config.get(section, "adresse", fallback="0x39"), 0),
+             config.get(section, "boitier", fallback="T").upper(),
+             (config.get(section, "gpiochip", fallback="/dev/gpiochip0"),
+              config.getint(section, "gpio"))
+             if config.has_option(section, "gpio") else None)
+            for section in sections]
+
+
+def rejoue(config, points, latence=0.0, erreurs=0.0, graine=None,
+           base=None, tampon=None, publication=None):
+    """ fait lire la trace points par les capteurs émulés de la
+    configuration, avec les fonctions de garage.py, et renvoie le bilan
+    param: base: base de données où stocker les mesures de tous les
+        capteurs (base rrd, ou base en pur Python si le module rrdtool est
+        absent), None pour ne rien stocker
+    param: tampon: TamponRRD utilisé pour écrire dans la base rrd
+    param: publication: partage.Publication où publier les mesures
+    """
+    import capteurs
+    import garage
+    horloge = Horloge(points[0][0])
+    lumiere = interpole(points)
+    bus = {}
+    # (puce, ligne) -> capteur émulé dont la sortie INT y est reliée
+    lignes = {}
+    for numero, adresse, boitier, ligne in adresses(config):
+        bus.setdefault(numero, BusEmule(latence=latence, erreurs=erreurs,
+                                        graine=graine, horloge=horloge))
+        emule = bus[numero].capteurs[adresse] = TSL2561Emule(
+            lumiere, horloge, boitier)
+        if ligne is not None:
+            lignes[ligne] = emule
+
+    def source(ligne, puce):
+        lignes[puce, ligne].source = SourceTube()
+        return lignes[puce, ligne].source
+    alertes = []
+    lectures = []
+    garage.config = config
+    garage.logger = logging.getLogger('Garage')
+    garage.SMBus = bus.__getitem__
+    capteurs.time = tsl2561.time = horloge
+    try:
+        delai, attente = garage.lit_config(config)
+        surveille = garage.Surveille(None)
+        surveille.publication = publication
+        surveille.tampon = tampon
+        surveille.series = {}
+        surveille.capteurs = garage.lit_capteurs(
+            delai, lambda msg: alertes.append((horloge.time(), msg)),
+            attente, source)
+        for capteur in surveille.capteurs:
+            # les dates virtuelles ne vont pas dans les vraies bases
+            capteur.rrd = base
+
+        def enregistre(capteur, lux):
+            lectures.append((capteur.horodatage, capteur.nom, lux))
+            surveille.enregistre(capteur, lux)
+        ordonnanceur = capteurs.Ordonnanceur(surveille.capteurs, enregistre)
+        ordonnanceur.executeur = ExecuteurImmediat()
+        boucle = boucle_virtuelle(horloge, list(lignes.values()))
+        chrono = time.perf_counter()
+        try:
+            ordonnanceur.run(points[-1][0] - points[0][0], boucle)
+            if tampon is not None:
+                tampon.vide()
+        finally:
+            boucle.close()
+            for serie in surveille.series.values():
+                if serie is not None:
+                    serie.close()
+            for emule in lignes.values():
+                if emule.source is not None:
+                    emule.source.close()
+        duree = time.perf_counter() - chrono
+    finally:
+        capteurs.time = tsl2561.time = time
+    return {"duree_virtuelle": horloge.instant,
+            "duree": duree,
+            "lectures": lectures,
+            "alertes": alertes,
+            "cadences": {capteur.nom: capteur.cadence.bilan()
+                         for capteur in surveille.capteurs},
+            "transactions": sum(b.transactions for b in bus.values()),
+            "echecs": sum(b.echecs for b in bus.values())}
+
+
+def verifie_reveil(etats, delai=300, persistance=1):
+    """ rejoue une porte qui s'ouvre au milieu d'une période de lecture,
+    avec un capteur relié à une interruption, et renvoie (date de
+    l'ouverture, date de la première lecture de la porte ouverte, date de
+    la lecture périodique suivante) : la lecture doit suivre l'ouverture de
+    quelques intégrations, bien avant l'échéance périodique
+    param: etats: section Etats de la configuration
+    """
+    config = configparser.ConfigParser()
+    config["Etats"] = etats
+    config["Temps"] = {"delay": str(delai), "compteur": "1"}
+    config["Capteur"] = {"integration": "402", "gain": "16", "gpio": "0",
+                         "persistance": str(persistance)}
+    lux = niveaux(etats)
+    debut = math.floor(time.time() / JOUR) * JOUR
+    ouverture = debut + 2.5 * delai
+    points = [(debut, lux[0]), (ouverture, lux[0]), (ouverture + 1, lux[-1]),
+              (debut + 4 * delai, lux[-1])]
+    lectures = [date for date, _, valeur in rejoue(config, points)["lectures"]
+                if valeur >= lux[-1] / 2]
+    reveil = lectures[0] if lectures else math.inf
+    return ouverture, reveil, debut + 3 * delai
+
+
+def verifie_cache_graphes():
+    """ demande trois fois le graphique du jour au serveur, tracé depuis la
+    base en pur Python : une deuxième fois une seconde et demie plus tard
+    sans nouvelle mesure, puis après une mesure. Renvoie le nombre
+    d'images tracées après chaque requête : (1, 1, 2) attendu.
+    """
+    import threading
+    import urllib.request
+    import graphes
+    import serie
+    import serveur
+    horloge = Horloge()
+    repertoire = tempfile.mkdtemp(prefix="garage-graphes-")
+    fichier = os.path.join(repertoire, "garage.serie")
+    base = serie.SerieTemporelle.cree(fichier, niveaux=serie.niveaux(30))
+    mesure = [0.0] * len(base.champs)
+    base.ajoute(horloge.time() - 30, *mesure)
+    graphes.time = horloge
+    serveur.graphes = graphes.GraphesSerie(fichier)
+    httpd = serveur.ServeurConcurrent(("127.0.0.1", 0), serveur.mon_serveur,
+                                      journal=False)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    traces = []
+    try:
+        for attente, nouvelle in ((0, False), (1.5, False), (1, True)):
+            horloge.sleep(attente)
+            if nouvelle:
+                base.ajoute(horloge.time(), *mesure)
+            with urllib.request.urlopen("http://{}:{}/garage_jour.{}".format(
+                    *httpd.server_address, serveur.graphes.extension)) as r:
+                r.read()
+            traces.append(serveur.graphes.traces)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        graphes.time = time
+        serveur.graphes = None
+        base.close()
+        shutil.rmtree(repertoire, ignore_errors=True)
+    return tuple(traces)
+
+
+def verifie_arret_notifications(delai=1.0):
+    """ arrête un Distributeur dont le canal échoue toujours pendant
+    l'attente entre deux essais (60 s). Renvoie (durée de l'arrêt, nombre
+    d'essais, messages restés dans le spool) : l'arrêt doit rendre la main
+    avant delai secondes, après un dernier essai, le message restant dans le
+    spool.
+    """
+    import notification
+    essais = []
+
+    def echoue(message):
+        essais.append(time.monotonic())
+        return False
+    repertoire = tempfile.mkdtemp(prefix="garage-spool-")
+    try:
+        distributeur = notification.Distributeur(
+            {"test": echoue}, repertoire, essais=5, delai=60, delai_max=300)
+        distributeur.envoie("porte ouverte")
+        # le premier envoi a échoué, le thread attend le suivant
+        fin = time.monotonic() + delai
+        while not essais and time.monotonic() < fin:
+            time.sleep(0.01)
+        debut = time.monotonic()
+        distributeur.arrete(delai)
+        duree = time.monotonic() - debut
+        restes = len([nom for nom in os.listdir(repertoire)
+                      if nom.endswith(".json")])
+    finally:
+        shutil.rmtree(repertoire, ignore_errors=True)
+    return duree, len(essais), restes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rejouer une trace de "
+                                                 "luminosité avec des "
+                                                 "capteurs émulés.")
+    parser.add_argument("-c", "--config", default=FICH_CONFIG,
+                        help="emplacement du fichier de configuration")
+    parser.add_argument("-r", "--historique", metavar="DEBUT",
+                        help="rejouer l'historique de la base rrd depuis "
+                             "DEBUT (format rrdtool)")
+    parser.add_argument("-l", "--latence", type=float, default=0.0,
+                        help="durée d'une transaction I2C en ms")
+    parser.add_argument("-e", "--erreurs", type=float, default=0.0,
+                        help="probabilité d'échec d'une transaction I2C")
+    parser.add_argument("-g", "--graine", type=int, default=None,
+                        help="graine des tirages aléatoires")
+    parser.add_argument("-v", "--verbeux", action="store_true",
+                        help="afficher les traces du programme")
+    parser.add_argument("-i", "--interruption", action="store_true",
+                        help="vérifier qu'un franchissement de seuil "
+                             "réveille la lecture avant l'échéance "
+                             "périodique")
+    parser.add_argument("--graphes", action="store_true",
+                        help="vérifier qu'un graphique n'est retracé qu'à "
+                             "l'arrivée d'une nouvelle mesure")
+    parser.add_argument("--notifications", action="store_true",
+                        help="vérifier que l'arrêt interrompt l'attente "
+                             "entre deux essais d'envoi")
+    parser.add_argument("trace", nargs="?", type=argparse.FileType('r'),
+                        help="fichier de mesures ; à défaut, journée "
+                             "synthétique construite sur les seuils de "
+                             "la section Etats")
+    args = Args()
+    parser.parse_args(namespace=args)
+    logging.basicConfig(level=logging.DEBUG if args.verbeux
+                        else logging.WARNING)
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='utf-8')
+    if "Etats" not in config:
+        print("Section Etats absente de {}".format(args.config),
+              file=sys.stderr)
+        sys.exit(1)
+    if args.interruption:
+        ouverture, reveil, periodique = verifie_reveil(config["Etats"])
+        print("Ouverture à {:.1f} s, lecture à {:.1f} s, échéance "
+              "périodique à {:.1f} s".format(0.0, reveil - ouverture,
+                                               periodique - ouverture))
+        if reveil >= periodique:
+            print("L'interruption n'a pas réveillé la lecture",
+                  file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+    if args.graphes:
+        traces = verifie_cache_graphes()
+        print("Images tracées après chaque requête : {}".format(
+            ", ".join(map(str, traces))))
+        if traces != (1, 1, 2):
+            print("Le graphique est retracé sans nouvelle mesure (1, 1, 2 "
+                  "attendu)", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+    if args.notifications:
+        duree, essais, restes = verifie_arret_notifications()
+        print("Arrêt en {:.3f} s après {} essais, {} message(s) dans le "
+              "spool".format(duree, essais, restes))
+        if duree >= 1.0 or essais != 2 or restes != 1:
+            print("L'arrêt n'a pas interrompu l'attente (moins de 1 s, "
+                  "2 essais et 1 message attendus)", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+    debut = math.floor(time.time() / JOUR) * JOUR - JOUR
+    if args.trace is not None:
+        points = lit_fichier(args.trace, debut)
+    elif args.historique:
+        from historique import historique
+        try:
+            points = [(date, lux) for date, lux in historique(
+                config["rrd"]["base"]).points(args.historique, "now")
+                      if lux is not None]
+        except (KeyError, OSError, ValueError) as e:
+            print("Historique illisible : {}".format(e), file=sys.stderr)
+            sys.exit(1)
+    else:
+        points = journee_synthetique(config["Etats"], debut,
+                                     graine=args.graine)
+    if len(points) < 2:
+        print("Trace trop courte", file=sys.stderr)
+        sys.exit(1)
+    bilan = rejoue(config, points, args.latence / 1000, args.erreurs,
+                   args.graine)
+    print("{} lectures sur {:.0f} s virtuelles rejouées en {:.2f} s "
+          "(x{:.0f})".format(len(bilan["lectures"]),
+                             bilan["duree_virtuelle"], bilan["duree"],
+                             bilan["duree_virtuelle"] /
+                             max(bilan["duree"], 1e-9)))
+    print("Transactions I2C : {} dont {} en échec".format(
+        bilan["transactions"], bilan["echecs"]))
+    for nom, cadence in bilan["cadences"].items():
+        print("{} : {}".format(nom, cadence))
+    print("{} notifications :".format(len(bilan["alertes"])))
+    for date, message in bilan["alertes"]:
+        print("  {} {}".format(time.strftime("%H:%M:%S",
+                                             time.localtime(date)), message))
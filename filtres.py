@@ -0,0 +1,308 @@
+#!/home/pi/.Envs/garage/bin/python
+# -*- coding: utf-8 -*-
+"""
+Filtrage des mesures avant la décision de l'état d'une porte : lissage
+(moyenne exponentielle ou médiane glissante), hystérésis autour de chaque
+seuil et confirmation d'un nouvel état par N lectures sur les M dernières.
+Chaque étape traite une mesure en temps constant.
+
+Lancé seul, le programme rejoue un enregistrement de mesures et compare le
+nombre de changements d'état avec et sans filtrage.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import argparse
+import bisect
+import collections
+import configparser
+import math
+import sys
+
+FICH_CONFIG = '/etc/garage.conf'
+
+
+class Args:
+    pass
+
+
+class MoyenneExponentielle:
+    """ moyenne exponentielle : chaque mesure compte pour alpha """
+
+    def __init__(self, alpha=0.3):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha hors de ]0, 1] : {}".format(alpha))
+        self.alpha = alpha
+        self.valeur = None
+
+    def ajoute(self, valeur):
+        if self.valeur is None:
+            self.valeur = valeur
+        else:
+            self.valeur += self.alpha * (valeur - self.valeur)
+        return self.valeur
+
+
+class Mediane:
+    """ médiane des taille dernières mesures """
+
+    def __init__(self, taille=5):
+        if taille < 1:
+            raise ValueError("fenêtre de médiane vide")
+        self.fenetre = collections.deque(maxlen=taille)
+        self.triees = []
+
+    def ajoute(self, valeur):
+        if len(self.fenetre) == self.fenetre.maxlen:
+            del self.triees[bisect.bisect_left(self.triees,
+                                               self.fenetre[0])]
+        self.fenetre.append(valeur)
+        bisect.insort(self.triees, valeur)
+        milieu = len(self.triees) // 2
+        if len(self.triees) % 2:
+            return self.triees[milieu]
+        return (self.triees[milieu - 1] + self.triees[milieu]) / 2
+
+
+class Classifieur:
+    """ état correspondant à une luminosité. Les seuils sont lus une fois
+    et triés ; sous le plus bas, la porte est dans l'état le plus sombre.
+    """
+
+    def __init__(self, etats):
+        """
+        param: etats: état -> seuil de luminosité
+        """
+        paires = sorted((float(seuil), etat) for etat, seuil in etats.items())
+        if not paires:
+            raise ValueError("aucun état défini")
+        self.seuils = [seuil for seuil, _ in paires]
+        self.etats = [etat for _, etat in paires]
+
+    def indice(self, lux):
+        return max(0, bisect.bisect_right(self.seuils, lux) - 1)
+
+    def classe(self, lux):
+        return self.etats[self.indice(lux)]
+
+    def bornes(self, lux):
+        """ seuils qui encadrent lux (None s'il n'y en a pas) """
+        i = bisect.bisect_right(self.seuils, lux)
+        return (self.seuils[i - 1] if i else None,
+                self.seuils[i] if i < len(self.seuils) else None)
+
+
+class Decision:
+    """ état d'une porte à partir des mesures successives de luminosité """
+
+    def __init__(self, etats, lissage=None, hysteresis=0.0, confirmation=1,
+                 fenetre=None):
+        """
+        param: etats: état -> seuil de luminosité
+        param: lissage: filtre appliqué aux mesures (MoyenneExponentielle,
+            Mediane) ou None
+        param: hysteresis: fraction du seuil à dépasser pour changer
+            d'état : au-dessus de seuil * (1 + hysteresis) pour monter,
+            sous seuil * (1 - hysteresis) pour descendre
+        param: confirmation: nombre de lectures, parmi les fenetre
+            dernières, qui doivent donner un même nouvel état pour qu'il
+            soit retenu
+        param: fenetre: nombre de lectures considérées (confirmation par
+            défaut : lectures consécutives)
+        """
+        fenetre = fenetre or confirmation
+        if not 1 <= confirmation <= fenetre:
+            raise ValueError("confirmation {} sur {} lectures "
+                             "impossible".format(confirmation, fenetre))
+        if not 0 <= hysteresis < 1:
+            raise ValueError("hystérésis hors de [0, 1[ : {}".format(
+                hysteresis))
+        self.classifieur = Classifieur(etats)
+        # seuils à dépasser pour monter ou pour descendre d'un état
+        self.hauts = [seuil * (1 + hysteresis)
+                      for seuil in self.classifieur.seuils]
+        self.bas = [seuil * (1 - hysteresis)
+                    for seuil in self.classifieur.seuils]
+        self.lissage = lissage
+        self.hysteresis = hysteresis
+        self.confirmation = confirmation
+        self.dernieres = collections.deque(maxlen=fenetre)
+        self.compte = collections.Counter()
+        self.etat = None
+
+    def classe(self, lux):
+        """ indice de l'état correspondant à lux, compte tenu de
+        l'hystérésis autour de l'état courant
+        """
+        brut = self.classifieur.indice(lux)
+        if self.etat is None or brut == self.etat:
+            return brut
+        if brut > self.etat:
+            return max(self.etat, bisect.bisect_right(self.hauts, lux) - 1)
+        return min(self.etat, max(0, bisect.bisect_right(self.bas, lux) - 1))
+
+    def bornes(self):
+        """ luminosités sous laquelle et au-dessus de laquelle une mesure
+        propose de quitter l'état retenu, hystérésis comprise (None s'il n'y
+        en a pas, ou tant qu'aucun état n'est retenu)
+        """
+        if self.etat is None:
+            return None, None
+        return (self.bas[self.etat] if self.etat else None,
+                self.hauts[self.etat + 1]
+                if self.etat + 1 < len(self.hauts) else None)
+
+    def force(self, etat):
+        """ reprend l'état courant etat, par exemple après un changement de
+        seuils ; sans effet si etat n'est pas un état connu
+        """
+        if etat in self.classifieur.etats:
+            self.change(self.classifieur.etats.index(etat))
+
+    def change(self, etat):
+        """ retient l'état d'indice etat : le vote repart de zéro, les
+        lectures qui ont confirmé l'ancien état ou le nouveau ne comptent
+        plus pour le suivant
+        """
+        self.etat = etat
+        self.dernieres.clear()
+        self.compte.clear()
+
+    def mesure(self, lux):
+        """ prend en compte une mesure et renvoie l'état retenu """
+        if self.lissage is not None:
+            lux = self.lissage.ajoute(lux)
+        candidat = self.classe(lux)
+        if len(self.dernieres) == self.dernieres.maxlen:
+            self.compte[self.dernieres[0]] -= 1
+        self.dernieres.append(candidat)
+        self.compte[candidat] += 1
+        if self.etat is None or (candidat != self.etat and
+                                 self.compte[candidat] >= self.confirmation):
+            self.change(candidat)
+        return self.classifieur.etats[self.etat]
+
+
+def decision(etats, reglages, confirmation=1):
+    """ crée la décision décrite par une section de configuration
+    param: reglages: section [Filtre] ou dictionnaire vide
+    param: confirmation: valeur par défaut de la confirmation
+    """
+    nom = reglages.get("lissage", "aucun")
+    if nom == "moyenne":
+        lissage = MoyenneExponentielle(float(reglages.get("alpha", 0.3)))
+    elif nom == "mediane":
+        lissage = Mediane(int(reglages.get("mediane", 5)))
+    elif nom == "aucun":
+        lissage = None
+    else:
+        raise ValueError("lissage inconnu : {}".format(nom))
+    confirmation = int(reglages.get("confirmation", confirmation))
+    return Decision(etats, lissage,
+                    float(reglages.get("hysteresis", 0.0)), confirmation,
+                    int(reglages.get("fenetre", confirmation)))
+
+
+def etats_retenus(valeurs, decision):
+    """ états successivement retenus par la décision sur une suite de
+    mesures : le premier puis un par changement d'état ; les valeurs NaN
+    (mesures manquantes) sont ignorées
+    """
+    etats = []
+    for valeur in valeurs:
+        if valeur is None or math.isnan(valeur):
+            continue
+        etat = decision.mesure(valeur)
+        if not etats or etat != etats[-1]:
+            etats.append(etat)
+    return etats
+
+
+def transitions(valeurs, decision):
+    """ nombre de changements d'état de la décision sur une suite de
+    mesures
+    """
+    return max(0, len(etats_retenus(valeurs, decision)) - 1)
+
+
+def lit_trace(fichier):
+    """ mesures d'un fichier texte : une par ligne, éventuellement précédée
+    de sa date
+    """
+    valeurs = []
+    for ligne in fichier:
+        champs = ligne.replace(",", " ").replace(";", " ").split()
+        if not champs or champs[0].startswith("#"):
+            continue
+        try:
+            valeurs.append(float(champs[-1]))
+        except ValueError:
+            # ligne d'entête
+            continue
+    return valeurs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Comparer les changements "
+                                                 "d'état avec et sans "
+                                                 "filtrage des mesures.")
+    parser.add_argument("-c", "--config", default=FICH_CONFIG,
+                        help="emplacement du fichier de configuration")
+    parser.add_argument("-d", "--debut", default="end-7days",
+                        help="début de l'historique lu dans la base rrd "
+                             "(format rrdtool)")
+    parser.add_argument("-a", "--attendu", metavar="ETAT,ETAT...",
+                        help="états que le filtrage doit retenir "
+                             "successivement ; erreur sinon")
+    parser.add_argument("trace", nargs="?", type=argparse.FileType('r'),
+                        help="fichier de mesures (une par ligne) ; à "
+                             "défaut, historique de la base rrd")
+    args = Args()
+    parser.parse_args(namespace=args)
+    config = configparser.ConfigParser()
+    config.read(args.config, encoding='utf-8')
+    if "Etats" not in config:
+        print("Section Etats absente de {}".format(args.config),
+              file=sys.stderr)
+        sys.exit(1)
+    if args.trace is not None:
+        valeurs = lit_trace(args.trace)
+    else:
+        from historique import historique
+        try:
+            points = historique(config["rrd"]["base"]).points(args.debut,
+                                                              "now")
+        except (KeyError, OSError, ValueError) as e:
+            print("Historique illisible : {}".format(e), file=sys.stderr)
+            sys.exit(1)
+        valeurs = [valeur for _, valeur in points]
+    reglages = config["Filtre"] if "Filtre" in config else {}
+    try:
+        filtree = decision(config["Etats"], reglages,
+                           config.getint("Temps", "compteur", fallback=1))
+    except ValueError as e:
+        print("Erreur dans la section Filtre : {}".format(e),
+              file=sys.stderr)
+        sys.exit(1)
+    brutes = transitions(valeurs, Decision(config["Etats"]))
+    etats = etats_retenus(valeurs, filtree)
+    print("{} mesures".format(len(valeurs)))
+    print("Changements d'état sans filtrage : {}".format(brutes))
+    print("Changements d'état avec filtrage : {} ({})".format(
+        max(0, len(etats) - 1), ", ".join(etats)))
+    if args.attendu is not None and etats != args.attendu.split(","):
+        print("États attendus : {}".format(args.attendu.replace(",", ", ")),
+              file=sys.stderr)
+        sys.exit(1)
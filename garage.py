@@ -20,154 +20,617 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-from tsl2561 import TSL2561
+from tsl2561 import TSL2561, TSL2561CS, _INTEGRATION_TIME
+from capteurs import Cadence, Capteur, Ordonnanceur, Porte
+from filtres import decision
+from interruptions import SourceGPIO
+from notification import Distributeur, TransportSMS, TransportSMTP, \
+    URL_FREEMOBILE
 from smbus2 import SMBus
+import concurrent.futures
 import configparser
 import argparse
-import datetime
-import time
+import functools
 import logging
 import logging.handlers
-import freesms
-import requests
+import os
+import signal
 import sys
-from email.mime.text import MIMEText
-from subprocess import Popen, PIPE
-from daemon3x import daemon
-try:
-    import rrdtool
-    rrd_store = True
-except ImportError:
-    rrd_store = False
+from partage import Publication, FICHIER as FICHIER_PARTAGE
+from serie import fichier_serie, ouvre as ouvre_serie
+from daemon3x import daemon, sd_notify, watchdog_interval
+import metriques
+import profilage
+import time
 
 FICH_CONFIG = '/etc/garage.conf'
 ERR_I2C = 1
 ERR_TSL = 2
-FMT_DATE = "%H:%M:%S"
+ERR_CONFIG = 3
+PREFIXE_CAPTEUR = "Capteur:"
+SPOOL = '/var/spool/garage'
+# délai par défaut pour écrire les mesures et envoyer les notifications en
+# attente à l'arrêt (s)
+ARRET = 20
+# au-delà de 2 périodes plus BLOCAGE secondes sans lecture, un capteur est
+# considéré bloqué et le chien de garde de systemd n'est plus prévenu
+BLOCAGE = 30
+# intervalle de mise à jour de l'état affiché par systemctl status (s)
+STATUT = 60
+fichier_config = FICH_CONFIG
 
 
 def envoi_mail(message):
+    """ envoie un mail, renvoie True si l'envoi a réussi """
+    from email.mime.text import MIMEText
+    from subprocess import Popen, PIPE
     msg = MIMEText(message)
     msg["To"] = config["Mail"]["destinataires"]
     msg["Subject"] = "Porte garage"
+    if transport_mail is not None:
+        if "expediteur" in config["Mail"]:
+            msg["From"] = config["Mail"]["expediteur"]
+        return transport_mail.envoie(msg)
     p = Popen(["/usr/sbin/sendmail", "-t", "-oi"], stdin=PIPE, stderr=PIPE)
     rep, err = p.communicate(msg.as_bytes())
+    if err:
+        logger.error("Erreur lors de l'envoi du mail")
     return not err
 
 
-def previens(msg, f):
-    """ rendre compte que la luminosité a changé
-    param: msg: message à envoyer
-    param: f: descripteur pour envoi sms
+def envoi_sms(client, message):
+    """ envoie un SMS, renvoie True si l'envoi a réussi
+    param: client: transport pour envoi sms
     """
-    logger.info(msg)
+    import requests
     try:
-        reponse = f.send_sms(msg)
-        if reponse.success():
-            logger.info("SMS envoyé")
-        else:
-            logger.error("Erreur lors de l'envoi du SMS")
+        envoye = client.envoie(message)
     except requests.exceptions.ConnectionError as errc:
         logger.error("Error Connecting:{}".format(errc))
+        return False
     except requests.exceptions.Timeout as errt:
         logger.error("Timeout Error:{}".format(errt))
+        return False
     except requests.exceptions.RequestException as err:
         logger.error("OOps: {}".format(err))
-    if not envoi_mail(msg):
-        logger.error("Erreur lors de l'envoi du mail")
+        return False
+    if envoye:
+        logger.info("SMS envoyé")
+        return True
+    logger.error("Erreur lors de l'envoi du SMS")
+    return False
+
+
+def init_transport_mail():
+    """ renvoie la connexion SMTP à utiliser pour les mails, ou None pour
+    passer par la commande sendmail
+    """
+    if "Mail" not in config:
+        return None
+    try:
+        parametres = config["Mail"]
+        transport = parametres.get("transport", "sendmail")
+        if transport == "sendmail":
+            return None
+        if transport != "smtp":
+            raise ValueError("transport inconnu : {}".format(transport))
+        return TransportSMTP(parametres.get("serveur", "localhost"),
+                             parametres.getint("port", fallback=25),
+                             parametres.get("utilisateur"),
+                             parametres.get("mot_de_passe"),
+                             parametres.getboolean("starttls",
+                                                   fallback=False))
+    except (KeyError, ValueError) as e:
+        logger.error("Erreur dans la section Mail du fichier de "
+                     "configuration : %s. Utilisation de sendmail.", e)
+        return None
+
+
+def previens(msg):
+    """ rendre compte que la luminosité a changé. Le message est confié au
+    distributeur, qui l'envoie par SMS et par mail en arrière-plan.
+    param: msg: message à envoyer
+    """
+    logger.info(msg)
+    distributeur.envoie(msg)
+
+
+def init_notification():
+    """ démarre l'envoi des notifications en arrière-plan, par SMS et par
+    mail si leurs sections sont présentes dans le fichier de configuration
+    """
+    canaux = {}
+    if "FreeMobile" in config:
+        client = TransportSMS(config["FreeMobile"]["user"],
+                              config["FreeMobile"]["password"],
+                              config["FreeMobile"].get("url",
+                                                       URL_FREEMOBILE))
+        logger.debug("initialisation SMS pour %s",
+                     config["FreeMobile"]["user"])
+        canaux["sms"] = functools.partial(envoi_sms, client)
+    if "Mail" in config:
+        canaux["mail"] = envoi_mail
+    if not canaux:
+        logger.warning("Ni section FreeMobile ni section Mail dans le "
+                       "fichier de configuration : aucune notification ne "
+                       "sera envoyée")
+    parametres = config["Notification"] if "Notification" in config else {}
+    try:
+        spool = parametres.get("spool", SPOOL)
+        taille = int(parametres.get("file", 100))
+        essais = int(parametres.get("essais", 5))
+        delai = float(parametres.get("delai", 2))
+        delai_max = float(parametres.get("delai_max", 300))
+    except ValueError as e:
+        logger.fatal("Erreur dans la section Notification du fichier de "
+                     "configuration : %s", e)
+        sys.exit(ERR_CONFIG)
+    return Distributeur(canaux, spool or None, taille, essais, delai,
+                        delai_max)
 
 
-def init_capteur():
-    logger.debug("Initialisation du bus I2C")
+def ouvre_bus(numero, bus_ouverts):
+    """ renvoie le bus I2C numero, ouvert une seule fois par processus """
+    if numero not in bus_ouverts:
+        logger.debug("Initialisation du bus I2C %s", numero)
+        try:
+            bus_ouverts[numero] = SMBus(numero)
+        except FileNotFoundError as e:
+            logger.fatal("Erreur dans la recherche du bus I2C : %s", e)
+            sys.exit(ERR_I2C)
+    return bus_ouverts[numero]
+
+
+def init_capteur(bus, section="Capteur", adresse=0x39):
+    """ initialise un capteur avec les paramètres d'une section du fichier
+    de configuration
+    param: bus: bus I2C du capteur
+    param: section: nom de la section de configuration
+    param: adresse: adresse du capteur sur le bus
+    """
+    logger.debug("Initialisation du capteur TSL %s (0x%x)", section, adresse)
     try:
-        bus = SMBus(1)
-    except FileNotFoundError as e:
-        logger.fatal("Erreur dans la recherche du bus I2C : %s", e)
-        sys.exit(ERR_I2C)
-    logger.debug("Initialisation du capteur TSL")
+        bloc = config[section].getboolean("bloc", fallback=False)
+    except (KeyError, ValueError) as e:
+        bloc = False
+        logger.error("Erreur dans le fichier de configuration."
+                     "lecture du mode de lecture en bloc : %s", e)
     try:
-        tsl = TSL2561(bus)
+        # seul le boîtier CS a d'autres coefficients de calcul
+        boitier = config[section].get("boitier", "T").upper()
+        classe = TSL2561CS if boitier == "CS" else TSL2561
+        tsl = classe(bus, address=adresse, block=bloc)
     except IOError as e:
         logger.fatal("Erreur dans la recherche du capteur : %s", e)
         sys.exit(ERR_TSL)
     try:
-        gain = int(config["Capteur"]["gain"])
+        gain = int(config[section]["gain"])
         tsl.gain(gain)
     except (KeyError, ValueError) as e:
         logger.error("Erreur dans le fichier de configuration."
                      "lecture du gain du capteur : %s", e)
     logger.info("Gain du capteur : %s", tsl.gain())
     try:
-        integration = int(config["Capteur"]["integration"])
+        integration = int(config[section]["integration"])
         tsl.integration_time(integration)
     except (KeyError, ValueError) as e:
         logger.error("Erreur dans le fichier de configuration."
                      "lecture du temps d'intégration du capteur : %s", e)
     logger.info("Temps d'intégration du capteur : %s ms.",
                 tsl.integration_time())
-    return tsl
+    try:
+        continu = config[section].getboolean("continu", fallback=False)
+        cycle = config[section].getfloat("cycle", fallback=1.0)
+        if not 0 < cycle <= 1:
+            raise ValueError("cycle hors de ]0, 1] : {}".format(cycle))
+    except (KeyError, ValueError) as e:
+        continu, cycle = False, 1.0
+        logger.error("Erreur dans le fichier de configuration."
+                     "lecture du mode continu du capteur : %s", e)
+    tsl.continuous(continu)
+    logger.info("Acquisition continue : %s (rapport cyclique %s)",
+                continu, cycle)
+    try:
+        automatique = config[section].getboolean("automatique",
+                                                 fallback=False)
+    except ValueError as e:
+        automatique = False
+        logger.error("Erreur dans le fichier de configuration."
+                     "lecture du réglage automatique du capteur : %s", e)
+    if automatique:
+        logger.info("Gain et temps d'intégration automatiques")
+    return tsl, cycle, automatique
+
+
+def init_interruption(section, fabrique=SourceGPIO):
+    """ ouvre la ligne GPIO reliée à la sortie INT du capteur si la section
+    de configuration en déclare une, et renvoie (source, persistance)
+    param: fabrique: fonction (ligne, puce) -> source d'interruption
+    """
+    if not config.has_option(section, "gpio"):
+        return None, 1
+    try:
+        ligne = config[section].getint("gpio")
+        persistance = config[section].getint("persistance", fallback=1)
+        puce = config[section].get("gpiochip", "/dev/gpiochip0")
+        source = fabrique(ligne, puce)
+    except (KeyError, ValueError, OSError) as e:
+        logger.error("Erreur dans l'initialisation de l'interruption du "
+                     "capteur : %s. Lecture périodique.", e)
+        return None, 1
+    logger.info("Interruption du capteur sur %s ligne %s", puce, ligne)
+    return source, persistance
+
+
+def init_cadence(section, delai):
+    """ échéances des lectures : période delai, accélérées jusqu'à
+    l'intervalle rapide de la section si celui-ci est donné
+    """
+    try:
+        rapide = config[section].getfloat("rapide", fallback=0)
+        variation = config[section].getfloat("variation", fallback=0.1)
+        proximite = config[section].getfloat("proximite", fallback=0.1)
+        if not 0 <= rapide <= delai:
+            raise ValueError("rapide hors de [0, {}] : {}".format(delai,
+                                                                   rapide))
+    except (KeyError, ValueError) as e:
+        logger.error("Erreur dans le fichier de configuration."
+                     "lecture de la cadence adaptative : %s", e)
+        return Cadence(delai)
+    if rapide:
+        logger.info("Lectures accélérées jusqu'à %s s", rapide)
+    return Cadence(delai, rapide, variation, proximite)
+
+
+def decision_porte(conf, nom, etats, attente):
+    """ filtrage des mesures de la porte nom, décrit par la section
+    [Filtre:nom] ou à défaut [Filtre] ; un nouvel état doit être confirmé
+    par attente lectures si la section ne précise pas la confirmation
+    """
+    section = "Filtre:" + nom if "Filtre:" + nom in conf else "Filtre"
+    reglages = conf[section] if section in conf else {}
+    return decision(etats, reglages, attente)
+
+
+def init_decision(nom, etats, attente):
+    try:
+        return decision_porte(config, nom, etats, attente)
+    except ValueError as e:
+        section = "Filtre:" + nom if "Filtre:" + nom in config else "Filtre"
+        logger.fatal("Erreur dans la section %s du fichier de "
+                     "configuration : %s", section, e)
+        sys.exit(ERR_CONFIG)
+
+
+def cree_capteur(nom, section, etats, alerte, bus, numero=1, adresse=0x39,
+                 delai=30, rrd=None, attente=1, fabrique=SourceGPIO):
+    """ initialise un capteur et la porte qu'il surveille """
+    tsl, cycle, automatique = init_capteur(bus, section, adresse)
+    interruption, persistance = init_interruption(section, fabrique)
+    if interruption is not None:
+        # le capteur compare chaque conversion aux seuils : il reste allumé
+        tsl.continuous(True)
+        cycle = 1.0
+    porte = Porte(nom, etats, alerte, init_decision(nom, etats, attente))
+    return Capteur(nom, tsl, porte, numero, delai, cycle, rrd,
+                   interruption, persistance, init_cadence(section, delai),
+                   automatique)
+
+
+def lit_capteurs(delai, alerte, attente=1, fabrique=SourceGPIO):
+    """ crée les capteurs déclarés dans les sections [Capteur:nom] du
+    fichier de configuration, ou à défaut le capteur de la section [Capteur]
+    param: delai: période de lecture par défaut
+    param: alerte: fonction d'envoi des messages
+    param: attente: nombre de lectures confirmant un changement d'état
+    param: fabrique: fonction (ligne, puce) -> source d'interruption des
+        capteurs dont la section déclare une ligne gpio
+    """
+    bus_ouverts = {}
+    sections = [s for s in config.sections() if s.startswith(PREFIXE_CAPTEUR)]
+    if not sections:
+        rrd = config["rrd"].get("base") if "rrd" in config else None
+        return [cree_capteur("garage", "Capteur", config["Etats"], alerte,
+                             ouvre_bus(1, bus_ouverts), delai=delai,
+                             rrd=rrd, attente=attente, fabrique=fabrique)]
+    capteurs = []
+    for section in sections:
+        nom = section[len(PREFIXE_CAPTEUR):]
+        try:
+            numero = config[section].getint("bus", fallback=1)
+            adresse = int(config[section].get("adresse", "0x39"), 0)
+            periode = config[section].getint("delay", fallback=delai)
+        except ValueError as e:
+            logger.fatal("Erreur dans la section %s du fichier de "
+                         "configuration : %s", section, e)
+            sys.exit(ERR_CONFIG)
+        etats = config["Etats:" + nom] if "Etats:" + nom in config \
+            else config["Etats"]
+        capteurs.append(cree_capteur(nom, section, etats, alerte,
+                                     ouvre_bus(numero, bus_ouverts), numero,
+                                     adresse, periode,
+                                     config[section].get("rrd"), attente,
+                                     fabrique))
+    logger.info("%s capteurs surveillés", len(capteurs))
+    return capteurs
+
+
+def init_publication():
+    """ ouvre le fichier dans lequel sont publiées les mesures pour le
+    serveur web
+    """
+    try:
+        fichier = config["Partage"]["fichier"]
+    except KeyError:
+        fichier = FICHIER_PARTAGE
+    try:
+        return Publication(fichier)
+    except OSError as e:
+        logger.error("Erreur lors de l'ouverture de %s : %s. Les mesures "
+                     "ne seront pas publiées.", fichier, e)
+        return None
+
+
+def init_metriques():
+    """ prépare l'écriture périodique des métriques pour le serveur web """
+    if "Metriques" not in config:
+        return metriques.Exportation(metriques.registre)
+    try:
+        parametres = config["Metriques"]
+        if not parametres.getboolean("actif", fallback=True):
+            return None
+        return metriques.Exportation(metriques.registre,
+                                     parametres.get("fichier",
+                                                    metriques.FICHIER),
+                                     parametres.getfloat("periode",
+                                                         fallback=15))
+    except ValueError as e:
+        logger.error("Erreur dans la section Metriques du fichier de "
+                     "configuration : %s. Métriques non exportées.", e)
+        return None
+
+
+def init_tampon(capteurs):
+    """ prépare l'écriture groupée des mesures dans les bases rrd ; None si
+    aucun capteur n'a de base ou si le module rrdtool n'est pas installé
+    (base en pur Python)
+    """
+    if not any(capteur.rrd for capteur in capteurs):
+        return None
+    try:
+        from stockage import TamponRRD
+    except ImportError:
+        return None
+    try:
+        parametres = config["rrd"]
+        taille = parametres.getint("tampon", fallback=10)
+        delai = parametres.getint("tampon_delai", fallback=300)
+    except (KeyError, ValueError) as e:
+        logger.error("Erreur dans la section rrd du fichier de "
+                     "configuration : %s. Écriture de chaque mesure.", e)
+        return TamponRRD(1)
+    return TamponRRD(taille, delai, parametres.get("demon"))
 
 
 class Surveille(daemon):
+    def enregistre(self, capteur, lux):
+        """ publie la valeur lue pour le serveur web et la stocke dans la
+        base de données tournante du capteur
+        """
+        if self.publication is not None:
+            broadband, ir = capteur.tsl.last_channels
+            self.publication.publie(capteur.horodatage, broadband, ir, lux,
+                                    capteur.nom, capteur.porte.etat)
+        if not capteur.rrd:
+            return
+        # valeurs brutes et réglage de la lecture gardés pour pouvoir
+        # recalculer la luminosité
+        valeurs = (lux*100,) + tuple(capteur.tsl.last_channels) + \
+            tuple(capteur.tsl.last_range)
+        if self.tampon is not None:
+            self.tampon.ajoute(capteur.rrd, capteur.horodatage, *valeurs)
+            return
+        serie = self.serie(capteur)
+        if serie is not None:
+            debut = time.perf_counter()
+            serie.ajoute(capteur.horodatage, *valeurs[:len(serie.champs)])
+            metriques.ECRITURE_DUREE.observe(time.perf_counter() - debut,
+                                             "serie")
+
+    def serie(self, capteur):
+        """ base de mesures en pur Python du capteur, utilisée à la place de
+        rrdtool s'il n'est pas installé
+        """
+        if capteur.nom not in self.series:
+            fichier = fichier_serie(capteur.rrd)
+            try:
+                self.series[capteur.nom] = ouvre_serie(fichier,
+                                                       capteur.delai)
+            except (OSError, ValueError) as e:
+                logger.error("Erreur lors de l'ouverture de %s : %s. Les "
+                             "mesures ne seront pas stockées.", fichier, e)
+                self.series[capteur.nom] = None
+        return self.series[capteur.nom]
+
+    def etat(self):
+        """ état courant écrit à la réception de SIGUSR2 """
+        etat = {"capteurs": [profilage.etat_capteur(capteur)
+                             for capteur in self.capteurs]}
+        if distributeur is not None:
+            etat["notifications_en_attente"] = distributeur.taille()
+        if self.tampon is not None:
+            etat["mesures_en_attente"] = self.tampon.en_attente()
+        return etat
+
+    def recharge(self):
+        """ relit le fichier de configuration à la réception de SIGHUP :
+        seuils, filtrage, gain, temps d'intégration, période de lecture et
+        destinataires des mails. Les capteurs ne sont pas réinitialisés et
+        les portes gardent leur état ; rien n'est changé si le fichier
+        contient une erreur.
+        """
+        global config
+        sd_notify("RELOADING=1")
+        nouvelle = configparser.ConfigParser()
+        try:
+            if not nouvelle.read(fichier_config, encoding='utf-8'):
+                raise OSError("{} illisible".format(fichier_config))
+            delai, attente = lit_config(nouvelle)
+            multiple = any(section.startswith(PREFIXE_CAPTEUR)
+                           for section in nouvelle.sections())
+            reglages = []
+            for capteur in self.capteurs:
+                nom = capteur.nom
+                section = PREFIXE_CAPTEUR + nom if multiple else "Capteur"
+                etats = nouvelle["Etats:" + nom] \
+                    if "Etats:" + nom in nouvelle else nouvelle["Etats"]
+                parametres = nouvelle[section]
+                gain = parametres.getint("gain", fallback=None)
+                integration = parametres.getint("integration", fallback=None)
+                # vérifiés avant tout changement : le réglage est appliqué
+                # plus tard, par l'ordonnanceur
+                if gain not in (None, 1, 16):
+                    raise ValueError("gain du capteur {} : {} au lieu de 1 "
+                                     "ou 16".format(nom, gain))
+                if integration not in (None,) + tuple(_INTEGRATION_TIME):
+                    raise ValueError("temps d'intégration du capteur {} : {} "
+                                     "au lieu de {}".format(
+                                         nom, integration, ", ".join(
+                                             map(str, _INTEGRATION_TIME))))
+                reglages.append((
+                    capteur, etats,
+                    decision_porte(nouvelle, nom, etats, attente),
+                    parametres.getint("delay", fallback=delai)
+                    if multiple else delai,
+                    gain, integration,
+                    parametres.getfloat("rapide", fallback=0),
+                    parametres.getboolean("automatique", fallback=False)))
+        except (OSError, configparser.Error, KeyError, ValueError) as e:
+            logger.error("Configuration non rechargée : %s", e)
+            sd_notify("READY=1")
+            return
+        config = nouvelle
+        for capteur, etats, decision_, periode, gain, integration, rapide, \
+                automatique in reglages:
+            capteur.porte.reconfigure(etats, decision_)
+            capteur.delai = periode
+            capteur.cadence.rapide = min(rapide, periode)
+            capteur.automatique = automatique
+            if not automatique:
+                self.ordonnanceur.regle(capteur, gain, integration)
+        logger.info("Configuration rechargée depuis %s", fichier_config)
+        sd_notify("READY=1")
+
+    def veille(self):
+        """ met à jour l'état affiché par systemd et prévient son chien de
+        garde tant qu'aucun capteur n'est bloqué : si le bus I2C se fige,
+        systemd relance le programme
+        """
+        maintenant = time.monotonic()
+        bloques = [capteur.nom for capteur in self.capteurs
+                   if maintenant - capteur.activite >
+                   2 * capteur.delai + BLOCAGE]
+        etats = ["STATUS=" + ", ".join(
+            "{} : {}".format(capteur.nom, "erreur" if capteur.porte.malade
+                             else capteur.porte.etat)
+            for capteur in self.capteurs)]
+        if bloques:
+            logger.error("Capteurs bloqués : %s", ", ".join(bloques))
+        elif self.chien_de_garde:
+            etats.append("WATCHDOG=1")
+        sd_notify(*etats)
+
+    def arrete(self):
+        """ arrêt demandé par SIGTERM """
+        logger.info("Arrêt du programme")
+        sd_notify("STOPPING=1")
+        self.ordonnanceur.arrete()
+
+    def termine(self, fin):
+        """ écrit les mesures et envoie les notifications en attente avant
+        la date monotone fin ; les messages non envoyés restent dans le
+        spool pour le prochain démarrage
+        """
+        if self.profil.actif:
+            self.profil.arrete()
+        if self.tampon is not None:
+            self.tampon.vide()
+        for serie in self.series.values():
+            if serie is not None:
+                serie.close()
+        if self.publication is not None:
+            self.publication.close()
+        if distributeur is not None:
+            distributeur.arrete(max(0, fin - time.monotonic()))
+        if self.exportation is not None:
+            self.exportation.arrete()
+
     def main(self, delai, attente):
-        """ lit le capteur en boucle et déclenche previens si capteur dans
+        """ lit les capteurs en boucle et déclenche previens si capteur dans
         l'état allumé depuis attente lectures
         """
-        tsl = init_capteur()
+        global distributeur
         logger.debug("fichier pid : %s", self.pidfile)
-        etat_avant = 'fermé'
-        compteur = 0
-        deja_malade = False
-        f = freesms.FreeClient(user=config["FreeMobile"]["user"],
-                               passwd=config["FreeMobile"]["password"])
-        logger.debug("initialisation SMS pour %s",
-                     config["FreeMobile"]["user"])
-        gdh = datetime.datetime.now()
-        while True:
-            time.sleep(delai - 1)
-            try:
-                lux = tsl.read()
-                tsl.active(False)
-            except (IOError, ValueError) as e:
-                if not deja_malade:
-                    msg = "Erreur dans la lecture du capteur : {e}".format(e=e)
-                    logger.fatal(msg)
-                    previens(msg)
-                deja_malade = True
-                continue
-            if deja_malade:
-                deja_malade = False
-                msg = "Capteur ok."
-                logger.info(msg)
-                previens(msg)
-            etat = [k for k, v in config["Etats"].items()
-                    if float(v) <= lux][-1]
-            logger.debug("Valeur lue : %s - état : %s", lux, etat)
-            if etat != etat_avant:
-                gdh = datetime.datetime.now()
-                msg = "garage : etat {statut}" \
-                      " a {gdh}".format(statut=etat,
-                                        gdh=gdh.strftime(FMT_DATE))
-
-                previens(msg, f)
-            etat_avant = etat
-            try:
-                if rrd_store:
-                    rrdtool.update(config["rrd"]["base"], "N:{}".format(lux*100))
-            except rrdtool.OperationalError:
-                pass
+        # les capteurs s'initialisent sur le bus I2C pendant la préparation
+        # des notifications et de la publication
+        with concurrent.futures.ThreadPoolExecutor(1) as executeur:
+            capteurs = executeur.submit(lit_capteurs, delai, previens,
+                                        attente)
+            distributeur = init_notification()
+            if "Mail" in config:
+                distributeur.envoie("Début du programme", ["mail"])
+            self.publication = init_publication()
+            self.capteurs = capteurs.result()
+        self.tampon = init_tampon(self.capteurs)
+        self.series = {}
+        metriques.suit_capteurs(self.capteurs)
+        metriques.suit_distributeur(distributeur)
+        self.exportation = init_metriques()
+        if self.exportation is not None:
+            self.exportation.start()
+        programme = config["Programme"] if "Programme" in config else {}
+        self.profil = profilage.Profilage(
+            programme.get("profils", profilage.REPERTOIRE), self.etat)
+        try:
+            arret = float(programme.get("arret", ARRET))
+        except ValueError as e:
+            logger.error("Erreur dans la clé arret du fichier de "
+                         "configuration : %s", e)
+            arret = ARRET
+        # arrêt par SIGTERM pendant l'initialisation
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        self.chien_de_garde = watchdog_interval()
+        veilleur = (self.chien_de_garde or STATUT, self.veille) \
+            if "NOTIFY_SOCKET" in os.environ else None
+        self.ordonnanceur = Ordonnanceur(
+            self.capteurs, self.enregistre,
+            {signal.SIGHUP: self.recharge,
+             signal.SIGTERM: self.arrete,
+             signal.SIGUSR1: self.profil.bascule,
+             signal.SIGUSR2: self.profil.ecrit_etat},
+            veilleur)
+        try:
+            sd_notify("READY=1")
+            self.ordonnanceur.run()
+        finally:
+            # un second SIGTERM n'interrompt pas l'écriture des données
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            self.termine(time.monotonic() + arret)
 
     def run(self):
         self.main(delai, attente)
 
 
 def init_prog(args):
+    global fichier_config
     config = configparser.ConfigParser()
     config_file = FICH_CONFIG
     if hasattr(args, 'config'):
         if hasattr(args.config, 'name'):
-            config_file = args.config.name
+            config_file = os.path.abspath(args.config.name)
     config.read(config_file, encoding='utf-8')
+    # relu à la réception de SIGHUP
+    fichier_config = config_file
     if args.log_level is None:
         try:
             level = logging._nameToLevel.get(
@@ -251,7 +714,7 @@ if __name__ == "__main__":
     args = lit_params_ligne_cmd()
     config = init_prog(args)
     delai, attente = lit_config(config)
-    envoi_mail("Début du programme")
+    transport_mail = init_transport_mail()
     surveille = Surveille(config["Programme"]["pid"])
     if args.foreground:
         surveille.run()
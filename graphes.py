@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Tracé des graphiques de luminosité à la demande, par la bibliothèque
+rrdtool, ou en SVG à partir de la base en pur Python si rrdtool n'est pas
+installé. Chaque image est gardée en mémoire avec la date de dernière mise
+à jour de la base : elle n'est retracée que si de nouvelles mesures sont
+arrivées.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import collections
+import html
+import importlib
+import importlib.util
+import re
+import threading
+import time
+import serie
+
+
+class ModuleDiffere:
+    """ module importé au premier accès à l'un de ses attributs : rrdtool
+    charge les bibliothèques de tracé, longues à charger sur un Raspberry
+    Pi, dont le serveur web n'a besoin qu'au premier graphique
+    """
+
+    def __init__(self, nom):
+        self._nom = nom
+        self._module = None
+
+    def __getattr__(self, attribut):
+        if self._module is None:
+            self._module = importlib.import_module(self._nom)
+        return getattr(self._module, attribut)
+
+
+rrdtool = ModuleDiffere("rrdtool") \
+    if importlib.util.find_spec("rrdtool") is not None else None
+
+# mêmes périodes que le script gen_graphs
+PERIODES = {"jour": "days", "mois": "months", "annee": "years"}
+LARGEUR = 1280
+HAUTEUR = 380
+TAILLE_MIN = 100
+TAILLE_MAX = 4000
+# spécification de date rrdtool : now, end-1days, 1572000000, -2h...
+_DATE = re.compile(r"^[\w+\-: ]{1,40}$")
+
+# durée des unités de temps acceptées dans les dates, en secondes
+UNITES = {"s": 1, "sec": 1, "seconds": 1, "min": 60, "minutes": 60,
+          "h": 3600, "hours": 3600, "d": 86400, "days": 86400,
+          "w": 604800, "weeks": 604800, "mon": 2678400, "months": 2678400,
+          "y": 31536000, "years": 31536000}
+_DATE_RELATIVE = re.compile(r"^(now|end|start)?([+-]\d+)([a-z]*)$")
+
+Image = collections.namedtuple("Image", "mise_a_jour contenu type")
+
+
+class _Cache:
+    """ images déjà tracées, les moins récemment demandées étant oubliées
+    en premier
+    """
+
+    def __init__(self, taille_cache):
+        self.taille_cache = taille_cache
+        self._cache = collections.OrderedDict()
+        self._verrou = threading.Lock()
+        # nombre d'images tracées (hors cache)
+        self.traces = 0
+
+    def _valide(self, cle, mise_a_jour):
+        image = self._cache.get(cle)
+        if image is not None and image.mise_a_jour == mise_a_jour:
+            self._cache.move_to_end(cle)
+            return image
+        return None
+
+    def _garde(self, cle, image):
+        self.traces += 1
+        self._cache[cle] = image
+        self._cache.move_to_end(cle)
+        while len(self._cache) > self.taille_cache:
+            self._cache.popitem(last=False)
+
+
+def _verifie(debut, fin, largeur, hauteur):
+    for date in (debut, fin):
+        if not _DATE.match(date):
+            raise ValueError("date incorrecte : {}".format(date))
+    if not (TAILLE_MIN <= largeur <= TAILLE_MAX and
+            TAILLE_MIN <= hauteur <= TAILLE_MAX):
+        raise ValueError("taille incorrecte : {}x{}".format(largeur,
+                                                           hauteur))
+
+
+class Graphes(_Cache):
+    """ tracé des graphiques d'une base de données tournante """
+    # extension des adresses des graphiques, selon leur format
+    extension = "png"
+
+    def __init__(self, base, taille_cache=32, consolidation="AVERAGE"):
+        """
+        param: base: fichier de la base de données tournante
+        param: taille_cache: nombre d'images gardées en mémoire ; les
+            moins récemment demandées sont oubliées en premier
+        param: consolidation: fonction de consolidation des archives
+            tracées (les bases non migrées n'ont que MAX)
+        """
+        if rrdtool is None:
+            raise RuntimeError("module rrdtool absent")
+        # le verrou évite aussi de tracer en parallèle, ce pour quoi la
+        # bibliothèque rrd n'est pas prévue
+        super().__init__(taille_cache)
+        self.base = base
+        self.consolidation = consolidation
+
+    def periode(self, periode):
+        """ graphique du jour, du mois ou de l'année, comme gen_graphs """
+        if periode not in PERIODES:
+            raise ValueError("période inconnue : {}".format(periode))
+        return self.trace("end-1" + PERIODES[periode], "now", LARGEUR,
+                          HAUTEUR, "Eclairage garage - " + periode)
+
+    def trace(self, debut="end-1days", fin="now", largeur=LARGEUR,
+              hauteur=HAUTEUR, titre="Eclairage garage"):
+        """ renvoie l'image PNG (Image) entre les dates debut et fin """
+        _verifie(debut, fin, largeur, hauteur)
+        mise_a_jour = rrdtool.last(self.base)
+        cle = (debut, fin, largeur, hauteur, titre)
+        with self._verrou:
+            image = self._valide(cle, mise_a_jour)
+            if image is not None:
+                return image
+            resultat = rrdtool.graphv(
+                "-", "--imgformat", "PNG", "--title", titre,
+                "--width", str(largeur), "--height", str(hauteur),
+                "--end", fin, "--start", debut,
+                "--vertical-label", "Lux",
+                "DEF:lux={}:lumin:{}".format(
+                    self.base.replace(":", "\\:"), self.consolidation),
+                "LINE1:lux#ff0000:Luminosité",
+                "GPRINT:lux:LAST:Dernière luminosité\\: %2.1lf")
+            image = Image(mise_a_jour, resultat["image"], "image/png")
+            self._garde(cle, image)
+        return image
+
+
+def date_absolue(date, maintenant, fin=None):
+    """ convertit une date au format rrdtool simplifié (now, end-1days,
+    -2h, date en secondes) en secondes depuis l'époque
+    """
+    if date.isdigit():
+        return int(date)
+    if date == "now":
+        return maintenant
+    relative = _DATE_RELATIVE.match(date)
+    if relative is None or relative.group(3) not in UNITES and \
+            relative.group(3):
+        raise ValueError("date incorrecte : {}".format(date))
+    reference, decalage, unite = relative.groups()
+    origine = fin if reference == "end" and fin is not None else maintenant
+    return origine + int(decalage) * UNITES.get(unite or "s")
+
+
+class GraphesSerie(_Cache):
+    """ tracé en SVG des graphiques de la base en pur Python """
+    extension = "svg"
+
+    def __init__(self, fichier, taille_cache=32):
+        super().__init__(taille_cache)
+        self.serie = serie.SerieTemporelle(fichier)
+        self.base = fichier
+
+    def periode(self, periode):
+        if periode not in PERIODES:
+            raise ValueError("période inconnue : {}".format(periode))
+        return self.trace("end-1" + PERIODES[periode], "now", LARGEUR,
+                          HAUTEUR, "Eclairage garage - " + periode)
+
+    def trace(self, debut="end-1days", fin="now", largeur=LARGEUR,
+              hauteur=HAUTEUR, titre="Eclairage garage"):
+        """ renvoie l'image SVG (Image) entre les dates debut et fin ;
+        comme pour Graphes, l'image est gardée sous les dates relatives et
+        n'est retracée que si une mesure a été ajoutée depuis
+        """
+        _verifie(debut, fin, largeur, hauteur)
+        mise_a_jour = self.serie.mise_a_jour()
+        cle = (debut, fin, largeur, hauteur, titre)
+        with self._verrou:
+            image = self._valide(cle, mise_a_jour)
+            if image is not None:
+                return image
+            maintenant = int(time.time())
+            fin = date_absolue(fin, maintenant)
+            debut = date_absolue(debut, maintenant, fin)
+            if debut >= fin:
+                raise ValueError("début postérieur à la fin")
+            points = self.serie.lit(debut, fin, (fin - debut) / largeur)
+            image = Image(mise_a_jour,
+                          _svg(points, debut, fin, largeur, hauteur, titre),
+                          "image/svg+xml")
+            self._garde(cle, image)
+        return image
+
+
+def _svg(points, debut, fin, largeur, hauteur, titre):
+    """ courbe des points (date, valeur), interrompue là où il manque des
+    mesures
+    """
+    valeurs = [valeur for _, valeur in points if valeur is not None]
+    maxi = max(valeurs, default=0) or 1
+    marge = 20
+    courbes, courbe = [], []
+    for date, valeur in points:
+        if valeur is None:
+            if courbe:
+                courbes.append(courbe)
+            courbe = []
+            continue
+        courbe.append("{:.1f},{:.1f}".format(
+            (date - debut) / (fin - debut) * largeur,
+            marge + (1 - valeur / maxi) * (hauteur - 2 * marge)))
+    if courbe:
+        courbes.append(courbe)
+    derniere = "{:2.1f}".format(valeurs[-1]) if valeurs else "-"
+    lignes = ['<svg xmlns="http://www.w3.org/2000/svg" width="{l}" '
+              'height="{h}" viewBox="0 0 {l} {h}">'.format(l=largeur,
+                                                          h=hauteur),
+              '<rect width="100%" height="100%" fill="white"/>',
+              '<text x="{}" y="14" text-anchor="middle">{}</text>'.format(
+                  largeur // 2, html.escape(titre)),
+              '<text x="2" y="{}">{:.1f} Lux</text>'.format(marge + 12, maxi),
+              '<text x="2" y="{}">Dernière luminosité : {}</text>'.format(
+                  hauteur - 4, derniere)]
+    lignes.extend('<polyline fill="none" stroke="#ff0000" '
+                  'points="{}"/>'.format(" ".join(courbe))
+                  for courbe in courbes)
+    lignes.append("</svg>")
+    return "\n".join(lignes).encode("utf-8")
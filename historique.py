@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Lecture de l'historique des mesures, dans la base rrd ou, si le module
+rrdtool n'est pas installé, dans la base en pur Python. Les points sont
+produits un à un pour être envoyés au fur et à mesure par le serveur web.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+import time
+import serie
+from graphes import date_absolue, rrdtool
+
+# garage.py enregistre la luminosité multipliée par ECHELLE
+ECHELLE = 100
+# valeurs renvoyées par canaux, après les dates
+CHAMPS = ("lumin", "ch0", "ch1", "gain", "integ")
+
+
+class HistoriqueRRD:
+    """ historique lu dans une base de données tournante """
+
+    def __init__(self, base):
+        self.base = base
+
+    def points(self, debut, fin, pas=None):
+        """ renvoie un itérateur sur les (date, luminosité) moyennes entre
+        debut et fin (dates au format rrdtool), None s'il manque des
+        mesures
+        """
+        options = ["--start", debut, "--end", fin]
+        if pas:
+            options += ["--resolution", str(pas)]
+        try:
+            (debut, _, pas), _, lignes = rrdtool.fetch(self.base, "AVERAGE",
+                                                       *options)
+        except rrdtool.OperationalError as e:
+            raise ValueError(str(e))
+        return ((debut + (i + 1) * pas,
+                 None if ligne[0] is None else ligne[0] / ECHELLE)
+                for i, ligne in enumerate(lignes))
+
+    def canaux(self, debut, fin, pas=None):
+        """ renvoie les listes des dates, des luminosités enregistrées, des
+        valeurs brutes des deux canaux, des gains et des temps d'intégration
+        entre debut et fin, NaN s'il manque des mesures ou si la base est
+        antérieure à l'enregistrement du réglage
+        """
+        options = ["--start", debut, "--end", fin]
+        if pas:
+            options += ["--resolution", str(pas)]
+        try:
+            (debut, _, pas), sources, lignes = rrdtool.fetch(
+                self.base, "AVERAGE", *options)
+        except rrdtool.OperationalError as e:
+            raise ValueError(str(e))
+        if "ch0" not in sources:
+            raise ValueError("pas de valeurs brutes dans {} : migrer la "
+                             "base avec rrd_manage.py --migrate".format(
+                                 self.base))
+        colonnes = [sources.index(nom) if nom in sources else None
+                    for nom in CHAMPS]
+        return ([debut + (i + 1) * pas for i in range(len(lignes))],) + \
+            tuple([math.nan if colonne is None or ligne[colonne] is None
+                   else ligne[colonne] for ligne in lignes]
+                  for colonne in colonnes)
+
+
+class HistoriqueSerie:
+    """ historique lu dans la base en pur Python """
+
+    def __init__(self, fichier):
+        self.base = fichier
+        self.serie = serie.SerieTemporelle(fichier)
+
+    def points(self, debut, fin, pas=None):
+        maintenant = int(time.time())
+        fin = date_absolue(fin, maintenant)
+        debut = date_absolue(debut, maintenant, fin)
+        if debut > fin:
+            raise ValueError("début postérieur à la fin")
+        return ((date, None if valeur is None else valeur / ECHELLE)
+                for date, valeur in self.serie.parcours(debut, fin, pas))
+
+    def canaux(self, debut, fin, pas=None):
+        if "ch0" not in self.serie.champs:
+            raise ValueError("pas de valeurs brutes dans {}".format(
+                self.base))
+        maintenant = int(time.time())
+        fin = date_absolue(fin, maintenant)
+        debut = date_absolue(debut, maintenant, fin)
+        resultat = [[] for _ in range(len(CHAMPS) + 1)]
+        for numero, nom in enumerate(CHAMPS, 1):
+            if nom not in self.serie.champs:
+                resultat[numero] = [math.nan] * len(resultat[0])
+                continue
+            points = self.serie.parcours(debut, fin, pas,
+                                         champ=self.serie.champs.index(nom))
+            for date, valeur in points:
+                if numero == 1:
+                    resultat[0].append(date)
+                resultat[numero].append(math.nan if valeur is None
+                                        else valeur)
+        return tuple(resultat)
+
+
+def historique(base):
+    """ historique de la base rrd base, ou de la base en pur Python qui la
+    remplace
+    """
+    if rrdtool is not None:
+        return HistoriqueRRD(base)
+    return HistoriqueSerie(serie.fichier_serie(base))
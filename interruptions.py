@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Sources d'interruption pour la détection sur seuil du TSL2561.
+Une source fournit un descripteur de fichier qui devient lisible lorsque
+la ligne INT du capteur est activée :
+
+- SourceGPIO lit les fronts d'une ligne GPIO par l'interface caractère
+  du noyau (/dev/gpiochipN), sans dépendance externe ;
+- SourceTube remplace la ligne par un tube, pour déclencher les
+  interruptions depuis un programme de test.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import fcntl
+import os
+import struct
+
+# linux/gpio.h (ABI v1)
+_GPIOHANDLE_REQUEST_INPUT = 1 << 0
+_GPIOEVENT_REQUEST_FALLING_EDGE = 1 << 1
+# struct gpioevent_request : lineoffset, handleflags, eventflags,
+# consumer_label[32], fd
+_GPIOEVENT_REQUEST = struct.Struct("III32si")
+_GPIO_GET_LINEEVENT_IOCTL = (3 << 30) | (_GPIOEVENT_REQUEST.size << 16) \
+    | (0xB4 << 8) | 0x04
+# struct gpioevent_data : timestamp, id (+ bourrage)
+_GPIOEVENT_DATA_SIZE = 16
+
+
+class SourceGPIO:
+    """ ligne INT du capteur reliée à une entrée GPIO. Le TSL2561 tire la
+    ligne à l'état bas : on attend les fronts descendants.
+    """
+
+    def __init__(self, ligne, puce="/dev/gpiochip0"):
+        """
+        param: ligne: numéro de la ligne sur la puce (numéro BCM sur un Pi)
+        param: puce: périphérique de la puce GPIO
+        """
+        self.ligne = ligne
+        requete = bytearray(_GPIOEVENT_REQUEST.pack(
+            ligne, _GPIOHANDLE_REQUEST_INPUT,
+            _GPIOEVENT_REQUEST_FALLING_EDGE, b"garage", 0))
+        fd_puce = os.open(puce, os.O_RDONLY)
+        try:
+            fcntl.ioctl(fd_puce, _GPIO_GET_LINEEVENT_IOCTL, requete)
+        finally:
+            os.close(fd_puce)
+        self._fd = _GPIOEVENT_REQUEST.unpack(requete)[4]
+        os.set_blocking(self._fd, False)
+
+    def fileno(self):
+        return self._fd
+
+    def acquitte(self):
+        """ consomme les fronts en attente """
+        try:
+            while os.read(self._fd, _GPIOEVENT_DATA_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SourceTube:
+    """ interruption simulée par un tube : declenche() joue le rôle du
+    capteur qui active la ligne INT
+    """
+
+    def __init__(self):
+        self._lecture, self._ecriture = os.pipe()
+        os.set_blocking(self._lecture, False)
+
+    def fileno(self):
+        return self._lecture
+
+    def declenche(self):
+        os.write(self._ecriture, b"\x00")
+
+    def acquitte(self):
+        try:
+            while os.read(self._lecture, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._lecture)
+        os.close(self._ecriture)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Compteurs et histogrammes des points chauds du programme, exposés au format
+texte de Prometheus. Chaque mesure ne coûte qu'une recherche dans une liste
+de bornes et quelques additions, sous le verrou de la métrique : aucune
+mesure n'est perdue quand plusieurs threads la mettent à jour, et
+l'exportation lit une copie cohérente de chaque série.
+
+garage.py écrit régulièrement ses métriques dans un fichier que serveur.py
+ajoute aux siennes sur /metrics.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import bisect
+import logging
+import os
+import threading
+
+FICHIER = "/dev/shm/garage.prom"
+TYPE_CONTENU = "text/plain; version=0.0.4; charset=utf-8"
+# bornes des histogrammes (s)
+BORNES_I2C = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)
+BORNES_LECTURE = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+BORNES_GIGUE = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+BORNES_ENVOI = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 60.0,
+                300.0)
+BORNES_ECRITURE = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 1.0)
+BORNES_HTTP = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1.0, 5.0)
+
+logger = logging.getLogger('Garage')
+
+
+def _echappe(valeur):
+    return str(valeur).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def _nombre(valeur):
+    if valeur == float("inf"):
+        return "+Inf"
+    if isinstance(valeur, float) and valeur.is_integer():
+        return str(int(valeur))
+    return repr(valeur)
+
+
+class Metrique:
+    """ métrique, éventuellement déclinée par valeurs d'étiquettes """
+    type = "untyped"
+
+    def __init__(self, nom, aide, etiquettes=()):
+        self.nom = nom
+        self.aide = aide
+        self.etiquettes = etiquettes
+        self.series = {}
+        self._verrou = threading.Lock()
+
+    def _etiquettes(self, valeurs, supplement=""):
+        paires = ['{}="{}"'.format(nom, _echappe(valeur))
+                  for nom, valeur in zip(self.etiquettes, valeurs)]
+        if supplement:
+            paires.append(supplement)
+        return "{" + ",".join(paires) + "}" if paires else ""
+
+    def valeurs(self):
+        """ (valeurs des étiquettes, valeur) de chaque série """
+        with self._verrou:
+            return list(self.series.items())
+
+    def lignes(self):
+        yield "# HELP {} {}".format(self.nom, self.aide)
+        yield "# TYPE {} {}".format(self.nom, self.type)
+        for etiquettes, valeur in sorted(list(self.valeurs())):
+            yield "{}{} {}".format(self.nom, self._etiquettes(etiquettes),
+                                   _nombre(valeur))
+
+
+class Compteur(Metrique):
+    type = "counter"
+
+    def ajoute(self, *etiquettes, n=1):
+        with self._verrou:
+            self.series[etiquettes] = self.series.get(etiquettes, 0) + n
+
+
+class Calculee(Metrique):
+    """ compteur ou jauge dont les valeurs sont lues à l'exportation :
+    fonction renvoie un dictionnaire valeurs des étiquettes -> valeur
+    """
+
+    def __init__(self, nom, aide, etiquettes=(), fonction=None,
+                 type="gauge"):
+        super().__init__(nom, aide, etiquettes)
+        self.fonction = fonction
+        self.type = type
+
+    def valeurs(self):
+        return self.fonction().items()
+
+
+class Histogramme(Metrique):
+    type = "histogram"
+
+    def __init__(self, nom, aide, etiquettes=(), bornes=BORNES_LECTURE):
+        super().__init__(nom, aide, etiquettes)
+        self.bornes = tuple(bornes)
+
+    def observe(self, valeur, *etiquettes):
+        intervalle = bisect.bisect_left(self.bornes, valeur)
+        with self._verrou:
+            serie = self.series.get(etiquettes)
+            if serie is None:
+                # nombre par intervalle (le dernier au-delà des bornes),
+                # somme
+                serie = self.series[etiquettes] = [
+                    [0] * (len(self.bornes) + 1), 0.0]
+            serie[0][intervalle] += 1
+            serie[1] += valeur
+
+    def valeurs(self):
+        with self._verrou:
+            return [(etiquettes, (list(comptes), somme))
+                    for etiquettes, (comptes, somme) in self.series.items()]
+
+    def lignes(self):
+        yield "# HELP {} {}".format(self.nom, self.aide)
+        yield "# TYPE {} {}".format(self.nom, self.type)
+        for etiquettes, (comptes, somme) in sorted(self.valeurs()):
+            cumul = 0
+            for borne, nombre in zip(self.bornes + (float("inf"),), comptes):
+                cumul += nombre
+                yield "{}_bucket{} {}".format(
+                    self.nom, self._etiquettes(
+                        etiquettes, 'le="{}"'.format(_nombre(borne))), cumul)
+            yield "{}_sum{} {}".format(self.nom, self._etiquettes(etiquettes),
+                                       _nombre(somme))
+            yield "{}_count{} {}".format(self.nom,
+                                         self._etiquettes(etiquettes), cumul)
+
+
+class Registre:
+    """ ensemble des métriques d'un processus """
+
+    def __init__(self):
+        self.metriques = []
+
+    def ajoute(self, metrique):
+        self.metriques.append(metrique)
+        return metrique
+
+    def compteur(self, nom, aide, etiquettes=()):
+        return self.ajoute(Compteur(nom, aide, etiquettes))
+
+    def histogramme(self, nom, aide, etiquettes=(), bornes=BORNES_LECTURE):
+        return self.ajoute(Histogramme(nom, aide, etiquettes, bornes))
+
+    def calculee(self, nom, aide, etiquettes, fonction, type="gauge"):
+        return self.ajoute(Calculee(nom, aide, etiquettes, fonction, type))
+
+    def texte(self):
+        lignes = []
+        for metrique in self.metriques:
+            try:
+                lignes.extend(metrique.lignes())
+            except Exception as e:
+                # une métrique calculée illisible ne cache pas les autres
+                logger.error("Métrique %s illisible : %s", metrique.nom, e)
+        return "\n".join(lignes) + "\n"
+
+
+class Exportation(threading.Thread):
+    """ écrit les métriques d'un registre dans un fichier toutes les
+    periode secondes, par remplacement pour que le lecteur ne voie jamais
+    un fichier incomplet
+    """
+
+    def __init__(self, registre, fichier=FICHIER, periode=15):
+        super().__init__(daemon=True, name="metriques")
+        self.registre = registre
+        self.fichier = fichier
+        self.periode = periode
+        self._arret = threading.Event()
+
+    def ecrit(self):
+        temporaire = self.fichier + ".tmp"
+        try:
+            with open(temporaire, "w", encoding="utf-8") as f:
+                f.write(self.registre.texte())
+            os.replace(temporaire, self.fichier)
+        except OSError as e:
+            logger.error("Erreur lors de l'écriture des métriques dans %s : "
+                         "%s", self.fichier, e)
+
+    def run(self):
+        while not self._arret.wait(self.periode):
+            self.ecrit()
+
+    def arrete(self):
+        self._arret.set()
+        self.ecrit()
+
+
+# métriques de garage.py
+registre = Registre()
+I2C_DUREE = registre.histogramme(
+    "garage_i2c_duree_secondes", "Durée des transactions I2C",
+    ("capteur",), BORNES_I2C)
+I2C_ERREURS = registre.compteur(
+    "garage_i2c_erreurs_total", "Transactions I2C en échec", ("capteur",))
+LECTURE_DUREE = registre.histogramme(
+    "garage_lecture_duree_secondes",
+    "Durée de TSL2561.read, conversion comprise", ("capteur",),
+    BORNES_LECTURE)
+LECTURE_ERREURS = registre.compteur(
+    "garage_lecture_erreurs_total", "Lectures du capteur en échec",
+    ("capteur",))
+GIGUE = registre.histogramme(
+    "garage_gigue_secondes", "Retard des lectures sur leur échéance",
+    ("capteur",), BORNES_GIGUE)
+NOTIFICATION_DELAI = registre.histogramme(
+    "garage_notification_delai_secondes",
+    "Délai entre le dépôt d'une notification et son envoi", ("canal",),
+    BORNES_ENVOI)
+NOTIFICATION_ECHECS = registre.compteur(
+    "garage_notification_echecs_total", "Envois de notification en échec",
+    ("canal",))
+ECRITURE_DUREE = registre.histogramme(
+    "garage_ecriture_duree_secondes",
+    "Durée d'écriture des mesures dans la base", ("stockage",),
+    BORNES_ECRITURE)
+ECRITURE_ERREURS = registre.compteur(
+    "garage_ecriture_erreurs_total",
+    "Écritures dans la base en échec", ("stockage",))
+
+
+def suit_capteurs(capteurs):
+    """ métriques lues dans les capteurs à l'exportation, et mesure de la
+    durée des transactions I2C et des lectures de chacun
+    """
+    registre.calculee(
+        "garage_i2c_transactions_total", "Transactions I2C", ("capteur",),
+        lambda: {(capteur.nom,): capteur.tsl.transactions
+                 for capteur in capteurs}, "counter")
+    registre.calculee(
+        "garage_saturations_total", "Conversions saturées", ("capteur",),
+        lambda: {(capteur.nom,): capteur.tsl.saturations
+                 for capteur in capteurs}, "counter")
+    registre.calculee(
+        "garage_echeances_manquees_total",
+        "Échéances de lecture manquées", ("capteur",),
+        lambda: {(capteur.nom,): capteur.cadence.manquees
+                 for capteur in capteurs}, "counter")
+    registre.calculee(
+        "garage_gain", "Gain du capteur", ("capteur",),
+        lambda: {(capteur.nom,): capteur.tsl.gain() for capteur in capteurs})
+    registre.calculee(
+        "garage_integration_secondes", "Temps d'intégration du capteur",
+        ("capteur",),
+        lambda: {(capteur.nom,): capteur.tsl.integration_time() / 1000
+                 for capteur in capteurs})
+    for capteur in capteurs:
+        instrumente(capteur.tsl, capteur.nom)
+
+
+def instrumente(tsl, nom):
+    def transaction(duree, erreur):
+        I2C_DUREE.observe(duree, nom)
+        if erreur:
+            I2C_ERREURS.ajoute(nom)
+
+    def lecture(duree):
+        LECTURE_DUREE.observe(duree, nom)
+    tsl.transaction_hook = transaction
+    tsl.read_hook = lecture
+
+
+def suit_distributeur(distributeur):
+    registre.calculee(
+        "garage_notification_attente", "Notifications en attente",
+        ("canal",), lambda: {(nom,): taille for nom, taille
+                             in distributeur.taille().items()})
+
+
+# métriques de serveur.py
+registre_http = Registre()
+HTTP_DUREE = registre_http.histogramme(
+    "garage_http_duree_secondes", "Durée de traitement des requêtes HTTP",
+    ("chemin",), BORNES_HTTP)
+HTTP_REQUETES = registre_http.compteur(
+    "garage_http_requetes_total", "Requêtes HTTP par code de réponse",
+    ("chemin", "code"))
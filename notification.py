@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Envoi des notifications en arrière-plan. La boucle de lecture des capteurs
+ne fait que déposer les messages ; un thread par canal (SMS, mail) les
+envoie, en réessayant avec un délai croissant en cas d'échec. Les messages
+en attente sont conservés dans un répertoire de spool pour être renvoyés
+après un redémarrage du programme.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import metriques
+
+URL_FREEMOBILE = "https://smsapi.free-mobile.fr/sendmsg"
+
+logger = logging.getLogger('Garage')
+
+
+class TransportSMS:
+    """ API SMS de FreeMobile, par une session HTTP dont la connexion est
+    gardée ouverte d'un message à l'autre ; requests n'est importé qu'au
+    premier envoi
+    """
+    CODES = {400: "paramètre manquant",
+             402: "trop de SMS envoyés",
+             403: "service non activé ou identifiants incorrects",
+             500: "erreur du serveur"}
+
+    def __init__(self, user, password, url=URL_FREEMOBILE, timeout=10):
+        self.user = user
+        self.password = password
+        self.url = url
+        self.timeout = timeout
+        self.session = None
+
+    def envoie(self, message):
+        """ renvoie True si le SMS est accepté ; les erreurs de connexion
+        sont levées (requests.exceptions.RequestException), la session se
+        reconnecte d'elle-même à l'envoi suivant
+        """
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        reponse = self.session.get(self.url, timeout=self.timeout,
+                                   params={"user": self.user,
+                                           "pass": self.password,
+                                           "msg": message})
+        if reponse.status_code == 200:
+            return True
+        logger.error("Erreur FreeMobile %s : %s", reponse.status_code,
+                     self.CODES.get(reponse.status_code, reponse.reason))
+        return False
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+class TransportSMTP:
+    """ connexion SMTP gardée ouverte, rétablie si le serveur l'a fermée ;
+    smtplib n'est importé qu'au premier envoi
+    """
+
+    def __init__(self, serveur="localhost", port=25, utilisateur=None,
+                 mot_de_passe=None, starttls=False, timeout=10):
+        self.serveur = serveur
+        self.port = port
+        self.utilisateur = utilisateur
+        self.mot_de_passe = mot_de_passe
+        self.starttls = starttls
+        self.timeout = timeout
+        self._smtp = None
+
+    def _connecte(self):
+        import smtplib
+        smtp = smtplib.SMTP(self.serveur, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                smtp.starttls()
+            if self.utilisateur:
+                smtp.login(self.utilisateur, self.mot_de_passe)
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+            raise
+        logger.debug("Connexion SMTP à %s:%s", self.serveur, self.port)
+        self._smtp = smtp
+
+    def envoie(self, msg):
+        """ envoie un email.message.Message, renvoie True si le serveur
+        l'a accepté pour tous les destinataires
+        """
+        import smtplib
+        for essai in range(2):
+            try:
+                if self._smtp is None:
+                    self._connecte()
+                refuses = self._smtp.send_message(msg)
+                break
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # connexion fermée par le serveur pendant l'inactivité
+                self.close()
+                if essai:
+                    raise
+        if refuses:
+            logger.error("Destinataires refusés : %s", refuses)
+        return not refuses
+
+    def close(self):
+        if self._smtp is None:
+            return
+        import smtplib
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+
+class Distributeur:
+    """ files d'attente bornées des messages, une par canal """
+
+    def __init__(self, canaux, spool=None, taille=100, essais=5, delai=2,
+                 delai_max=300):
+        """
+        param: canaux: dictionnaire nom -> fonction d'envoi d'un message,
+            qui renvoie True si le message est parti
+        param: spool: répertoire de conservation des messages en attente
+        param: taille: nombre maximal de messages en attente par canal
+        param: essais: nombre d'envois tentés avant d'abandonner un message
+        param: delai: attente avant le premier nouvel essai, doublée à
+            chaque échec
+        param: delai_max: attente maximale entre deux essais
+        """
+        self.canaux = canaux
+        self.spool = spool
+        self.essais = essais
+        self.delai = delai
+        self.delai_max = delai_max
+        self.files = {nom: queue.Queue(maxsize=taille) for nom in canaux}
+        self._numero = itertools.count()
+        # arrêt demandé : interrompt les attentes entre deux essais
+        self._arret = threading.Event()
+        if spool is not None:
+            try:
+                os.makedirs(spool, exist_ok=True)
+            except OSError as e:
+                logger.error("Répertoire de spool %s inutilisable : %s",
+                             spool, e)
+                self.spool = None
+        self._reprend_spool()
+        self.threads = [threading.Thread(target=self._envoie_canal,
+                                         args=(nom,), daemon=True,
+                                         name="notification-" + nom)
+                        for nom in canaux]
+        for thread in self.threads:
+            thread.start()
+
+    def envoie(self, message, canaux=None):
+        """ dépose un message pour les canaux donnés (tous par défaut), sans
+        attendre
+        """
+        for nom in self.canaux if canaux is None else canaux:
+            if nom in self.files:
+                self._depose(nom, message, self._sauve(nom, message))
+
+    def _depose(self, nom, message, fichier):
+        file = self.files[nom]
+        while True:
+            try:
+                file.put_nowait((message, fichier, time.monotonic()))
+                return
+            except queue.Full:
+                # le message le plus ancien est le moins utile
+                try:
+                    ancien, ancien_fichier, _ = file.get_nowait()
+                except queue.Empty:
+                    continue
+                logger.error("File %s pleine, message abandonné : %s",
+                             nom, ancien)
+                self._efface(ancien_fichier)
+
+    def _sauve(self, nom, message):
+        if self.spool is None:
+            return None
+        fichier = os.path.join(self.spool, "{:.6f}-{}-{}.json".format(
+            time.time(), next(self._numero), nom))
+        try:
+            with open(fichier + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"canal": nom, "message": message}, f)
+            os.replace(fichier + ".tmp", fichier)
+        except OSError as e:
+            logger.error("Erreur lors de l'écriture du spool : %s", e)
+            return None
+        return fichier
+
+    def _efface(self, fichier):
+        if fichier is None:
+            return
+        try:
+            os.remove(fichier)
+        except OSError as e:
+            logger.error("Erreur lors de l'effacement de %s : %s", fichier, e)
+
+    def _reprend_spool(self):
+        """ remet en file les messages non envoyés avant l'arrêt """
+        if self.spool is None:
+            return
+        for nom_fichier in sorted(os.listdir(self.spool)):
+            if not nom_fichier.endswith(".json"):
+                continue
+            fichier = os.path.join(self.spool, nom_fichier)
+            try:
+                with open(fichier, encoding="utf-8") as f:
+                    contenu = json.load(f)
+                nom, message = contenu["canal"], contenu["message"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.error("Fichier de spool %s illisible : %s",
+                             fichier, e)
+                continue
+            if nom not in self.files:
+                continue
+            logger.info("Reprise du message %s (%s)", message, nom)
+            self._depose(nom, message, fichier)
+
+    def _envoie_canal(self, nom):
+        envoi = self.canaux[nom]
+        file = self.files[nom]
+        while True:
+            element = file.get()
+            if element is None:
+                file.task_done()
+                return
+            message, fichier, depot = element
+            attente = self.delai
+            for essai in range(1, self.essais + 1):
+                try:
+                    envoye = envoi(message)
+                except Exception as e:
+                    logger.error("Erreur lors de l'envoi %s : %s", nom, e)
+                    envoye = False
+                if envoye:
+                    metriques.NOTIFICATION_DELAI.observe(
+                        time.monotonic() - depot, nom)
+                    self._efface(fichier)
+                    break
+                metriques.NOTIFICATION_ECHECS.ajoute(nom)
+                if essai < self.essais and not self._arret.is_set():
+                    # interrompue par l'arrêt, l'attente est suivie d'un
+                    # dernier essai immédiat
+                    self._arret.wait(attente)
+                    attente = min(2 * attente, self.delai_max)
+                    continue
+                logger.error("Message %s non envoyé après %s essais, "
+                             "conservé pour le prochain démarrage : %s",
+                             nom, essai, message)
+                break
+            file.task_done()
+
+    def taille(self):
+        """ nombre de messages en attente par canal """
+        return {nom: file.qsize() for nom, file in self.files.items()}
+
+    def arrete(self, delai=None):
+        """ envoie les messages en attente puis arrête les threads, au plus
+        delai secondes ; les messages restants restent dans le spool. Un
+        message en attente d'un nouvel essai est retenté aussitôt, puis
+        chaque message de la file une seule fois.
+        """
+        fin = None if delai is None else time.monotonic() + delai
+        self._arret.set()
+        for file in self.files.values():
+            try:
+                file.put(None, timeout=None if fin is None
+                         else max(0, fin - time.monotonic()))
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(None if fin is None
+                        else max(0, fin - time.monotonic()))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Publication des mesures du démon dans un fichier projeté en mémoire.
+Le démon écrit chaque mesure dans un tampon circulaire protégé par un
+compteur de séquence (seqlock) : le serveur web et tout autre lecteur
+obtiennent la dernière mesure sans accès au bus I2C et sans verrou.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import collections
+import itertools
+import mmap
+import os
+import struct
+import time
+
+FICHIER = "/dev/shm/garage"
+NB_MESURES = 256
+
+_MAGIQUE = b"GARG"
+_VERSION = 1
+# magique, version, nombre d'emplacements, taille d'une mesure,
+# séquence, nombre de mesures écrites
+_ENTETE = struct.Struct("<4sIIIQQ")
+_SEQUENCE = 16
+_COMPTEUR = 24
+_ENTIER = struct.Struct("<Q")
+# horodatage, canal 0, canal 1, lux, nom du capteur, état
+_MESURE = struct.Struct("<dIId16s16s")
+# lectures tentées pendant une écriture avant d'abandonner, attente avant
+# la deuxième (s), doublée à chaque fois : 0,1 s au total
+ESSAIS = 10
+PAUSE = 0.0001
+
+Mesure = collections.namedtuple("Mesure",
+                                "horodatage broadband ir lux nom etat")
+
+
+class EcritureInterrompue(OSError):
+    """ séquence impaire trop longtemps : le démon s'est sans doute arrêté
+    au milieu d'une publication
+    """
+
+
+def _texte(octets):
+    return octets.rstrip(b"\x00").decode("utf-8", "replace")
+
+
+class Publication:
+    """ écriture des mesures, par le démon uniquement """
+
+    def __init__(self, fichier=FICHIER, nb_mesures=NB_MESURES):
+        taille = _ENTETE.size + nb_mesures * _MESURE.size
+        fd = os.open(fichier, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != taille:
+                os.ftruncate(fd, taille)
+            self._mm = mmap.mmap(fd, taille)
+        finally:
+            os.close(fd)
+        entete = _ENTETE.unpack_from(self._mm, 0)
+        if entete[:4] != (_MAGIQUE, _VERSION, nb_mesures, _MESURE.size) \
+                or entete[4] % 2:
+            # fichier neuf, d'un autre format ou écriture interrompue :
+            # on garde le même fichier pour les lecteurs déjà ouverts
+            self._mm[:] = bytes(taille)
+            _ENTETE.pack_into(self._mm, 0, _MAGIQUE, _VERSION, nb_mesures,
+                              _MESURE.size, 0, 0)
+        self.nb_mesures = nb_mesures
+
+    def publie(self, horodatage, broadband, ir, lux, nom, etat):
+        sequence = _ENTIER.unpack_from(self._mm, _SEQUENCE)[0]
+        compteur = _ENTIER.unpack_from(self._mm, _COMPTEUR)[0]
+        # séquence impaire : écriture en cours
+        _ENTIER.pack_into(self._mm, _SEQUENCE, sequence + 1)
+        _MESURE.pack_into(self._mm, _ENTETE.size +
+                          (compteur % self.nb_mesures) * _MESURE.size,
+                          horodatage, broadband, ir, lux,
+                          nom.encode("utf-8")[:16],
+                          etat.encode("utf-8")[:16])
+        _ENTIER.pack_into(self._mm, _COMPTEUR, compteur + 1)
+        _ENTIER.pack_into(self._mm, _SEQUENCE, sequence + 2)
+
+    def close(self):
+        self._mm.close()
+
+
+class Lecture:
+    """ lecture des mesures, par un nombre quelconque de processus """
+
+    def __init__(self, fichier=FICHIER):
+        with open(fichier, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magique, version, self.nb_mesures, taille, _, _ = \
+            _ENTETE.unpack_from(self._mm, 0)
+        if (magique, version, taille) != (_MAGIQUE, _VERSION, _MESURE.size):
+            self._mm.close()
+            raise ValueError("{} n'est pas un fichier de mesures".format(
+                fichier))
+
+    def _copie(self):
+        """ copie cohérente du nombre de mesures et du tampon ; lève
+        EcritureInterrompue si une écriture dure plus de ESSAIS tentatives
+        """
+        pause = PAUSE
+        for essai in range(ESSAIS):
+            if essai:
+                time.sleep(pause)
+                pause *= 2
+            avant = _ENTIER.unpack_from(self._mm, _SEQUENCE)[0]
+            if avant % 2:
+                continue
+            compteur = _ENTIER.unpack_from(self._mm, _COMPTEUR)[0]
+            tampon = self._mm[_ENTETE.size:]
+            if _ENTIER.unpack_from(self._mm, _SEQUENCE)[0] == avant:
+                return compteur, tampon
+        raise EcritureInterrompue("publication des mesures interrompue")
+
+    def _mesure(self, tampon, i):
+        horodatage, broadband, ir, lux, nom, etat = _MESURE.unpack_from(
+            tampon, (i % self.nb_mesures) * _MESURE.size)
+        return Mesure(horodatage, broadband, ir, lux, _texte(nom),
+                      _texte(etat))
+
+    def _parcours(self):
+        """ mesures de la plus récente à la plus ancienne """
+        compteur, tampon = self._copie()
+        for i in range(compteur - 1,
+                       max(-1, compteur - 1 - self.nb_mesures), -1):
+            yield self._mesure(tampon, i)
+
+    def nouvelles(self, depuis=None):
+        """ renvoie le nombre de mesures publiées et la liste des mesures
+        publiées après les depuis premières, de la plus ancienne à la plus
+        récente ; celles déjà écrasées dans le tampon sont perdues
+        """
+        compteur, tampon = self._copie()
+        if depuis is None:
+            return compteur, []
+        return compteur, [self._mesure(tampon, i) for i in range(
+            max(depuis, compteur - self.nb_mesures), compteur)]
+
+    def dernieres(self, nombre=None):
+        """ renvoie les dernières mesures, de la plus récente à la plus
+        ancienne
+        """
+        return list(itertools.islice(self._parcours(), nombre))
+
+    def derniere(self, nom=None):
+        """ dernière mesure, du capteur nom si précisé, ou None """
+        for mesure in self._parcours():
+            if nom is None or mesure.nom == nom:
+                return mesure
+        return None
+
+    def par_capteur(self):
+        """ dernière mesure de chaque capteur, par ordre de nom """
+        mesures = {}
+        for mesure in self.dernieres():
+            mesures.setdefault(mesure.nom, mesure)
+        return [mesures[nom] for nom in sorted(mesures)]
+
+    def close(self):
+        self._mm.close()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Profilage du démon en fonctionnement, commandé par signaux :
+- SIGUSR1 démarre un profileur par échantillonnage et tracemalloc, puis à
+  la réception suivante les arrête et écrit les piles échantillonnées (au
+  format « collapsed » de flamegraph.pl) et les principales allocations ;
+- SIGUSR2 écrit l'état courant du programme (dernières mesures, files
+  d'attente, ponctualité des lectures) sans l'interrompre.
+
+Les fichiers sont écrits dans le répertoire des journaux, datés :
+  kill -USR1 $(cat /var/run/garage/garage.pid)
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+import metriques
+
+REPERTOIRE = "/var/log/garage"
+# intervalle entre deux échantillons (s)
+INTERVALLE = 0.01
+# profondeur des piles gardées par tracemalloc
+PROFONDEUR = 10
+# nombre de lignes d'allocation écrites
+ALLOCATIONS = 30
+
+logger = logging.getLogger('Garage')
+
+
+def _nom_fichier(repertoire, prefixe, extension):
+    return os.path.join(repertoire, "{}-{}.{}".format(
+        prefixe, time.strftime("%Y%m%d-%H%M%S"), extension))
+
+
+def _cadre(code):
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class Echantillonneur(threading.Thread):
+    """ relève périodiquement la pile de chaque thread ; le coût ne dépend
+    que de l'intervalle, pas de ce qu'exécute le programme
+    """
+
+    def __init__(self, intervalle=INTERVALLE):
+        super().__init__(daemon=True, name="profilage")
+        self.intervalle = intervalle
+        self.piles = collections.Counter()
+        self.echantillons = 0
+        self._arret = threading.Event()
+
+    def releve(self):
+        noms = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, cadre in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            pile = []
+            while cadre is not None:
+                pile.append(_cadre(cadre.f_code))
+                cadre = cadre.f_back
+            pile.append(noms.get(ident, str(ident)))
+            self.piles[";".join(reversed(pile))] += 1
+        self.echantillons += 1
+
+    def run(self):
+        while not self._arret.wait(self.intervalle):
+            self.releve()
+
+    def arrete(self):
+        self._arret.set()
+        self.join()
+
+    def ecrit(self, fichier):
+        with open(fichier, "w", encoding="utf-8") as f:
+            for pile, nombre in self.piles.most_common():
+                f.write("{} {}\n".format(pile, nombre))
+
+
+class Profilage:
+    """ profilage et état du programme à la demande """
+
+    def __init__(self, repertoire=REPERTOIRE, etat=None,
+                 intervalle=INTERVALLE):
+        """
+        param: repertoire: répertoire des fichiers écrits
+        param: etat: fonction renvoyant l'état du programme sous forme
+            d'un dictionnaire sérialisable en JSON
+        param: intervalle: intervalle entre deux échantillons (s)
+        """
+        self.repertoire = repertoire
+        self.etat = etat
+        self.intervalle = intervalle
+        self.echantillonneur = None
+        self._debut = None
+        self._memoire = None
+
+    @property
+    def actif(self):
+        return self.echantillonneur is not None
+
+    def bascule(self):
+        """ démarre le profilage ou l'arrête et écrit ses résultats """
+        if self.actif:
+            self.arrete()
+        else:
+            self.demarre()
+
+    def demarre(self):
+        self._debut = time.monotonic()
+        # tracemalloc peut avoir été lancé par PYTHONTRACEMALLOC
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFONDEUR)
+        self._memoire = tracemalloc.take_snapshot()
+        self.echantillonneur = Echantillonneur(self.intervalle)
+        self.echantillonneur.start()
+        logger.info("Profilage démarré")
+
+    def arrete(self):
+        echantillonneur, self.echantillonneur = self.echantillonneur, None
+        echantillonneur.arrete()
+        memoire = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        duree = time.monotonic() - self._debut
+        try:
+            os.makedirs(self.repertoire, exist_ok=True)
+            piles = _nom_fichier(self.repertoire, "profil", "txt")
+            echantillonneur.ecrit(piles)
+            allocations = _nom_fichier(self.repertoire, "allocations", "txt")
+            self.ecrit_allocations(allocations, memoire, duree)
+        except OSError as e:
+            logger.error("Erreur lors de l'écriture du profil dans %s : %s",
+                         self.repertoire, e)
+            return
+        logger.info("Profilage arrêté après %.0f s (%s échantillons) : %s, "
+                    "%s", duree, echantillonneur.echantillons, piles,
+                    allocations)
+
+    def ecrit_allocations(self, fichier, memoire, duree):
+        filtres = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        memoire = memoire.filter_traces(filtres)
+        with open(fichier, "w", encoding="utf-8") as f:
+            f.write("# allocations en cours après {:.0f} s de "
+                    "profilage\n".format(duree))
+            for stat in memoire.statistics("lineno")[:ALLOCATIONS]:
+                f.write("{}\n".format(stat))
+            f.write("\n# variation depuis le début du profilage\n")
+            debut = self._memoire.filter_traces(filtres)
+            for stat in memoire.compare_to(debut, "lineno")[:ALLOCATIONS]:
+                f.write("{}\n".format(stat))
+            f.write("\n# piles des {} principales allocations\n".format(
+                ALLOCATIONS // 3))
+            for stat in memoire.statistics("traceback")[:ALLOCATIONS // 3]:
+                f.write("{} blocs, {:.1f} Kio\n".format(stat.count,
+                                                      stat.size / 1024))
+                f.write("\n".join(stat.traceback.format()) + "\n")
+
+    def ecrit_etat(self):
+        """ écrit l'état courant du programme """
+        etat = {
+            "horodatage": time.time(),
+            "pid": os.getpid(),
+            # ko sous Linux
+            "memoire_max_ko": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            "threads": sorted(thread.name
+                              for thread in threading.enumerate()),
+            "profilage": self.actif,
+        }
+        try:
+            etat["taches"] = len(asyncio.all_tasks())
+        except RuntimeError:
+            # hors de la boucle d'événements
+            pass
+        if self.etat is not None:
+            etat.update(self.etat())
+        try:
+            os.makedirs(self.repertoire, exist_ok=True)
+            fichier = _nom_fichier(self.repertoire, "etat", "json")
+            with open(fichier, "w", encoding="utf-8") as f:
+                json.dump(etat, f, indent=2, ensure_ascii=False,
+                          default=str)
+        except OSError as e:
+            logger.error("Erreur lors de l'écriture de l'état dans %s : %s",
+                         self.repertoire, e)
+            return
+        logger.info("État écrit dans %s", fichier)
+
+
+def etat_capteur(capteur):
+    """ dernière mesure, réglage et ponctualité d'un capteur """
+    cadence = capteur.cadence
+    tsl = capteur.tsl
+    lectures, duree = 0, 0.0
+    for etiquettes, (comptes, somme) in metriques.LECTURE_DUREE.valeurs():
+        if etiquettes == (capteur.nom,):
+            lectures, duree = sum(comptes), somme
+    return {
+        "nom": capteur.nom,
+        "lux": capteur.lux,
+        "etat": capteur.porte.etat,
+        "malade": capteur.porte.malade,
+        "horodatage": capteur.horodatage,
+        "canaux": tsl.last_channels,
+        "gain": tsl.gain(),
+        "integration_ms": tsl.integration_time(),
+        "automatique": capteur.automatique,
+        "transactions_i2c": tsl.transactions,
+        "saturations": tsl.saturations,
+        "lecture_moyenne_ms": duree * 1000 / lectures if lectures else None,
+        "cadence": {
+            "periode": cadence.periode,
+            "intervalle": cadence.intervalle,
+            "lectures": cadence.lectures,
+            "manquees": cadence.manquees,
+            "gigue_moyenne_ms": cadence.gigue_totale * 1000 /
+            max(1, cadence.lectures),
+            "gigue_max_ms": cadence.gigue_max * 1000,
+        },
+    }
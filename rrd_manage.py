@@ -19,32 +19,212 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
-import rrdtool
 import os
 import sys
 import configparser
 import argparse
 import logging
+import math
+import time
 from datetime import datetime
+import serie
+try:
+    import rrdtool
+except ImportError:
+    rrdtool = None
 
 FICH_CONFIG = '/etc/garage.conf'
+JOUR = 86400
+# archives consolidées : (durée d'un point, durée conservée) en secondes.
+# Chaque graphique trouve une archive d'environ un point par pixel : mesures
+# brutes pour le jour, points horaires pour le mois, journaliers pour l'année
+ARCHIVES = ((None, 7 * JOUR), (3600, 62 * JOUR), (JOUR, 5 * 366 * JOUR))
+CONSOLIDATIONS = ("AVERAGE", "MIN", "MAX")
+# nombre de mesures par appel à rrdtool.update lors d'une migration
+LOT_MIGRATION = 1000
 
 
 class Args:
     pass
 
 
-def cree_rrd_database(db_file, step):
-    nb_points = int(7 * 60 * 24 * 20 / step)
+def definitions_rrd(step):
+    """ source de données et archives de la base, pour une mesure toutes
+    les step secondes
+    """
+    pas_rrd = step * 3
     heart_beat = int(3 * step)
+    # luminosité (x100), valeurs brutes des deux canaux du capteur et
+    # réglage (gain, temps d'intégration en ms) avec lequel elles sont lues
     data_sources = ["DS:lumin:GAUGE:{}:0:U".format(heart_beat),
-                    "RRA:MAX:0.9:1:{}".format(nb_points),
-                    ]
-    rrdtool.create(db_file, "--step", str(step*3), data_sources)
+                    "DS:ch0:GAUGE:{}:0:65535".format(heart_beat),
+                    "DS:ch1:GAUGE:{}:0:65535".format(heart_beat),
+                    "DS:gain:GAUGE:{}:1:16".format(heart_beat),
+                    "DS:integ:GAUGE:{}:13:402".format(heart_beat)]
+    for duree_point, duree in ARCHIVES:
+        nb_pas = max(1, (duree_point or pas_rrd) // pas_rrd)
+        nb_points = int(duree / (nb_pas * pas_rrd))
+        data_sources.extend("RRA:{}:0.5:{}:{}".format(fonction, nb_pas,
+                                                     nb_points)
+                            for fonction in CONSOLIDATIONS)
+    return pas_rrd, data_sources
+
+
+def cree_rrd_database(db_file, step, debut=None):
+    pas_rrd, data_sources = definitions_rrd(step)
+    options = ["--step", str(pas_rrd)]
+    if debut is not None:
+        options += ["--start", str(int(debut))]
+    rrdtool.create(db_file, *options, *data_sources)
     logging.debug("Base de données {} créée.".format(db_file))
     logging.debug("Data sources : {}".format(data_sources))
 
 
+def migre_rrd_database(db_file, step):
+    """ reconstruit la base avec les archives de cree_rrd_database à partir
+    des mesures de l'ancienne base, gardée sous le nom db_file.old
+    """
+    infos = rrdtool.info(db_file)
+    # archive la plus fine de l'ancienne base
+    rra = min((infos["rra[{}].pdp_per_row".format(i)], i)
+              for i in range(len([k for k in infos
+                                  if k.endswith(".pdp_per_row")])))[1]
+    fonction = infos["rra[{}].cf".format(rra)]
+    pas = infos["step"] * infos["rra[{}].pdp_per_row".format(rra)]
+    fin = infos["last_update"]
+    debut = fin - pas * infos["rra[{}].rows".format(rra)]
+    (debut, fin, pas), sources, lignes = rrdtool.fetch(
+        db_file, fonction, "--resolution", str(pas),
+        "--start", str(debut), "--end", str(fin))
+    points = ["{}:{}".format(debut + (i + 1) * pas, ":".join(
+        "U" if valeur is None else str(valeur) for valeur in ligne))
+              for i, ligne in enumerate(lignes)
+              if any(valeur is not None for valeur in ligne)]
+    logging.info("{} mesures ({}) reprises de {}".format(len(points),
+                                                         fonction, db_file))
+    nouvelle = db_file + ".new"
+    if os.path.exists(nouvelle):
+        os.remove(nouvelle)
+    cree_rrd_database(nouvelle, step, debut)
+    for i in range(0, len(points), LOT_MIGRATION):
+        rrdtool.update(nouvelle, "--template", ":".join(sources),
+                       *points[i:i + LOT_MIGRATION])
+    os.replace(db_file, db_file + ".old")
+    os.replace(nouvelle, db_file)
+    logging.info("Base de données {} migrée, ancienne base conservée dans "
+                 "{}.old".format(db_file, db_file))
+
+
+def consolidations(db_file):
+    """ fonctions de consolidation des archives de la base """
+    infos = rrdtool.info(db_file)
+    return {valeur for cle, valeur in infos.items()
+            if cle.startswith("rra[") and cle.endswith("].cf")}
+
+
+def mesure_graphes(db_file, repetitions=5):
+    """ temps moyen de tracé en ms des graphiques du jour, du mois et de
+    l'année, sans cache, et fonction de consolidation tracée : AVERAGE,
+    ou celle de la base si elle n'a pas encore été migrée. Le temps d'un
+    graphique que rrdtool ne peut pas tracer est le message d'erreur.
+    """
+    from graphes import Graphes, PERIODES
+    fonctions = consolidations(db_file)
+    consolidation = "AVERAGE" if "AVERAGE" in fonctions or not fonctions \
+        else sorted(fonctions)[0]
+    graphes = Graphes(db_file, taille_cache=0, consolidation=consolidation)
+    temps = {}
+    for periode in PERIODES:
+        debut = time.perf_counter()
+        try:
+            for _ in range(repetitions):
+                graphes.periode(periode)
+        except rrdtool.OperationalError as e:
+            temps[periode] = str(e)
+            continue
+        temps[periode] = (time.perf_counter() - debut) * 1000 / repetitions
+    return temps, consolidation
+
+
+def affiche_mesures(db_file, repetitions):
+    temps, consolidation = mesure_graphes(db_file, repetitions)
+    if consolidation != "AVERAGE":
+        print("Pas d'archive AVERAGE : graphiques tracés avec "
+              "{}".format(consolidation))
+    for periode, duree in temps.items():
+        if isinstance(duree, str):
+            print("Graphique {:6} : erreur : {}".format(periode, duree))
+        else:
+            print("Graphique {:6} : {:8.1f} ms".format(periode, duree))
+
+
+def recalcule(db_file, boitier, gain, integration, debut="end-7days"):
+    """ recalcule la luminosité à partir des valeurs brutes enregistrées,
+    pour un autre boîtier ou pour vérifier les valeurs enregistrées. Chaque
+    mesure est convertie avec le réglage enregistré avec elle, ou à défaut
+    (base créée avant) avec gain et integration
+    """
+    import tsl2561
+    from historique import ECHELLE, historique
+    classe = getattr(tsl2561, "TSL2561" + boitier)
+    dates, lumin, broadband, ir, gains, integrations = \
+        historique(db_file).canaux(debut, "now")
+    broadband = list(broadband)
+    for i, (gain_lu, integration_lue) in enumerate(zip(gains,
+                                                        integrations)):
+        if gain_lu != gain_lu or integration_lue != integration_lue:
+            gains[i], integrations[i] = gain, integration
+        elif gain_lu not in (1, 16) or \
+                integration_lue not in tsl2561._INTEGRATION_TIME:
+            # réglages différents moyennés dans un même point
+            broadband[i] = math.nan
+            gains[i], integrations[i] = gain, integration
+        else:
+            integrations[i] = int(integration_lue)
+    chrono = time.perf_counter()
+    lux = classe.lux_array(broadband, ir, gains, integrations)
+    duree = time.perf_counter() - chrono
+    ecarts = [abs(calcul - valeur / ECHELLE)
+              for calcul, valeur in zip(lux, lumin)
+              if calcul == calcul and valeur == valeur]
+    print("{} mesures recalculées en {:.1f} ms{}".format(
+        len(dates), duree * 1000,
+        " (numpy)" if tsl2561.numpy is not None else ""))
+    if ecarts:
+        print("Écart maximal avec les valeurs enregistrées : {:.3f} "
+              "lux".format(max(ecarts)))
+    return dates, lux
+
+
+def cree_serie(db_file, step):
+    """ crée la base en pur Python utilisée à la place de rrdtool """
+    fichier = serie.fichier_serie(db_file)
+    base = serie.SerieTemporelle.cree(fichier, niveaux=serie.niveaux(step))
+    logging.debug("Base de données {} créée.".format(fichier))
+    logging.debug("Archives : {}".format([(archive.pas, archive.nb)
+                                          for archive in base.archives]))
+    base.close()
+
+
+def info_serie(db_file):
+    fichier = serie.fichier_serie(db_file)
+    if not os.path.exists(fichier):
+        print("La base de données {} n'existe pas".format(fichier))
+        return
+    base = serie.SerieTemporelle(fichier)
+    print("Informations sur la base de données {}".format(fichier))
+    for archive in base.archives:
+        print("Archive : pas de {} s, {} points".format(archive.pas,
+                                                        archive.nb))
+    mise_a_jour = base.mise_a_jour()
+    if mise_a_jour:
+        derniere = base.lit(mise_a_jour, mise_a_jour,
+                            consolidation="derniere")[0][1]
+        print("Dernière mise à jour :", datetime.fromtimestamp(mise_a_jour),
+              "avec la valeur", derniere)
+    base.close()
+
+
 if __name__ == '__main__':
     config = configparser.ConfigParser()
     config.read(FICH_CONFIG, encoding='utf-8')
@@ -70,6 +250,21 @@ if __name__ == '__main__':
     parser.add_argument("-i", "--info",
                         action="store_true",
                         help="informations sur la base de données")
+    parser.add_argument("-m", "--migrate",
+                        action="store_true",
+                        help="reconstruire la base de données avec les "
+                             "archives consolidées actuelles")
+    parser.add_argument("-r", "--replay",
+                        nargs="?", const="end-7days", default=None,
+                        metavar="DEBUT",
+                        help="recalculer la luminosité depuis DEBUT à "
+                             "partir des valeurs brutes enregistrées")
+    parser.add_argument("-b", "--bench",
+                        nargs="?", type=int, const=5, default=None,
+                        metavar="N",
+                        help="mesurer le temps de tracé des graphiques "
+                             "(moyenne sur N tracés, avant et après la "
+                             "migration avec --migrate)")
     args = Args()
     parser.parse_args(namespace=args)
     if args.log_level:
@@ -90,10 +285,45 @@ if __name__ == '__main__':
     if args.create:
         logging.debug("Argument create : {}".format(args.create))
         step = int(config["Temps"]["delay"])
-        cree_rrd_database(db_file, step)
+        if rrdtool is None:
+            logging.info("Module rrdtool absent : création d'une base en "
+                         "pur Python")
+            cree_serie(db_file, step)
+        else:
+            cree_rrd_database(db_file, step)
+    if args.replay:
+        try:
+            recalcule(db_file, config.get("Capteur", "boitier",
+                                          fallback="T").upper(),
+                      config.getint("Capteur", "gain", fallback=1),
+                      config.getint("Capteur", "integration",
+                                    fallback=402),
+                      args.replay)
+        except ValueError as e:
+            logging.error(e)
+            sys.exit(1)
+    if (args.migrate or args.bench) and rrdtool is None:
+        logging.error("Module rrdtool absent : la base en pur Python a "
+                      "déjà des archives consolidées")
+        sys.exit(1)
+    if args.bench:
+        print("Tracé des graphiques depuis {}".format(db_file))
+        try:
+            affiche_mesures(db_file, args.bench)
+        except rrdtool.OperationalError as e:
+            # la migration a lieu quand même
+            logging.error("Mesure impossible : {}".format(e))
+    if args.migrate:
+        logging.debug("Argument migrate : {}".format(args.migrate))
+        migre_rrd_database(db_file, int(config["Temps"]["delay"]))
+        if args.bench:
+            print("Après migration :")
+            affiche_mesures(db_file, args.bench)
     if args.info:
         logging.debug("Argument info: {}".format(args.info))
-        if os.path.exists(db_file):
+        if rrdtool is None:
+            info_serie(db_file)
+        elif os.path.exists(db_file):
             print("Informations sur la base de données {}".format(db_file))
             infos = rrdtool.info(db_file)
             print("Dernière mise à jour :", datetime.fromtimestamp(infos["last_update"]), "avec la valeur", infos["ds[lumin].last_ds"])
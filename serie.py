@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Base de données tournante en pur Python, utilisée lorsque le module
+rrdtool n'est pas installé. Le fichier, de taille fixe, est projeté en
+mémoire. Il contient plusieurs archives circulaires de résolutions
+différentes (mesures brutes, par minute, par heure) mises à jour à chaque
+ajout ; une lecture ne parcourt que les points demandés.
+
+Chaque case d'une archive contient le début de l'intervalle qu'elle
+représente, le nombre de mesures et, pour chaque valeur, la somme, le
+minimum, le maximum et la dernière mesure de l'intervalle.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import math
+import mmap
+import os
+import struct
+
+_MAGIQUE = b"GSER"
+_VERSION = 1
+# magique, version, nombre de valeurs, nombre d'archives, dernière mise à
+# jour ; puis le nom de chaque valeur et (pas, nombre de cases) de chaque
+# archive
+_ENTETE = struct.Struct("<4sIIId")
+_NOM = struct.Struct("<16s")
+_ARCHIVE = struct.Struct("<II")
+_DOUBLE = 8
+_MISE_A_JOUR = 16
+
+# (pas en secondes, durée conservée en secondes) de chaque archive ; le pas
+# de la première est celui des mesures
+JOUR = 86400
+NIVEAUX = ((20, 7 * JOUR), (60, 31 * JOUR), (3600, 5 * 365 * JOUR))
+
+# luminosité et valeurs brutes des deux canaux du capteur
+CHAMPS = ("lumin", "ch0", "ch1", "gain", "integ")
+CONSOLIDATIONS = {"moyenne": 0, "min": 1, "max": 2, "derniere": 3}
+_SOMME, _MIN, _MAX, _DERNIERE = range(4)
+
+
+class Archive:
+    """ une résolution de la base : nb cases de pas secondes """
+
+    def __init__(self, pas, nb, debut, nb_champs):
+        self.pas = pas
+        self.nb = nb
+        # position de la première case (en nombre de doubles) et taille
+        # d'une case
+        self.debut = debut
+        self.taille_case = 2 + 4 * nb_champs
+
+    def case(self, intervalle):
+        return self.debut + (intervalle % self.nb) * self.taille_case
+
+
+class SerieTemporelle:
+    """ base de données tournante projetée en mémoire """
+
+    def __init__(self, fichier):
+        self.fichier = fichier
+        with open(fichier, "r+b") as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+        magique, version, nb_champs, nb_archives, _ = \
+            _ENTETE.unpack_from(self._mm, 0)
+        if (magique, version) != (_MAGIQUE, _VERSION):
+            self._mm.close()
+            raise ValueError("{} n'est pas une base de mesures".format(
+                fichier))
+        position = _ENTETE.size
+        self.champs = []
+        for _ in range(nb_champs):
+            nom, = _NOM.unpack_from(self._mm, position)
+            self.champs.append(nom.rstrip(b"\x00").decode("utf-8"))
+            position += _NOM.size
+        definitions = []
+        for _ in range(nb_archives):
+            definitions.append(_ARCHIVE.unpack_from(self._mm, position))
+            position += _ARCHIVE.size
+        self._valeurs = memoryview(self._mm).cast("d")
+        debut = _taille_entete(nb_champs, nb_archives) // _DOUBLE
+        self.archives = []
+        for pas, nb in definitions:
+            archive = Archive(pas, nb, debut, nb_champs)
+            self.archives.append(archive)
+            debut += nb * archive.taille_case
+
+    @classmethod
+    def cree(cls, fichier, champs=CHAMPS, niveaux=NIVEAUX):
+        """ crée une base vide ; niveaux donne (pas, durée conservée) de
+        chaque archive, en secondes
+        """
+        archives = [(pas, max(1, math.ceil(duree / pas)))
+                    for pas, duree in niveaux]
+        entete = bytearray(_taille_entete(len(champs), len(archives)))
+        taille = len(entete) + _DOUBLE * sum(
+            nb * (2 + 4 * len(champs)) for _, nb in archives)
+        _ENTETE.pack_into(entete, 0, _MAGIQUE, _VERSION, len(champs),
+                          len(archives), 0)
+        position = _ENTETE.size
+        for nom in champs:
+            _NOM.pack_into(entete, position, nom.encode("utf-8"))
+            position += _NOM.size
+        for archive in archives:
+            _ARCHIVE.pack_into(entete, position, *archive)
+            position += _ARCHIVE.size
+        with open(fichier + ".tmp", "wb") as f:
+            f.write(entete)
+            f.truncate(taille)
+        os.replace(fichier + ".tmp", fichier)
+        return cls(fichier)
+
+    def mise_a_jour(self):
+        """ date de la dernière mesure ajoutée """
+        return self._valeurs[_MISE_A_JOUR // _DOUBLE]
+
+    def ajoute(self, horodatage, *valeurs):
+        """ ajoute une mesure prise à la date horodatage (secondes) dans
+        toutes les archives
+        """
+        if len(valeurs) != len(self.champs):
+            raise ValueError("{} valeurs attendues".format(len(self.champs)))
+        v = self._valeurs
+        for archive in self.archives:
+            intervalle = int(horodatage // archive.pas)
+            case = archive.case(intervalle)
+            if v[case] != intervalle * archive.pas or not v[case + 1]:
+                # case d'un intervalle précédent : on la recycle
+                v[case] = intervalle * archive.pas
+                v[case + 1] = 1
+                for i, valeur in enumerate(valeurs):
+                    p = case + 2 + 4 * i
+                    v[p] = v[p + 1] = v[p + 2] = v[p + 3] = valeur
+                continue
+            v[case + 1] += 1
+            for i, valeur in enumerate(valeurs):
+                p = case + 2 + 4 * i
+                v[p + _SOMME] += valeur
+                if valeur < v[p + _MIN]:
+                    v[p + _MIN] = valeur
+                if valeur > v[p + _MAX]:
+                    v[p + _MAX] = valeur
+                v[p + _DERNIERE] = valeur
+        v[_MISE_A_JOUR // _DOUBLE] = max(horodatage, self.mise_a_jour())
+
+    def archive(self, debut, pas=None):
+        """ archive qui contient encore la date debut, de pas le plus
+        proche de pas sans le dépasser (la plus fine si pas vaut None)
+        """
+        fin = self.mise_a_jour()
+        choix = None
+        for archive in self.archives:
+            if fin - debut > archive.pas * archive.nb:
+                continue
+            if choix is None or pas is not None and archive.pas <= pas:
+                choix = archive
+            if pas is None or archive.pas >= pas:
+                break
+        return choix if choix is not None else self.archives[-1]
+
+    def lit(self, debut, fin, pas=None, consolidation="moyenne", champ=0):
+        """ renvoie la liste des (date, valeur) entre debut et fin, avec
+        None pour les intervalles sans mesure. La résolution est celle de
+        l'archive choisie par archive(debut, pas).
+        """
+        return list(self.parcours(debut, fin, pas, consolidation, champ))
+
+    def parcours(self, debut, fin, pas=None, consolidation="moyenne",
+                 champ=0):
+        """ comme lit, mais produit les points un à un """
+        archive = self.archive(debut, pas)
+        fonction = CONSOLIDATIONS[consolidation]
+        v = self._valeurs
+        decalage = 2 + 4 * champ
+        for intervalle in range(int(debut // archive.pas),
+                                int(fin // archive.pas) + 1):
+            date = intervalle * archive.pas
+            case = archive.case(intervalle)
+            if v[case] != date or not v[case + 1]:
+                yield date, None
+            elif fonction == 0:
+                yield date, v[case + decalage] / v[case + 1]
+            else:
+                yield date, v[case + decalage + fonction]
+
+    def close(self):
+        self._valeurs.release()
+        self._mm.close()
+
+
+def _taille_entete(nb_champs, nb_archives):
+    taille = _ENTETE.size + nb_champs * _NOM.size + nb_archives * _ARCHIVE.size
+    return (taille + _DOUBLE - 1) // _DOUBLE * _DOUBLE
+
+
+def niveaux(pas):
+    """ archives par défaut pour des mesures toutes les pas secondes """
+    return ((pas, NIVEAUX[0][1]),) + tuple(
+        niveau for niveau in NIVEAUX[1:] if niveau[0] > pas)
+
+
+def fichier_serie(base):
+    """ fichier de la base en pur Python qui remplace la base rrd base """
+    return os.path.splitext(base)[0] + ".serie"
+
+
+def ouvre(fichier, pas=NIVEAUX[0][0], champs=CHAMPS):
+    """ ouvre la base fichier, en la créant si elle n'existe pas """
+    if os.path.exists(fichier):
+        return SerieTemporelle(fichier)
+    return SerieTemporelle.cree(fichier, champs, niveaux(pas))
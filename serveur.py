@@ -3,6 +3,8 @@
 """
 Serveur HTTP minimal pour obtenir la mesure de luminosité.
 Peut être placé derrière un stunnel pour assurer le contrôle d'accès.
+Les mesures sont lues dans le fichier publié par garage.py : le serveur
+n'accède jamais au capteur.
 
 Copyright (C) 2018  christophe Nanteuil <christophe.nanteuil@gmail.com>
 
@@ -20,77 +22,583 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import configparser
-from smbus2 import SMBus
-from tsl2561 import TSL2561
+import email.utils
+import json
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+from partage import EcritureInterrompue, Lecture, \
+    FICHIER as FICHIER_PARTAGE
+from graphes import Graphes, GraphesSerie, LARGEUR, HAUTEUR, rrdtool
+from daemon3x import listen_fds, reexec, sd_notify, watchdog_interval
+from historique import historique
+import metriques
+from serie import fichier_serie
 import sys
+import urllib.parse
+import zlib
 
-ERR_I2C = 1
-ERR_TSL = 2
 ERR_CONFIG = 3
 FICH_CONFIG = "/etc/garage.conf"
+# graphiques des périodes prédéfinies, servis avec l'extension de leur
+# format (graphes.extension) : /garage_jour.png ou /garage_jour.svg
+GRAPHES = {'/garage_jour': 'jour',
+           '/garage_mois': 'mois',
+           '/garage_annee': 'annee'}
+PREFIXE_CAPTEUR = "Capteur:"
+# nombre de points de l'historique envoyés par morceau
+POINTS_PAR_MORCEAU = 256
+# délai laissé aux requêtes en cours à l'arrêt ou à la relance (s)
+ARRET = 5
+
+# lecteur des mesures publiées par garage.py, ouvert à la première requête
+fichier_partage = FICHIER_PARTAGE
+lecture = None
+# graphiques tracés à la demande, par rrdtool ou depuis la base en pur
+# Python
+graphes = None
+# base de données de chaque capteur, pour /api/history ; l'historique est
+# ouvert à la première requête
+bases = {}
+historiques = {}
+# métriques écrites par garage.py, ajoutées à celles du serveur
+fichier_metriques = metriques.FICHIER
+# adresses suivies séparément dans les métriques, les autres sont comptées
+# ensemble
+CHEMINS = {chemin + extension for chemin in list(GRAPHES) + ['/graphe']
+           for extension in ('.png', '.svg')} | {
+               '/', '/api/current', '/api/history', '/api/stream',
+               '/favicon.ico', '/metrics'}
+
+
+class ServeurConcurrent(HTTPServer):
+    """ serveur HTTP dont les connexions sont traitées par un nombre borné
+    de threads ; au-delà de threads + file connexions en cours, les
+    nouvelles connexions attendent dans la file du système
+    """
+    daemon_threads = True
+
+    def __init__(self, adresse, gestionnaire, threads=8, file=32,
+                 journal=True, fd=None):
+        """
+        param: fd: socket d'écoute héritée (relance ou activation par
+            systemd), à la place d'une nouvelle socket sur adresse
+        """
+        super().__init__(adresse, gestionnaire, bind_and_activate=fd is None)
+        if fd is not None:
+            self.socket.close()
+            self.socket = socket.socket(fileno=fd)
+            self.server_address = self.socket.getsockname()
+            hote, port = self.server_address[:2]
+            self.server_name = socket.getfqdn(hote)
+            self.server_port = port
+        self.journal = journal
+        self.pool = ThreadPoolExecutor(max_workers=threads,
+                                       thread_name_prefix="http")
+        self.places = threading.BoundedSemaphore(threads + file)
+        self.en_cours = 0
+        self._fin = threading.Condition()
+        # arrêt demandé : None, "arret" ou "relance"
+        self.demande = None
+        self.chien_de_garde = watchdog_interval()
+        self._battement = 0
+
+    def process_request(self, request, client_address):
+        self.places.acquire()
+        with self._fin:
+            self.en_cours += 1
+        self.pool.submit(self._traite, request, client_address)
+
+    def _traite(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.places.release()
+            with self._fin:
+                self.en_cours -= 1
+                self._fin.notify_all()
+
+    def service_actions(self):
+        # appelé par serve_forever au moins toutes les 0,5 s : le chien de
+        # garde n'est prévenu que si le serveur accepte les connexions
+        if self.chien_de_garde is not None and \
+                time.monotonic() >= self._battement:
+            sd_notify("WATCHDOG=1")
+            self._battement = time.monotonic() + self.chien_de_garde
+
+    def demande_arret(self, demande):
+        """ fin de serve_forever, appelable depuis un gestionnaire de
+        signal : shutdown attend la fin de serve_forever, il est appelé
+        depuis un autre thread
+        """
+        if self.demande is None:
+            self.demande = demande
+            sd_notify("STOPPING=1" if demande == "arret" else "RELOADING=1")
+            threading.Thread(target=self.shutdown).start()
+
+    def attend(self, delai):
+        """ attend au plus delai secondes la fin des connexions en cours ;
+        renvoie le nombre de connexions restantes. Les connexions
+        persistantes inactives et les flux /api/stream sont coupés au-delà
+        """
+        fin = time.monotonic() + delai
+        with self._fin:
+            while self.en_cours and time.monotonic() < fin:
+                self._fin.wait(fin - time.monotonic())
+            return self.en_cours
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+Fichier = collections.namedtuple("Fichier",
+                                 "mtime taille etag date contenu")
+
+
+class CacheFichiers:
+    """ contenu des fichiers servis, relu lorsque leur date de
+    modification change
+    """
+
+    def __init__(self, taille_max=1 << 20, duree=60):
+        """
+        param: taille_max: taille au-delà de laquelle un fichier n'est pas
+            gardé en mémoire mais envoyé par sendfile
+        param: duree: durée de validité annoncée aux navigateurs (s)
+        """
+        self.taille_max = taille_max
+        self.duree = duree
+        self._fichiers = {}
+        self._verrou = threading.Lock()
+
+    def lit(self, nom):
+        infos = os.stat(nom)
+        with self._verrou:
+            fichier = self._fichiers.get(nom)
+        if fichier is not None and fichier.mtime == infos.st_mtime and \
+                fichier.taille == infos.st_size:
+            return fichier
+        etag = '"{:x}-{:x}"'.format(infos.st_mtime_ns, infos.st_size)
+        date = email.utils.formatdate(infos.st_mtime, usegmt=True)
+        if infos.st_size > self.taille_max:
+            return Fichier(infos.st_mtime, infos.st_size, etag, date, None)
+        with open(nom, mode='rb') as fich:
+            contenu = fich.read()
+        fichier = Fichier(infos.st_mtime, len(contenu), etag, date, contenu)
+        if len(contenu) == infos.st_size:
+            # sinon, fichier en cours de réécriture : il sera relu
+            with self._verrou:
+                self._fichiers[nom] = fichier
+        return fichier
+
+
+cache_fichiers = CacheFichiers()
+
+
+class Diffusion:
+    """ un seul thread lit les nouvelles mesures dans le fichier partagé et
+    les transmet à tous les abonnés de /api/stream. Il s'arrête quand il
+    n'y a plus d'abonné.
+    """
+
+    def __init__(self, periode=1.0, max_abonnes=4, taille=64):
+        """
+        param: periode: intervalle en secondes entre deux lectures
+        param: max_abonnes: nombre maximal de flux ouverts en même temps
+        param: taille: nombre d'événements en attente pour un abonné ; un
+            abonné trop lent est déconnecté
+        """
+        self.periode = periode
+        self.max_abonnes = max_abonnes
+        self.taille = taille
+        self._abonnes = set()
+        self._verrou = threading.Lock()
+        self._thread = None
+
+    def abonne(self):
+        """ renvoie la file des événements du nouvel abonné, ou None s'il y
+        a déjà max_abonnes abonnés
+        """
+        with self._verrou:
+            if len(self._abonnes) >= self.max_abonnes:
+                return None
+            file = queue.Queue(self.taille)
+            self._abonnes.add(file)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._produit,
+                                                name="diffusion",
+                                                daemon=True)
+                self._thread.start()
+        return file
+
+    def desabonne(self, file):
+        with self._verrou:
+            self._abonnes.discard(file)
+
+    def _diffuse(self, evenement):
+        with self._verrou:
+            abonnes = list(self._abonnes)
+        for file in abonnes:
+            try:
+                file.put_nowait(evenement)
+            except queue.Full:
+                # abonné trop lent : on libère une place pour le prévenir
+                self.desabonne(file)
+                try:
+                    file.get_nowait()
+                except queue.Empty:
+                    pass
+                file.put_nowait(None)
+
+    def _produit(self):
+        compteur = None
+        etats = {}
+        while True:
+            time.sleep(self.periode)
+            with self._verrou:
+                if not self._abonnes:
+                    self._thread = None
+                    return
+            try:
+                if compteur is None:
+                    etats = {mesure.nom: mesure.etat
+                             for mesure in lecteur().par_capteur()}
+                compteur, nouvelles = lecteur().nouvelles(compteur)
+            except (OSError, ValueError):
+                continue
+            for mesure in nouvelles:
+                donnees = json.dumps(mesure._asdict())
+                self._diffuse(evenement("mesure", donnees))
+                if mesure.nom in etats and etats[mesure.nom] != mesure.etat:
+                    self._diffuse(evenement("etat", donnees))
+                etats[mesure.nom] = mesure.etat
+
+
+def evenement(nom, donnees):
+    """ événement au format server-sent events """
+    return "event: {}\ndata: {}\n\n".format(nom, donnees).encode("utf-8")
+
+
+diffusion = Diffusion()
 
 
 class mon_serveur(BaseHTTPRequestHandler):
+    # connexions persistantes ; une connexion inactive est fermée après
+    # timeout secondes
+    protocol_version = "HTTP/1.1"
+    timeout = 10
+    # entête et contenu sont écrits séparément : sans cela, l'algorithme
+    # de Nagle retarde chaque réponse sur une connexion persistante
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.journal:
+            super().log_message(format, *args)
+
+    def send_response(self, code, message=None):
+        self.code = code
+        super().send_response(code, message)
 
     def serve_image(self, filename):
         if 'garage' in filename:
             filename = '/var/log/garage' + filename
         else:
             filename = '.' + filename
+        try:
+            fichier = cache_fichiers.lit(filename)
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        if self.envoie(fichier):
+            return
+        # fichier trop gros pour le cache : copie par le noyau
         try:
             with open(filename, mode='rb') as fich:
-                contenu = fich.read()
+                self.connection.sendfile(fich, count=fichier.taille)
         except FileNotFoundError:
-            self.send_response(404)
+            self.close_connection = True
+
+    def envoie(self, fichier, type_contenu="image/png"):
+        """ envoie l'entête et le contenu s'il est en mémoire, ou seulement
+        l'entête ; renvoie True si la réponse est complète
+        """
+        if self.non_modifie(fichier):
+            self.send_response(304)
+            self.entetes_cache(fichier)
+            self.end_headers()
+            return True
+        self.send_response(200)
+        self.send_header("Content-type", type_contenu)
+        self.send_header("Content-length", fichier.taille)
+        self.entetes_cache(fichier)
+        self.end_headers()
+        if fichier.contenu is None:
+            return False
+        self.wfile.write(fichier.contenu)
+        return True
+
+    def serve_graphe(self, periode=None, parametres=None):
+        """ graphique tracé à la demande : période prédéfinie ou paramètres
+        debut, fin, largeur et hauteur de l'adresse. L'ETag ne dépend que
+        du graphique demandé : les autres paramètres (anti-cache) sont
+        ignorés.
+        """
+        try:
+            if periode is not None:
+                cle = periode
+                image = graphes.periode(periode)
+            else:
+                parametres = urllib.parse.parse_qs(parametres)
+                cle = (parametres.get("debut", ["end-1days"])[0],
+                       parametres.get("fin", ["now"])[0],
+                       int(parametres.get("largeur", [LARGEUR])[0]),
+                       int(parametres.get("hauteur", [HAUTEUR])[0]))
+                image = graphes.trace(*cle)
+        except ValueError as e:
+            self.send_error(400, explain=str(e))
+            return
+        except OSError as e:
+            self.send_error(500, explain=str(e))
+            return
+        self.envoie(Fichier(image.mise_a_jour, len(image.contenu),
+                            '"{:x}-{:x}"'.format(
+                                zlib.crc32(repr(cle).encode()),
+                                int(image.mise_a_jour)),
+                            email.utils.formatdate(image.mise_a_jour,
+                                                   usegmt=True),
+                            image.contenu), image.type)
+
+    def morceau(self, donnees):
+        """ envoie un morceau d'une réponse de longueur inconnue """
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(donnees), donnees))
+
+    def entetes_morceaux(self, type_contenu):
+        self.send_response(200)
+        self.send_header("Content-type", type_contenu)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def serve_actuel(self):
+        """ dernière mesure de chaque capteur, en JSON """
+        try:
+            capteurs = lecteur().par_capteur()
+        except (OSError, ValueError) as e:
+            self.send_error(503, explain=str(e))
             return
+        contenu = json.dumps([mesure._asdict()
+                              for mesure in capteurs]).encode("utf-8")
         self.send_response(200)
-        self.send_header("Content-type", "image/png")
+        self.send_header("Content-type", "application/json")
         self.send_header("Content-length", len(contenu))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(contenu)
+
+    def serve_historique(self, parametres):
+        """ mesures enregistrées entre start et end (dates au format
+        rrdtool), un objet JSON par ligne, envoyées au fur et à mesure de
+        leur lecture
+        """
+        parametres = urllib.parse.parse_qs(parametres)
+        try:
+            nom = parametres.get("capteur", [None])[0]
+            if nom is None and len(bases) == 1:
+                nom = next(iter(bases))
+            if nom not in bases:
+                raise ValueError("capteur inconnu : {}".format(nom))
+            pas = int(parametres.get("step", [0])[0]) or None
+            if pas is not None and pas < 0:
+                raise ValueError("pas incorrect : {}".format(pas))
+            if nom not in historiques:
+                historiques[nom] = historique(bases[nom])
+            points = historiques[nom].points(
+                parametres.get("start", ["end-1days"])[0],
+                parametres.get("end", ["now"])[0], pas)
+        except ValueError as e:
+            self.send_error(400, explain=str(e))
+            return
+        except OSError as e:
+            self.send_error(503, explain=str(e))
+            return
+        self.entetes_morceaux("application/x-ndjson")
+        lignes = []
+        for date, lux in points:
+            lignes.append('{{"horodatage": {}, "lux": {}}}\n'.format(
+                date, "null" if lux is None else lux))
+            if len(lignes) >= POINTS_PAR_MORCEAU:
+                self.morceau("".join(lignes).encode("utf-8"))
+                lignes = []
+        if lignes:
+            self.morceau("".join(lignes).encode("utf-8"))
+        self.morceau(b"")
+
+    def serve_flux(self):
+        """ chaque nouvelle mesure (événement mesure) et chaque changement
+        d'état d'une porte (événement etat), au format server-sent events
+        """
+        file = diffusion.abonne()
+        if file is None:
+            self.send_error(503, explain="trop de flux ouverts")
+            return
+        try:
+            self.entetes_morceaux("text/event-stream")
+            while True:
+                try:
+                    donnees = file.get(timeout=15)
+                except queue.Empty:
+                    # commentaire : garde la connexion ouverte
+                    self.morceau(b": \n\n")
+                    continue
+                if donnees is None:
+                    break
+                self.morceau(donnees)
+            self.morceau(b"")
+        except OSError:
+            self.close_connection = True
+        finally:
+            diffusion.desabonne(file)
+
+    def entetes_cache(self, fichier):
+        self.send_header("ETag", fichier.etag)
+        self.send_header("Last-Modified", fichier.date)
+        self.send_header("Cache-Control",
+                         "max-age={}".format(cache_fichiers.duree))
+
+    def non_modifie(self, fichier):
+        """ le client a-t-il déjà la version courante du fichier ? """
+        etags = self.headers.get("If-None-Match")
+        if etags is not None:
+            return etags.strip() == "*" or fichier.etag in \
+                [etag.strip() for etag in etags.split(",")]
+        date = self.headers.get("If-Modified-Since")
+        if date is None:
+            return False
+        try:
+            date = email.utils.parsedate_to_datetime(date).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(fichier.mtime) <= date
+
+    def serve_metriques(self):
+        """ métriques du serveur et de garage.py, au format Prometheus """
+        contenu = metriques.registre_http.texte()
+        try:
+            with open(fichier_metriques, encoding="utf-8") as fich:
+                contenu += fich.read()
+        except OSError:
+            # garage.py arrêté ou métriques désactivées
+            pass
+        contenu = contenu.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-type", metriques.TYPE_CONTENU)
+        self.send_header("Content-length", len(contenu))
+        self.send_header("Cache-Control", "no-cache")
         self.end_headers()
         self.wfile.write(contenu)
 
     def do_GET(self):
-        if self.path in ('/favicon.ico', '/garage_annee.png',
+        debut = time.perf_counter()
+        self.code = None
+        try:
+            self.repond()
+        finally:
+            chemin = urllib.parse.urlsplit(self.path).path
+            if chemin not in CHEMINS:
+                chemin = "autre"
+            metriques.HTTP_DUREE.observe(time.perf_counter() - debut, chemin)
+            metriques.HTTP_REQUETES.ajoute(chemin, str(self.code))
+
+    def repond(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/metrics':
+            return self.serve_metriques()
+        if url.path == '/api/current':
+            return self.serve_actuel()
+        if url.path == '/api/history':
+            return self.serve_historique(url.query)
+        if url.path == '/api/stream':
+            return self.serve_flux()
+        if graphes is not None:
+            chemin, extension = os.path.splitext(url.path)
+            if extension == '.' + graphes.extension:
+                if chemin in GRAPHES:
+                    return self.serve_graphe(GRAPHES[chemin])
+                if chemin == '/graphe':
+                    return self.serve_graphe(parametres=url.query)
+
+        if url.path in ('/favicon.ico', '/garage_annee.png',
             '/garage_jour.png', '/garage_mois.png'):
-            return self.serve_image(self.path)
+            return self.serve_image(url.path)
 
-        if self.path != '/':
-            self.send_response(404)
+        if url.path != '/':
+            self.send_error(404)
             return
 
+        try:
+            texte = mesures()
+        except EcritureInterrompue as e:
+            self.send_error(503, explain=str(e))
+            return
+        # images de gen_graphs, ou tracées à la demande
+        extension = graphes.extension if graphes is not None else 'png'
+        contenu = bytes(
+        """{mesures}
+        <img src='/garage_jour.{ext}' alt='Graphique du jour'</img><br>
+        <img src='/garage_mois.{ext}' alt='Graphique du mois'</img><br>
+        <img src='/garage_annee.{ext}' alt='Graphique de année'</img><br>
+        """.format(mesures=texte, ext=extension), "utf8")
+
         # envoi code status
         self.send_response(200)
 
         # envoi entête
         self.send_header("Content-type", "text/html; charset=utf-8")
+        self.send_header("Content-length", len(contenu))
         self.end_headers()
 
         # envoi message
-        lu = tsl.read()
-        tsl.active(False)
-        self.wfile.write(bytes(
-        """La lumière vaut {lu}<br>
-        <img src='/garage_jour.png' alt='Graphique du jour'</img><br>
-        <img src='/garage_mois.png' alt='Graphique du mois'</img><br>
-        <img src='/garage_annee.png' alt='Graphique de année'</img><br>
-        """.format(lu=lu), "utf8"))
+        self.wfile.write(contenu)
 
 
-def initialisation():
-    print("Vérification du capteur...")
-    try:
-        bus = SMBus(1)
-    except FileNotFoundError as e:
-        print("Erreur dans la recherche du bus I2C : {}".format(e),
-              file=sys.stderr)
-        sys.exit(ERR_I2C)
+def lecteur():
+    """ lecteur du fichier partagé, ouvert au premier appel """
+    global lecture
+    if lecture is None:
+        lecture = Lecture(fichier_partage)
+    return lecture
+
+
+def mesures():
+    """ dernière mesure de chaque capteur, lue dans le fichier partagé ;
+    EcritureInterrompue est transmise pour répondre 503
+    """
     try:
-        tsl = TSL2561(bus)
-    except IOError as e:
-        print("Erreur dans la recherche du capteur : {}".format(e),
-              file=sys.stderr)
-        sys.exit(ERR_TSL)
+        capteurs = lecteur().par_capteur()
+    except EcritureInterrompue:
+        raise
+    except (OSError, ValueError) as e:
+        return "Pas de mesure disponible : {}<br>".format(e)
+    if not capteurs:
+        return "Pas de mesure disponible<br>"
+    if len(capteurs) == 1:
+        return "La lumière vaut {lu}<br>".format(lu=capteurs[0].lux)
+    return "".join("{nom} : la lumière vaut {lu} ({etat})<br>".format(
+        nom=mesure.nom, lu=mesure.lux, etat=mesure.etat)
+        for mesure in capteurs)
+
+
+def initialisation():
     print("Démarrage du serveur.")
     config = configparser.ConfigParser()
     config.read(FICH_CONFIG)
@@ -101,11 +609,80 @@ def initialisation():
         print("Erreur dans la lecture du fichier de configuration :  "
               "{}".format(e), file=sys.stderr)
         sys.exit(ERR_CONFIG)
-    return tsl, addr, port
+    try:
+        fichier = config["Partage"]["fichier"]
+    except KeyError:
+        fichier = FICHIER_PARTAGE
+    try:
+        threads = config["Serveur"].getint("threads", fallback=8)
+        file = config["Serveur"].getint("file", fallback=32)
+        journal = config["Serveur"].getboolean("journal", fallback=True)
+        arret = config["Serveur"].getfloat("arret", fallback=ARRET)
+        cache_fichiers.duree = config["Serveur"].getint("cache",
+                                                        fallback=60)
+        cache_fichiers.taille_max = config["Serveur"].getint(
+            "cache_taille_max", fallback=1 << 20)
+        mon_serveur.timeout = config["Serveur"].getfloat("timeout",
+                                                         fallback=10)
+        diffusion.max_abonnes = config["Serveur"].getint(
+            "flux", fallback=max(1, threads // 2))
+        global fichier_metriques
+        if "Metriques" in config:
+            fichier_metriques = config["Metriques"].get("fichier",
+                                                        metriques.FICHIER)
+    except ValueError as e:
+        print("Erreur dans la lecture du fichier de configuration :  "
+              "{}".format(e), file=sys.stderr)
+        sys.exit(ERR_CONFIG)
+    if "rrd" in config and "base" in config["rrd"]:
+        bases["garage"] = config["rrd"]["base"]
+    for section in config.sections():
+        if section.startswith(PREFIXE_CAPTEUR) and config[section].get("rrd"):
+            bases[section[len(PREFIXE_CAPTEUR):]] = config[section]["rrd"]
+    global graphes
+    if "rrd" in config and \
+            config["Serveur"].getboolean("graphes", fallback=True):
+        try:
+            taille = config["Serveur"].getint("graphes_cache", fallback=32)
+            if rrdtool is not None:
+                graphes = Graphes(config["rrd"]["base"], taille)
+            else:
+                graphes = GraphesSerie(fichier_serie(config["rrd"]["base"]),
+                                       taille)
+        except (KeyError, ValueError) as e:
+            print("Erreur dans la lecture du fichier de configuration :  "
+                  "{}".format(e), file=sys.stderr)
+            sys.exit(ERR_CONFIG)
+        except OSError as e:
+            print("Graphiques indisponibles : {}".format(e), file=sys.stderr)
+        else:
+            print("Graphiques tracés à la demande depuis {}".format(
+                graphes.base))
+    return fichier, addr, port, threads, file, journal, arret
 
 
 if __name__ == '__main__':
-    tsl, addr, port = initialisation()
-    httpd = HTTPServer((addr, port), mon_serveur)
-    print("Serveur en écoute sur {ad}:{port}...".format(ad=addr, port=port))
+    fichier_partage, addr, port, threads, file, journal, arret = \
+        initialisation()
+    # socket gardée lors d'une relance (SIGHUP) ou ouverte par systemd
+    fds = listen_fds()
+    httpd = ServeurConcurrent((addr, port), mon_serveur, threads, file,
+                              journal, fds[0] if fds else None)
+    signal.signal(signal.SIGTERM,
+                  lambda signum, frame: httpd.demande_arret("arret"))
+    signal.signal(signal.SIGHUP,
+                  lambda signum, frame: httpd.demande_arret("relance"))
+    print("Serveur en écoute sur {ad}:{port}...".format(
+        ad=httpd.server_address[0], port=httpd.server_address[1]))
+    sd_notify("READY=1")
     httpd.serve_forever()
+    # les connexions qui arrivent maintenant attendent dans la file de la
+    # socket d'écoute, qui reste ouverte en cas de relance
+    restantes = httpd.attend(arret)
+    if restantes:
+        print("{} connexions interrompues".format(restantes),
+              file=sys.stderr)
+    if httpd.demande == "relance":
+        print("Relance du serveur.")
+        reexec([httpd.fileno()])
+    httpd.server_close()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Écriture groupée des mesures dans les bases de données tournantes.
+Les mesures sont gardées en mémoire et écrites par un seul appel à
+rrdtool.update pour plusieurs dates, ce qui limite les écritures sur la
+carte SD. Les écritures peuvent aussi passer par le démon rrdcached.
+
+Copyright (C) 2018,2019  christophe Nanteuil <christophe.nanteuil@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+import time
+import rrdtool
+import metriques
+
+logger = logging.getLogger('Garage')
+
+
+class TamponRRD:
+    """ mesures en attente d'écriture, par base de données """
+
+    def __init__(self, taille=10, delai=300, demon=None):
+        """
+        param: taille: nombre de mesures écrites en une fois
+        param: delai: durée maximale en secondes pendant laquelle une mesure
+            reste en mémoire
+        param: demon: adresse du démon rrdcached (unix:/chemin ou hôte:port)
+        """
+        self.taille = taille
+        self.delai = delai
+        self.demon = demon
+        self._mesures = {}
+        self._premiere = {}
+        self._sources = {}
+
+    def sources(self, base):
+        """ nombre de sources de données de la base : les valeurs en trop
+        ne sont pas écrites dans les bases créées avant les valeurs brutes
+        """
+        if base not in self._sources:
+            try:
+                infos = rrdtool.info(base)
+            except rrdtool.OperationalError:
+                return None
+            self._sources[base] = len([cle for cle in infos
+                                       if cle.endswith(".index")])
+        return self._sources[base]
+
+    def ajoute(self, base, horodatage, *valeurs):
+        """ ajoute une mesure prise à la date horodatage (secondes) """
+        valeurs = valeurs[:self.sources(base)]
+        seconde = int(horodatage)
+        mesures = self._mesures.setdefault(base, [])
+        point = "{}:{}".format(seconde, ":".join(str(v) for v in valeurs))
+        if mesures and mesures[-1][0] >= seconde:
+            # rrdtool refuse deux mises à jour à la même seconde
+            mesures[-1] = (seconde, point)
+        else:
+            mesures.append((seconde, point))
+        self._premiere.setdefault(base, time.monotonic())
+        if len(mesures) >= self.taille or \
+                time.monotonic() - self._premiere[base] >= self.delai:
+            self.vide(base)
+
+    def vide(self, base=None):
+        """ écrit les mesures en attente d'une base, ou de toutes """
+        for base in [base] if base is not None else list(self._mesures):
+            mesures = self._mesures.pop(base, [])
+            self._premiere.pop(base, None)
+            if not mesures:
+                continue
+            options = ["--daemon", self.demon] if self.demon else []
+            debut = time.perf_counter()
+            try:
+                rrdtool.update(base, *options,
+                               *(point for _, point in mesures))
+            except rrdtool.OperationalError as e:
+                metriques.ECRITURE_ERREURS.ajoute("rrdtool")
+                logger.error("Erreur lors de l'écriture de %s mesures dans "
+                             "%s : %s", len(mesures), base, e)
+            else:
+                metriques.ECRITURE_DUREE.observe(time.perf_counter() - debut,
+                                                 "rrdtool")
+                logger.debug("%s mesures écrites dans %s", len(mesures), base)
+
+    def en_attente(self):
+        """ nombre de mesures en attente, toutes bases confondues """
+        return sum(len(mesures) for mesures in self._mesures.values())
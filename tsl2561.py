@@ -18,8 +18,24 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import bisect
 import time
 
+# imported by the first call to lux_array: numpy takes seconds to import on
+# small boards and the daemon never needs it
+numpy = None
+
+
+def _load_numpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+    return numpy
+
+
 _COMMAND_BIT = 0x80
 _WORD_BIT = 0x20
 _CLEAR_BIT = 0x40
@@ -33,6 +49,9 @@ _REGISTER_ID = 0x0A
 _REGISTER_CHANNEL0 = 0x0C
 _REGISTER_CHANNEL1 = 0x0E
 
+# registers whose value is only changed by the driver: writes can be cached
+_CACHED_REGISTERS = (_REGISTER_CONTROL, _REGISTER_TIMING, _REGISTER_INTERRUPT)
+
 _CONTROL_POWERON = 0x03
 _CONTROL_POWEROFF = 0x00
 
@@ -48,6 +67,17 @@ _INTEGRATION_TIME = {
 }
 
 
+# (gain, integration time) settings tried by read(autorange=True), shortest
+# integration first and, for the same time, best resolution first
+_RANGES = sorted(((gain, time) for gain in (1, 16)
+                  for time in _INTEGRATION_TIME if time),
+                 key=lambda setting: (setting[1], -setting[0]))
+
+
+def _scale(integration_time, gain):
+    return _INTEGRATION_TIME[integration_time][5] / gain
+
+
 class TSL2561:
     _LUX_SCALE = (
     #       K       B       M
@@ -60,26 +90,83 @@ class TSL2561:
         (0x029a, 0x0018, 0x0012),
     )
 
-    def __init__(self, bus, address=0x39):
+    def __init__(self, bus, address=0x39, block=False, continuous=False):
         self.bus = bus
         self.address = address
+        self.block = block
+        # monotonic time of the last power on, and (time, channels) of the
+        # last conversion read in continuous mode
+        self._powered_at = None
+        self._last = None
+        # number of I2C transactions since creation, and during last read()
+        self.transactions = 0
+        self.last_transactions = 0
+        # raw values of the last read(), and the (gain, integration time)
+        # they were read with
+        self.last_channels = None
+        self.last_range = None
+        # saturated conversions read since creation
+        self.saturations = 0
+        # called with (seconds, failed) after each I2C transaction and with
+        # (seconds,) after each read(), to collect latencies
+        self.transaction_hook = None
+        self.read_hook = None
+        self._cache = {}
         sensor_id = self.sensor_id()
         if not sensor_id & 0x10:
             raise RuntimeError("bad sensor id 0x{:x}".format(sensor_id))
         self._active = self._register8(_REGISTER_CONTROL) != 0
         self._gain, self._integration_time = self._get_gain_and_time()
+        self._scale = _scale(self._integration_time, self._gain)
+        if self._active:
+            # powered before us: a conversion is already available
+            self._powered_at = time.monotonic() - self.conversion_time()
+        self._continuous = False
+        self.continuous(continuous)
+
+    def _transfer(self, function, *args):
+        self.transactions += 1
+        if self.transaction_hook is None:
+            return function(self.address, *args)
+        start = time.perf_counter()
+        try:
+            result = function(self.address, *args)
+        except OSError:
+            self.transaction_hook(time.perf_counter() - start, True)
+            raise
+        self.transaction_hook(time.perf_counter() - start, False)
+        return result
 
     def _register16(self, register, value=None):
-        register |= _COMMAND_BIT | _WORD_BIT
+        command = register | _COMMAND_BIT | _WORD_BIT
         if value is None:
-            return self.bus.read_word_data(self.address, register)
-        self.bus.write_word_data(self.address, register, value)
+            return self._transfer(self.bus.read_word_data, command)
+        self._transfer(self.bus.write_word_data, command, value)
 
     def _register8(self, register, value=None):
-        register |= _COMMAND_BIT
+        command = register | _COMMAND_BIT
         if value is None:
-            return self.bus.read_byte_data(self.address, register)
-        self.bus.write_byte_data(self.address, register, value)
+            result = self._transfer(self.bus.read_byte_data, command)
+            if register in _CACHED_REGISTERS:
+                self._cache[register] = result
+            return result
+        if self._cache.get(register) == value:
+            return
+        # forget the cached value if the write fails
+        self._cache.pop(register, None)
+        self._transfer(self.bus.write_byte_data, command, value)
+        if register in _CACHED_REGISTERS:
+            self._cache[register] = value
+
+    def _channels(self):
+        if self.block:
+            # both channels in one transaction, from the same integration
+            data = self._transfer(self.bus.read_i2c_block_data,
+                                  _REGISTER_CHANNEL0 | _COMMAND_BIT, 4)
+            return data[0] | data[1] << 8, data[2] | data[3] << 8
+        broadband = self._register16(_REGISTER_CHANNEL0)
+        ir = self._register16(_REGISTER_CHANNEL1)
+        return broadband, ir
 
     def active(self, value=None):
         if value is None:
@@ -89,6 +176,25 @@ class TSL2561:
             self._active = value
             self._register8(_REGISTER_CONTROL,
                 _CONTROL_POWERON if value else _CONTROL_POWEROFF)
+            self._powered_at = time.monotonic() if value else None
+            self._last = None
+
+    def continuous(self, value=None):
+        if value is None:
+            return self._continuous
+        self._continuous = bool(value)
+        if self._continuous:
+            self.active(True)
+
+    def conversion_time(self):
+        return _INTEGRATION_TIME[self._integration_time][1] / 1000
+
+    def remaining(self):
+        """seconds before the first conversion since power on is done"""
+        if self._powered_at is None:
+            return self.conversion_time()
+        elapsed = time.monotonic() - self._powered_at
+        return max(0, self.conversion_time() - elapsed)
 
     def gain(self, value=None):
         if value is None:
@@ -109,9 +215,14 @@ class TSL2561:
     def _update_gain_and_time(self):
         was_active = self.active()
         self.active(True)
-        self._register8(_REGISTER_TIMING,
-            _INTEGRATION_TIME[self._integration_time][0] |
-            {1: 0x00, 16: 0x10}[self._gain])
+        timing = (_INTEGRATION_TIME[self._integration_time][0] |
+                  {1: 0x00, 16: 0x10}[self._gain])
+        if self._cache.get(_REGISTER_TIMING) != timing:
+            # the conversion in progress restarts with the new settings
+            self._powered_at = time.monotonic()
+            self._last = None
+        self._register8(_REGISTER_TIMING, timing)
+        self._scale = _scale(self._integration_time, self._gain)
         self.active(was_active)
 
     def _get_gain_and_time(self):
@@ -129,16 +240,53 @@ class TSL2561:
         return self._register8(_REGISTER_ID)
 
     def _read(self):
+        if self._continuous:
+            return self._read_continuous()
         was_active = self.active()
         self.active(True)
-        if not was_active:
-            # if the sensor was off, wait for measurement
-            time.sleep(_INTEGRATION_TIME[self._integration_time][1] / 1000)
-        broadband = self._register16(_REGISTER_CHANNEL0)
-        ir = self._register16(_REGISTER_CHANNEL1)
+        # if the sensor was off, wait for measurement
+        delay = self.remaining()
+        if delay:
+            time.sleep(delay)
+        broadband, ir = self._channels()
         self.active(was_active)
         return broadband, ir
 
+    def _read_continuous(self):
+        # the sensor stays powered: only the first read after power on
+        # waits, the next ones get the last completed conversion
+        self.active(True)
+        if (self._last is not None and
+                time.monotonic() - self._last[0] < self.conversion_time()):
+            # no new conversion since the last read
+            return self._last[1]
+        delay = self.remaining()
+        if delay:
+            time.sleep(delay)
+        channels = self._channels()
+        self._last = (time.monotonic(), channels)
+        return channels
+
+    @classmethod
+    def _lux_table(cls):
+        """K, B and M columns of _LUX_SCALE; B and M end with 0 for the
+        ratios above the last K"""
+        table = cls.__dict__.get("_table")
+        if table is None:
+            k, b, m = zip(*cls._LUX_SCALE)
+            table = cls._table = (k, b + (0,), m + (0,))
+        return table
+
+    @classmethod
+    def _lux_value(cls, broadband, ir, scale):
+        channel0 = (broadband * scale) / 1024
+        channel1 = (ir * scale) / 1024
+        ratio = (((channel1 * 1024) / channel0 if channel0 else 0) + 1) / 2
+        k, b, m = cls._lux_table()
+        index = bisect.bisect_left(k, ratio)
+        return (max(0, channel0 * b[index] - channel1 * m[index]) +
+                8192) / 16384
+
     def _lux(self, channels):
         if self._integration_time == 0:
             raise ValueError(
@@ -146,22 +294,159 @@ class TSL2561:
         broadband, ir = channels
         clip = _INTEGRATION_TIME[self._integration_time][2]
         if broadband > clip or ir > clip:
+            self.saturations += 1
             raise ValueError("sensor saturated")
-        scale = _INTEGRATION_TIME[self._integration_time][5] / self._gain
-        channel0 = (broadband * scale) / 1024
-        channel1 = (ir * scale) / 1024
-        ratio = (((channel1 * 1024) / channel0 if channel0 else 0) + 1) / 2
-        for k, b, m in self._LUX_SCALE:
-            if ratio <= k:
-                break
-        else:
-            b = 0
-            m = 0
-        return (max(0, channel0 * b - channel1 * m) + 8192) / 16384
+        return self._lux_value(broadband, ir, self._scale)
+
+    @classmethod
+    def lux_array(cls, broadband, ir, gain=1, integration_time=402):
+        """lux of sequences of raw channel values, computed in one pass with
+        numpy if it is installed (a list otherwise); gain and
+        integration_time may be sequences too. Saturated or missing
+        samples give NaN; the other ones the same value as read().
+        """
+        if _load_numpy() is None:
+            return cls._lux_list(broadband, ir, gain, integration_time)
+        broadband = numpy.asarray(broadband, dtype=float)
+        ir = numpy.asarray(ir, dtype=float)
+        times = numpy.asarray(integration_time)
+        scale = numpy.full(times.shape, numpy.nan)
+        clip = numpy.full(times.shape, numpy.nan)
+        for value, (_, _, clip_, _, _, scale_) in _INTEGRATION_TIME.items():
+            if value:
+                scale[times == value] = scale_
+                clip[times == value] = clip_
+        if not numpy.isin(times, list(_INTEGRATION_TIME)).all():
+            raise ValueError("integration time must be 13ms, 101ms or 402ms")
+        scale = scale / numpy.asarray(gain, dtype=float)
+        channel0 = broadband * scale / 1024
+        channel1 = ir * scale / 1024
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ratio = numpy.where(channel0 != 0, channel1 * 1024 / channel0, 0)
+            ratio = (ratio + 1) / 2
+            k, b, m = cls._lux_table()
+            index = numpy.searchsorted(k, ratio, side="left")
+            lux = (numpy.maximum(0, channel0 * numpy.take(b, index) -
+                                 channel1 * numpy.take(m, index)) +
+                   8192) / 16384
+            invalid = ~((broadband <= clip) & (ir <= clip))
+        return numpy.where(invalid, numpy.nan, lux)
+
+    @classmethod
+    def _lux_list(cls, broadband, ir, gain, integration_time):
+        count = len(broadband)
+        if not isinstance(gain, (list, tuple)):
+            gain = [gain] * count
+        if not isinstance(integration_time, (list, tuple)):
+            integration_time = [integration_time] * count
+        result = []
+        for values in zip(broadband, ir, gain, integration_time):
+            broadband_, ir_, gain_, time_ = values
+            if time_ not in _INTEGRATION_TIME:
+                raise ValueError(
+                    "integration time must be 13ms, 101ms or 402ms")
+            clip = _INTEGRATION_TIME[time_][2]
+            if time_ == 0 or broadband_ is None or ir_ is None or \
+                    not (broadband_ <= clip and ir_ <= clip):
+                result.append(float("nan"))
+            else:
+                result.append(cls._lux_value(broadband_, ir_,
+                                             _scale(time_, gain_)))
+        return result
 
-    def read(self, autogain=False, raw=False):
+    def broadband_threshold(self, lux, channels=None):
+        """broadband count giving lux at the ir/broadband ratio of channels
+        (the last read by default), for the interrupt threshold registers
+        """
+        if self._integration_time == 0:
+            raise ValueError(
+                "can't calculate lux with manual integration time")
+        broadband, ir = channels or self.last_channels or (1, 0)
+        ir_ratio = ir / broadband if broadband else 0
+        ratio = (ir_ratio * 1024 + 1) / 2
+        k, b, m = self._lux_table()
+        index = bisect.bisect_left(k, ratio)
+        coefficient = b[index] - ir_ratio * m[index]
+        if coefficient <= 0:
+            return 0xffff
+        count = (lux * 16384 - 8192) * 1024 / (self._scale * coefficient)
+        return int(min(0xffff, max(0, count)))
+
+    def read(self, autogain=False, raw=False, autorange=False):
+        transactions = self.transactions
+        start = time.perf_counter()
+        try:
+            return self._read_value(autogain, raw, autorange)
+        finally:
+            self.last_transactions = self.transactions - transactions
+            if self.read_hook is not None:
+                self.read_hook(time.perf_counter() - start)
+
+    def _best_range(self, broadband, saturated=False):
+        """(gain, integration time) with the shortest integration whose
+        expected broadband count, estimated from broadband read with the
+        current settings, is between the min and max columns of
+        _INTEGRATION_TIME. The current settings are kept while they fit,
+        unless a shorter integration fits with twice its min count.
+        When saturated, broadband is only a lower bound and less sensitive
+        settings are considered.
+        """
+        current = (self._gain, self._integration_time)
+        fitting = []
+        for gain, time_ in _RANGES:
+            scale = _scale(time_, gain)
+            if saturated and scale <= self._scale:
+                continue
+            count = broadband * self._scale / scale
+            low, high = _INTEGRATION_TIME[time_][3:5]
+            if low <= count and (saturated or count <= high):
+                fitting.append(((gain, time_), count >= 2 * low))
+        for setting, margin in fitting:
+            if setting == current or (
+                    margin and setting[1] < self._integration_time):
+                return setting
+        if fitting:
+            return fitting[0][0]
+        scales = {setting: _scale(setting[1], setting[0])
+                  for setting in _RANGES}
+        if saturated or broadband > _INTEGRATION_TIME[current[1]][4]:
+            # too bright for any setting: least sensitive one
+            return max(scales, key=scales.get)
+        # too dark: most sensitive one
+        return min(scales, key=scales.get)
+
+    def _set_range(self, gain, integration_time):
+        self._gain = gain
+        self._integration_time = integration_time
+        self._update_gain_and_time()
+
+    def _autorange(self, broadband, ir):
+        """read again with less sensitive settings while the sensor is
+        saturated; returns the channels and the settings for the next read
+        (None to keep the current ones)
+        """
+        while True:
+            clip = _INTEGRATION_TIME[self._integration_time][2]
+            saturated = broadband > clip or ir > clip
+            setting = self._best_range(max(broadband, ir), saturated)
+            if setting == (self._gain, self._integration_time):
+                # saturated with the least sensitive setting: _lux raises
+                return broadband, ir, None
+            if not saturated:
+                return broadband, ir, setting
+            self.saturations += 1
+            self._set_range(*setting)
+            broadband, ir = self._read()
+
+    def _read_value(self, autogain, raw, autorange):
         broadband, ir = self._read()
-        if autogain:
+        next_range = None
+        if autorange:
+            if self._integration_time == 0:
+                raise ValueError(
+                    "can't do autorange with manual integration time")
+            broadband, ir, next_range = self._autorange(broadband, ir)
+        elif autogain:
             if self._integration_time == 0:
                 raise ValueError(
                     "can't do autogain with manual integration time")
@@ -173,9 +458,17 @@ class TSL2561:
             if new_gain != self._gain:
                 self.gain(new_gain)
                 broadband, ir = self._read()
-        if raw:
-            return broadband, ir
-        return self._lux((broadband, ir))
+        self.last_channels = broadband, ir
+        self.last_range = self._gain, self._integration_time
+        try:
+            if raw:
+                return broadband, ir
+            return self._lux((broadband, ir))
+        finally:
+            # the channels read are converted with the settings they were
+            # read with, the new ones apply from the next read
+            if next_range is not None:
+                self._set_range(*next_range)
 
     def threshold(self, cycles=None, min_value=None, max_value=None):
         if min_value is None and max_value is None and cycles is None:
@@ -205,9 +498,9 @@ class TSL2561:
     def interrupt(self, value):
         if value or value is None:
             raise ValueError("can only clear the interrupt")
-        self.bus.write_byte_data(self.address,
-                                 _CLEAR_BIT | _REGISTER_CONTROL,
-                                 b'\x00')
+        # a command byte alone clears the interrupt without writing CONTROL
+        self._transfer(self.bus.write_byte,
+                       _COMMAND_BIT | _CLEAR_BIT | _REGISTER_CONTROL)
 
 
 # Those packages are identical.